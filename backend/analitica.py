@@ -0,0 +1,409 @@
+import asyncio
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import versiones
+from fechas import sin_zona
+from ocupacion import filtro_ocupan, fines_efectivos
+from database import (
+    contratos_collection, pagos_collection, habitaciones_collection, pisos_collection, inquilinos_collection,
+    contratos_archivo_collection, pagos_archivo_collection
+)
+
+# Resultados ya calculados: (informe, parámetros, versiones de los datos) -> resultado
+_cache = {}
+MAXIMO_CACHE = 64
+
+
+async def _memorizado(informe: str, parametros: tuple, colecciones: tuple, calcular):
+    """Devuelve el resultado en caché mientras no cambien los parámetros ni la versión de las colecciones"""
+    version = await versiones.obtener()
+    clave = (informe, parametros, tuple(version.get(c, 0) for c in colecciones))
+    if clave not in _cache:
+        resultado = await calcular()
+        if len(_cache) >= MAXIMO_CACHE:
+            _cache.clear()
+        _cache[clave] = resultado
+    return _cache[clave]
+
+
+def _indices_dia(fechas: pd.Series, base: np.datetime64, n: int) -> np.ndarray:
+    """Posición de cada fecha en el rango diario [base, base + n], recortada a sus extremos"""
+    dias = (fechas.values.astype("datetime64[D]") - base).astype(np.int64)
+    return np.clip(dias, 0, n)
+
+
+def calcular_series(
+    contratos: pd.DataFrame,
+    cobrados: pd.Series,
+    total_habitaciones: int,
+    desde: pd.Timestamp,
+    hasta: pd.Timestamp,
+    granularidad: str
+) -> dict:
+    """Series de ocupación e ingresos con aritmética de intervalos vectorizada.
+
+    Cada contrato suma +1 (y su cuota mensual) el día que empieza y resta
+    el día que termina; la suma acumulada da las habitaciones ocupadas y la
+    cuota vigente de cada día sin recorrer los días de cada contrato.
+    """
+    dias = pd.date_range(desde, hasta, freq="D")
+    n = len(dias)
+    base = np.datetime64(desde.date(), "D")
+
+    if len(contratos):
+        inicio = _indices_dia(contratos["fecha_inicio"], base, n)
+        fin = _indices_dia(contratos["fecha_fin"], base, n)
+        cuota = contratos["renta_mensual"].to_numpy(float) + contratos["gastos_mensuales_tarifa"].fillna(0).to_numpy(float)
+        ocupadas = np.cumsum(np.bincount(inicio, minlength=n + 1) - np.bincount(fin, minlength=n + 1))[:n]
+        cuota_vigente = np.cumsum(
+            np.bincount(inicio, weights=cuota, minlength=n + 1) - np.bincount(fin, weights=cuota, minlength=n + 1)
+        )[:n]
+    else:
+        ocupadas = np.zeros(n)
+        cuota_vigente = np.zeros(n)
+
+    ocupadas = np.minimum(ocupadas, total_habitaciones)
+    tasa = ocupadas / total_habitaciones if total_habitaciones else np.zeros(n)
+
+    if granularidad == "diaria":
+        return {
+            "fechas": dias.strftime("%Y-%m-%d").tolist(),
+            "habitaciones_ocupadas": ocupadas.astype(int).tolist(),
+            "tasa_ocupacion": np.round(tasa, 4).tolist()
+        }
+
+    # Cuota prorrateada por día: la cuota mensual se reparte entre los días del mes
+    diario = pd.DataFrame({"tasa": tasa, "esperado": cuota_vigente / dias.days_in_month.to_numpy()}, index=dias)
+    mensual = diario.resample("MS").agg({"tasa": "mean", "esperado": "sum"})
+    meses = mensual.index.strftime("%Y-%m")
+    return {
+        "meses": meses.tolist(),
+        "tasa_ocupacion": np.round(mensual["tasa"].to_numpy(), 4).tolist(),
+        "ingresos_esperados": np.round(mensual["esperado"].to_numpy(), 2).tolist(),
+        "ingresos_cobrados": np.round(cobrados.reindex(meses, fill_value=0.0).to_numpy(float), 2).tolist()
+    }
+
+
+async def _cargar_datos(desde: datetime, hasta: datetime):
+    """Lee en bloque los intervalos de contrato, lo cobrado por mes y el total de habitaciones.
+
+    El histórico incluye los contratos y pagos que ya se han pasado al archivo.
+    """
+    ahora = sin_zona(datetime.now(timezone.utc))
+    filtro_contratos = {"fecha_inicio": {"$lte": hasta}, "fecha_fin": {"$gt": desde}, **filtro_ocupan(ahora)}
+    proyeccion_contratos = {
+        "_id": 0, "fecha_inicio": 1, "fecha_fin": 1, "fecha_finalizacion": 1, "estado": 1,
+        "renta_mensual": 1, "gastos_mensuales_tarifa": 1
+    }
+    pipeline_cobrados = [
+        {"$match": {
+            "estado": "pagado",
+            "tipo": {"$in": ["alquiler", "gastos"]},
+            "mes_anio": {"$gte": desde.strftime("%Y-%m"), "$lte": hasta.strftime("%Y-%m")}
+        }},
+        {"$group": {"_id": "$mes_anio", "total": {"$sum": "$importe"}}}
+    ]
+    contratos, archivados, cobrados, cobrados_archivo, total_habitaciones = await asyncio.gather(
+        contratos_collection.find(filtro_contratos, proyeccion_contratos).to_list(None),
+        contratos_archivo_collection.find(filtro_contratos, proyeccion_contratos).to_list(None),
+        pagos_collection.aggregate(pipeline_cobrados).to_list(None),
+        pagos_archivo_collection.aggregate(pipeline_cobrados).to_list(None),
+        habitaciones_collection.count_documents({})
+    )
+    df = pd.DataFrame(contratos + archivados, columns=[
+        "fecha_inicio", "fecha_fin", "fecha_finalizacion", "estado", "renta_mensual", "gastos_mensuales_tarifa"
+    ])
+    df["fecha_inicio"] = pd.to_datetime(df["fecha_inicio"])
+    df["fecha_fin"] = fines_efectivos(df, ahora)
+    df = df.dropna(subset=["fecha_fin"])
+    serie_cobrados = (
+        pd.DataFrame(cobrados + cobrados_archivo, columns=["_id", "total"])
+        .groupby("_id")["total"].sum().astype(float)
+    )
+    return df, serie_cobrados, total_habitaciones
+
+
+async def ocupacion_e_ingresos(anios: int, granularidad: str) -> dict:
+    """Series de los últimos anios años, cacheadas mientras no cambien los datos ni el día"""
+    hoy = datetime.now(timezone.utc).date()
+
+    async def calcular():
+        hasta = pd.Timestamp(hoy)
+        desde = hasta - pd.DateOffset(years=anios)
+        if granularidad == "mensual":
+            desde = desde.replace(day=1)
+        contratos, cobrados, total_habitaciones = await _cargar_datos(desde.to_pydatetime(), hasta.to_pydatetime())
+        series = await asyncio.to_thread(
+            calcular_series, contratos, cobrados, total_habitaciones, desde, hasta, granularidad
+        )
+        return {
+            "desde": desde.strftime("%Y-%m-%d"),
+            "hasta": hasta.strftime("%Y-%m-%d"),
+            "granularidad": granularidad,
+            "total_habitaciones": total_habitaciones,
+            **series
+        }
+
+    return await _memorizado(
+        "ocupacion_ingresos", (anios, granularidad, hoy), ("contratos", "pagos", "habitaciones"), calcular
+    )
+
+
+def calcular_proyeccion(
+    contratos: pd.DataFrame,
+    primer_mes: pd.Timestamp,
+    meses: int,
+    probabilidad_renovacion: float,
+    incremento_renovacion: float
+):
+    """Ingresos contratados y esperados por contrato y mes, como matrices contratos x meses.
+
+    La parte de cada mes que cubre un contrato se calcula a la vez para
+    todos con broadcasting; tras fecha_fin se suma la cuota renovada
+    ponderada por la probabilidad de renovación.
+    """
+    inicios_mes = pd.date_range(primer_mes, periods=meses, freq="MS")
+    fines_mes = inicios_mes + pd.offsets.MonthBegin(1)
+    dias_mes = inicios_mes.days_in_month.to_numpy(float)
+    un_dia = np.timedelta64(1, "D")
+
+    ini = contratos["fecha_inicio"].to_numpy("datetime64[ns]")[:, None]
+    fin = contratos["fecha_fin"].to_numpy("datetime64[ns]")[:, None]
+    mi = inicios_mes.to_numpy("datetime64[ns]")[None, :]
+    mf = fines_mes.to_numpy("datetime64[ns]")[None, :]
+
+    cuota = (
+        contratos["renta_mensual"].to_numpy(float)
+        + contratos["gastos_mensuales_tarifa"].fillna(0).to_numpy(float)
+        + np.where(contratos["tiene_limpieza"].fillna(False).to_numpy(bool),
+                   contratos["importe_limpieza_mensual"].fillna(0).to_numpy(float), 0.0)
+    )[:, None]
+
+    cubierto = np.clip((np.minimum(fin, mf) - np.maximum(ini, mi)) / un_dia, 0, None) / dias_mes
+    renovado = np.clip((mf - np.maximum(fin, mi)) / un_dia, 0, None) / dias_mes
+    contratado = cuota * cubierto
+    esperado = contratado + probabilidad_renovacion * cuota * (1 + incremento_renovacion) * renovado
+    return inicios_mes.strftime("%Y-%m").tolist(), contratado, esperado
+
+
+async def proyeccion_rentas(meses: int, probabilidad_renovacion: float, incremento_renovacion: float) -> dict:
+    """Rent roll de los próximos meses por piso, con escenario de renovaciones"""
+    primer_mes = pd.Timestamp(datetime.now(timezone.utc).date()).replace(day=1)
+
+    async def calcular():
+        contratos, habitaciones, pisos = await asyncio.gather(
+            contratos_collection.find(
+                {
+                    "estado": {"$in": ["activo", "programado"]},
+                    "fecha_fin": {"$gt": primer_mes.to_pydatetime()},
+                    "archivado": {"$ne": True}
+                },
+                {"_id": 0, "habitacion_id": 1, "fecha_inicio": 1, "fecha_fin": 1, "renta_mensual": 1,
+                 "gastos_mensuales_tarifa": 1, "tiene_limpieza": 1, "importe_limpieza_mensual": 1}
+            ).to_list(None),
+            habitaciones_collection.find({}, {"piso_id": 1}).to_list(None),
+            pisos_collection.find({}, {"nombre": 1}).to_list(None)
+        )
+        df = pd.DataFrame(contratos, columns=[
+            "habitacion_id", "fecha_inicio", "fecha_fin", "renta_mensual",
+            "gastos_mensuales_tarifa", "tiene_limpieza", "importe_limpieza_mensual"
+        ])
+        df["fecha_inicio"] = pd.to_datetime(df["fecha_inicio"])
+        df["fecha_fin"] = pd.to_datetime(df["fecha_fin"])
+        df["piso_id"] = df["habitacion_id"].map({h["_id"]: h["piso_id"] for h in habitaciones})
+
+        etiquetas, contratado, esperado = await asyncio.to_thread(
+            calcular_proyeccion, df, primer_mes, meses, probabilidad_renovacion, incremento_renovacion
+        )
+        por_piso_contratado = pd.DataFrame(contratado, index=df["piso_id"].fillna("")).groupby(level=0).sum()
+        por_piso_esperado = pd.DataFrame(esperado, index=df["piso_id"].fillna("")).groupby(level=0).sum()
+        nombres = {p["_id"]: p["nombre"] for p in pisos}
+
+        return {
+            "meses": etiquetas,
+            "escenario": {
+                "probabilidad_renovacion": probabilidad_renovacion,
+                "incremento_renovacion": incremento_renovacion
+            },
+            "total_contratos": len(df),
+            "total": {
+                "contratado": np.round(contratado.sum(axis=0), 2).tolist(),
+                "esperado": np.round(esperado.sum(axis=0), 2).tolist(),
+                "suma_contratado": round(float(contratado.sum()), 2),
+                "suma_esperado": round(float(esperado.sum()), 2)
+            },
+            "pisos": [
+                {
+                    "piso_id": piso_id or None,
+                    "nombre": nombres.get(piso_id),
+                    "contratado": np.round(por_piso_contratado.loc[piso_id].to_numpy(), 2).tolist(),
+                    "esperado": np.round(por_piso_esperado.loc[piso_id].to_numpy(), 2).tolist()
+                }
+                for piso_id in sorted(por_piso_contratado.index, key=lambda p: nombres.get(p, ""))
+            ]
+        }
+
+    return await _memorizado(
+        "proyeccion",
+        (meses, probabilidad_renovacion, incremento_renovacion, primer_mes),
+        ("contratos", "habitaciones", "pisos"),
+        calcular
+    )
+
+
+# Tramos de antigüedad de la deuda: (etiqueta, días mínimos desde el vencimiento)
+TRAMOS_MOROSIDAD = [("0-30", 0), ("31-60", 31), ("61-90", 61), ("90+", 91)]
+
+
+def calcular_deuda(contratos: pd.DataFrame, pagado: pd.DataFrame, hoy: pd.Timestamp) -> pd.DataFrame:
+    """Importe pendiente y días de retraso de cada mes vencido de cada contrato.
+
+    Los meses de todos los contratos se generan a la vez con np.repeat y se
+    cruzan con lo pagado por (contrato, mes); el vencimiento de cada mes es su
+    dia_pago (o el último día si el mes es más corto).
+    """
+    columnas = ["contrato_id", "mes_anio", "pendiente", "dias"]
+    if contratos.empty:
+        return pd.DataFrame(columns=columnas)
+
+    inicio = contratos["fecha_inicio"].to_numpy("datetime64[M]")
+    # El último mes es el que contiene el día anterior a fecha_fin, como mucho el actual
+    fin = np.minimum(
+        (contratos["fecha_fin"] - pd.Timedelta(microseconds=1)).to_numpy("datetime64[M]"),
+        np.datetime64(hoy, "M")
+    )
+    num_meses = np.clip((fin - inicio).astype(np.int64) + 1, 0, None)
+
+    fila = np.repeat(np.arange(len(contratos)), num_meses)
+    desplazamiento = np.arange(num_meses.sum()) - np.repeat(np.cumsum(num_meses) - num_meses, num_meses)
+    meses = inicio[fila] + desplazamiento.astype("timedelta64[M]")
+
+    primer_dia = meses.astype("datetime64[D]")
+    dias_mes = ((meses + 1).astype("datetime64[D]") - primer_dia).astype(np.int64)
+    dia_pago = np.clip(contratos["dia_pago"].fillna(1).to_numpy(np.int64)[fila], 1, dias_mes)
+    vencimiento = primer_dia + (dia_pago - 1).astype("timedelta64[D]")
+
+    cuota = (
+        contratos["renta_mensual"].to_numpy(float)
+        + contratos["gastos_mensuales_tarifa"].fillna(0).to_numpy(float)
+        + np.where(contratos["tiene_limpieza"].fillna(False).to_numpy(bool),
+                   contratos["importe_limpieza_mensual"].fillna(0).to_numpy(float), 0.0)
+    )[fila]
+
+    deuda = pd.DataFrame({
+        "contrato_id": contratos["_id"].to_numpy()[fila],
+        "mes_anio": np.datetime_as_string(meses, unit="M"),
+        "cuota": cuota,
+        "dias": (np.datetime64(hoy, "D") - vencimiento).astype(np.int64)
+    })
+    deuda = deuda[deuda["dias"] >= 0]
+    deuda = deuda.merge(pagado, on=["contrato_id", "mes_anio"], how="left")
+    deuda["pendiente"] = np.clip(deuda["cuota"] - deuda["pagado"].fillna(0), 0, None)
+    return deuda.loc[deuda["pendiente"] > 0.005, columnas]
+
+
+def _tramos(deuda: pd.DataFrame, clave: str) -> pd.DataFrame:
+    """Suma lo pendiente por clave y tramo de antigüedad"""
+    etiquetas = [t[0] for t in TRAMOS_MOROSIDAD]
+    limites = [t[1] for t in TRAMOS_MOROSIDAD]
+    tramo = pd.Categorical(
+        np.array(etiquetas)[np.searchsorted(limites, deuda["dias"].to_numpy(), side="right") - 1],
+        categories=etiquetas
+    )
+    tabla = deuda.assign(tramo=tramo).pivot_table(
+        index=clave, columns="tramo", values="pendiente", aggfunc="sum", fill_value=0.0, observed=False
+    )
+    tabla = tabla.reindex(columns=etiquetas, fill_value=0.0)
+    tabla["total"] = tabla.sum(axis=1)
+    return tabla.round(2).sort_values("total", ascending=False)
+
+
+async def morosidad() -> dict:
+    """Deuda pendiente por inquilino y por piso repartida en tramos de antigüedad"""
+    hoy = pd.Timestamp(datetime.now(timezone.utc).date())
+
+    async def calcular():
+        # La deuda de un contrato archivado sigue pendiente: se leen también las colecciones de archivo
+        ahora = sin_zona(datetime.now(timezone.utc))
+        proyeccion_contratos = {
+            "habitacion_id": 1, "inquilino_id": 1, "fecha_inicio": 1, "fecha_fin": 1, "fecha_finalizacion": 1,
+            "estado": 1, "dia_pago": 1, "renta_mensual": 1, "gastos_mensuales_tarifa": 1, "tiene_limpieza": 1,
+            "importe_limpieza_mensual": 1
+        }
+        pipeline_pagado = [
+            {"$match": {"estado": "pagado", "tipo": {"$in": ["alquiler", "gastos"]}}},
+            {"$group": {"_id": {"contrato_id": "$contrato_id", "mes_anio": "$mes_anio"}, "pagado": {"$sum": "$importe"}}}
+        ]
+        contratos, archivados, pagado, pagado_archivo, habitaciones, pisos, inquilinos = await asyncio.gather(
+            contratos_collection.find(filtro_ocupan(ahora), proyeccion_contratos).to_list(None),
+            contratos_archivo_collection.find(filtro_ocupan(ahora), proyeccion_contratos).to_list(None),
+            pagos_collection.aggregate(pipeline_pagado).to_list(None),
+            pagos_archivo_collection.aggregate(pipeline_pagado).to_list(None),
+            habitaciones_collection.find({}, {"piso_id": 1, "nombre": 1}).to_list(None),
+            pisos_collection.find({}, {"nombre": 1}).to_list(None),
+            inquilinos_collection.find({}, {"nombre": 1, "dni": 1}).to_list(None)
+        )
+        df_contratos = pd.DataFrame(contratos + archivados, columns=[
+            "_id", "habitacion_id", "inquilino_id", "fecha_inicio", "fecha_fin", "fecha_finalizacion", "estado",
+            "dia_pago", "renta_mensual", "gastos_mensuales_tarifa", "tiene_limpieza", "importe_limpieza_mensual"
+        ])
+        df_contratos["fecha_inicio"] = pd.to_datetime(df_contratos["fecha_inicio"])
+        # Un contrato terminado antes de tiempo no genera cuotas tras su finalización
+        df_contratos["fecha_fin"] = fines_efectivos(df_contratos, ahora)
+        df_contratos = df_contratos.dropna(subset=["fecha_fin"])
+        df_pagado = (
+            pd.DataFrame(
+                [{**p["_id"], "pagado": p["pagado"]} for p in pagado + pagado_archivo],
+                columns=["contrato_id", "mes_anio", "pagado"]
+            )
+            .groupby(["contrato_id", "mes_anio"], as_index=False)["pagado"].sum()
+        )
+
+        deuda = await asyncio.to_thread(calcular_deuda, df_contratos, df_pagado, hoy)
+
+        piso_de_habitacion = {h["_id"]: h["piso_id"] for h in habitaciones}
+        contexto = df_contratos.set_index("_id")
+        deuda["inquilino_id"] = deuda["contrato_id"].map(contexto["inquilino_id"])
+        deuda["piso_id"] = deuda["contrato_id"].map(contexto["habitacion_id"]).map(piso_de_habitacion)
+
+        nombres_pisos = {p["_id"]: p["nombre"] for p in pisos}
+        datos_inquilinos = {i["_id"]: i for i in inquilinos}
+        pisos_por_inquilino = deuda.groupby("inquilino_id")["piso_id"].agg(lambda ids: sorted(set(ids.dropna())))
+        etiquetas = [t[0] for t in TRAMOS_MOROSIDAD]
+
+        def _tramos_fila(fila) -> dict:
+            return {e: float(fila[e]) for e in etiquetas + ["total"]}
+
+        por_inquilino = _tramos(deuda, "inquilino_id") if len(deuda) else pd.DataFrame()
+        por_piso = _tramos(deuda.dropna(subset=["piso_id"]), "piso_id") if len(deuda) else pd.DataFrame()
+        meses_por_inquilino = deuda["inquilino_id"].value_counts()
+        totales = {e: 0.0 for e in etiquetas + ["total"]}
+        if len(por_inquilino):
+            totales = _tramos_fila(por_inquilino[etiquetas + ["total"]].sum().round(2))
+
+        return {
+            "fecha": hoy.strftime("%Y-%m-%d"),
+            "totales": totales,
+            "inquilinos": [
+                {
+                    "inquilino_id": inquilino_id,
+                    "nombre": datos_inquilinos.get(inquilino_id, {}).get("nombre"),
+                    "dni": datos_inquilinos.get(inquilino_id, {}).get("dni"),
+                    "pisos": [nombres_pisos.get(p) for p in pisos_por_inquilino.get(inquilino_id, [])],
+                    "meses_pendientes": int(meses_por_inquilino.get(inquilino_id, 0)),
+                    **_tramos_fila(fila)
+                }
+                for inquilino_id, fila in por_inquilino.iterrows()
+            ],
+            "pisos": [
+                {"piso_id": piso_id, "nombre": nombres_pisos.get(piso_id), **_tramos_fila(fila)}
+                for piso_id, fila in por_piso.iterrows()
+            ]
+        }
+
+    return await _memorizado(
+        "morosidad", (hoy,), ("contratos", "pagos", "habitaciones", "pisos", "inquilinos"), calcular
+    )
@@ -0,0 +1,108 @@
+import asyncio
+import os
+from datetime import datetime, timezone
+
+from fastapi import HTTPException
+from pymongo import DeleteOne, ReplaceOne
+
+import versiones
+from eventos import bus_eventos
+from repositorios import contratos_repo, pagos_repo, gastos_repo
+
+# Los contratos finalizados hace más de estos meses pasan al archivo
+ARCHIVO_MESES = int(os.environ.get("ARCHIVO_MESES", "24"))
+# Contratos que se mueven por lote (con sus pagos y gastos)
+TAMANO_LOTE = 200
+# Pausa entre lotes para no acaparar la base de datos
+PAUSA_ENTRE_LOTES = 0.1
+# Vueltas de copia y borrado por colección (los documentos que cambian durante una se mueven en la siguiente)
+MAXIMO_VUELTAS = 3
+
+
+def _restar_meses(fecha: datetime, meses: int) -> datetime:
+    """Primer día del mes de hace meses meses"""
+    total = fecha.year * 12 + fecha.month - 1 - meses
+    return fecha.replace(year=total // 12, month=total % 12 + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+async def _mover(origen, destino, filtro: dict, cambios: dict) -> list:
+    """Copia los documentos del filtro a destino (idempotente) y los borra del origen; devuelve sus ids.
+
+    Solo se borra un documento si no ha cambiado desde la copia (mismo
+    updated_at); los que se escriben entretanto se vuelven a copiar en la
+    siguiente vuelta, y lo mismo los que aparecen nuevos en el filtro.
+    """
+    movidos = []
+    for _ in range(MAXIMO_VUELTAS):
+        documentos = await origen.find(filtro).to_list(None)
+        if not documentos:
+            break
+        await destino.bulk_write(
+            [ReplaceOne({"_id": d["_id"]}, {**d, **cambios}, upsert=True) for d in documentos],
+            ordered=False
+        )
+        await origen.bulk_write(
+            [DeleteOne({"_id": d["_id"], "updated_at": d.get("updated_at")}) for d in documentos],
+            ordered=False
+        )
+        restantes = {d["_id"] for d in await origen.find(
+            {"_id": {"$in": [d["_id"] for d in documentos]}}, {"_id": 1}
+        ).to_list(None)}
+        movidos += [d["_id"] for d in documentos if d["_id"] not in restantes]
+    return movidos
+
+
+async def _mover_contratos(ids: list, al_archivo: bool) -> dict:
+    """Mueve contratos con sus pagos y gastos entre las colecciones activas y el archivo.
+
+    Primero los hijos y después el contrato: si el proceso se corta, el
+    contrato sigue en su sitio y la siguiente ejecución termina de moverlo.
+    Al final se repasan los hijos por si se creó alguno mientras tanto.
+    """
+    ahora = datetime.now(timezone.utc)
+    movidos = {repo.nombre: [] for repo in (pagos_repo, gastos_repo, contratos_repo)}
+    for repo in (pagos_repo, gastos_repo, contratos_repo, pagos_repo, gastos_repo):
+        origen, destino = (repo.coleccion, repo.archivo) if al_archivo else (repo.archivo, repo.coleccion)
+        filtro = {"_id": {"$in": ids}} if repo is contratos_repo else {"contrato_id": {"$in": ids}}
+        cambios = {"updated_at": ahora}
+        if repo is contratos_repo:
+            cambios["archivado"] = al_archivo
+        movidos[repo.nombre] += await _mover(origen, destino, filtro, cambios)
+
+    for repo in (pagos_repo, gastos_repo, contratos_repo):
+        ids_movidos = movidos[repo.nombre]
+        if not ids_movidos:
+            continue
+        # Para /api/sync lo archivado deja de existir y lo restaurado vuelve a aparecer
+        if al_archivo:
+            await repo.marcar_eliminados(ids_movidos)
+        else:
+            await repo.quitar_marcas_eliminados(ids_movidos)
+        await versiones.incrementar(repo.nombre)
+        bus_eventos.publicar_cambio(repo.nombre, "archivados" if al_archivo else "restaurados")
+    return {nombre: len(ids_movidos) for nombre, ids_movidos in movidos.items()}
+
+
+async def archivar_contratos(meses: int = None, ahora: datetime = None) -> dict:
+    """Pasa al archivo, por lotes, los contratos finalizados hace más de meses y sus pagos y gastos"""
+    ahora = ahora or datetime.now(timezone.utc)
+    limite = _restar_meses(ahora, ARCHIVO_MESES if meses is None else meses)
+    totales = {"contratos": 0, "pagos": 0, "gastos": 0}
+    while True:
+        lote = await contratos_repo.coleccion.find(
+            {"estado": "finalizado", "fecha_fin": {"$lt": limite}}, {"_id": 1}
+        ).limit(TAMANO_LOTE).to_list(None)
+        if not lote:
+            break
+        movidos = await _mover_contratos([c["_id"] for c in lote], al_archivo=True)
+        for nombre, cantidad in movidos.items():
+            totales[nombre] += cantidad
+        await asyncio.sleep(PAUSA_ENTRE_LOTES)
+    return {"limite": limite, **totales}
+
+
+async def restaurar_contrato(contrato_id: str) -> dict:
+    """Devuelve un contrato archivado (con sus pagos y gastos) a las colecciones activas"""
+    if await contratos_repo.archivo.find_one({"_id": contrato_id}, {"_id": 1}) is None:
+        raise HTTPException(status_code=404, detail="Contrato archivado no encontrado")
+    return await _mover_contratos([contrato_id], al_archivo=False)
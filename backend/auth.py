@@ -1,11 +1,14 @@
+from contextvars import ContextVar
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
 
+from sesiones import registro_sesiones
+
 # Configuración
 SECRET_KEY = os.environ.get("SECRET_KEY", "tu-clave-secreta-muy-segura-cambiar-en-produccion")
 ALGORITHM = "HS256"
@@ -13,6 +16,10 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 480  # 8 horas
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+security_opcional = HTTPBearer(auto_error=False)
+
+# Usuario ya autenticado por /api/batch: las subpeticiones no vuelven a decodificar el JWT
+usuario_lote: ContextVar[Optional[dict]] = ContextVar("usuario_lote", default=None)
 
 def verificar_contraseña(contraseña_plana: str, contraseña_hash: str) -> bool:
     """Verifica que la contraseña coincida con el hash"""
@@ -34,15 +41,24 @@ def crear_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 def decodificar_token(token: str):
-    """Decodifica y valida un token JWT"""
+    """Decodifica y valida un token JWT (None si es inválido, ha expirado, no tiene jti o su sesión está revocada)"""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload
     except JWTError:
         return None
+    # Los tokens sin jti (anteriores al registro de sesiones) no se pueden revocar: se rechazan
+    jti = payload.get("jti")
+    if not jti or registro_sesiones.revocada(jti):
+        return None
+    return payload
 
-async def obtener_usuario_actual(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def obtener_usuario_actual(credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional)):
     """Dependency para obtener el usuario actual desde el token"""
+    usuario = usuario_lote.get()
+    if usuario is not None:
+        return usuario
+    if credentials is None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authenticated")
     token = credentials.credentials
     payload = decodificar_token(token)
     if payload is None:
@@ -53,6 +69,23 @@ async def obtener_usuario_actual(credentials: HTTPAuthorizationCredentials = Dep
         )
     return payload
 
+async def obtener_usuario_cabecera_o_ticket(
+    ticket: Optional[str] = Query(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_opcional)
+):
+    """Como obtener_usuario_actual, pero acepta también ?ticket= de /api/eventos/ticket (EventSource no permite cabeceras)"""
+    if credentials:
+        payload = decodificar_token(credentials.credentials)
+    else:
+        payload = await registro_sesiones.canjear_ticket(ticket) if ticket else None
+    if payload is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Token inválido o expirado",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return payload
+
 def verificar_rol(roles_permitidos: list):
     """Decorator para verificar el rol del usuario"""
     async def verificador(usuario_actual: dict = Depends(obtener_usuario_actual)):
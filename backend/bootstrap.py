@@ -0,0 +1,63 @@
+import asyncio
+
+from fastapi import HTTPException
+
+import versiones
+from repositorios import pisos_repo, habitaciones_repo, inquilinos_repo, contratos_repo
+
+# Entidades de referencia del frontend: repositorio, filtro y campos que necesita la UI
+ENTIDADES = {
+    "pisos": (pisos_repo, {}, {"nombre": 1, "direccion": 1}),
+    "habitaciones": (habitaciones_repo, {}, {"piso_id": 1, "nombre": 1, "precio_base": 1}),
+    "inquilinos": (inquilinos_repo, {}, {"nombre": 1, "email": 1, "telefono": 1, "dni": 1, "activo": 1}),
+    # Solo los contratos vigentes o futuros: el histórico se consulta bajo demanda
+    "contratos": (contratos_repo, {"estado": {"$in": ["activo", "programado"]}, "archivado": {"$ne": True}}, {
+        "habitacion_id": 1, "inquilino_id": 1, "fecha_inicio": 1, "fecha_fin": 1,
+        "renta_mensual": 1, "dia_pago": 1, "estado": 1
+    }),
+}
+
+# nombre -> (versión, {id: documento})
+_cache = {}
+
+
+def _token(versiones_actuales: dict) -> str:
+    """Token con la versión de cada entidad, en el orden de ENTIDADES"""
+    return ".".join(str(versiones_actuales[nombre]) for nombre in ENTIDADES)
+
+
+def _leer_token(token: str) -> dict:
+    """Versiones de un token de bootstrap; 400 si no es válido"""
+    partes = token.split(".")
+    if len(partes) != len(ENTIDADES) or not all(p.isdigit() for p in partes):
+        raise HTTPException(status_code=400, detail="Token de versión no válido")
+    return dict(zip(ENTIDADES, (int(p) for p in partes)))
+
+
+async def _cargar(nombre: str, version: int) -> dict:
+    """Lee la entidad de Mongo (si la caché no tiene esa versión) indexada por id"""
+    en_cache = _cache.get(nombre)
+    if en_cache and en_cache[0] == version:
+        return en_cache[1]
+    repo, filtro, proyeccion = ENTIDADES[nombre]
+    documentos = await repo.listar(filtro, proyeccion, limite=None)
+    datos = {d.pop("_id"): d for d in documentos}
+    # La versión se leyó antes que los datos: como mucho se guardan datos más nuevos que la versión
+    _cache[nombre] = (version, datos)
+    return datos
+
+
+async def obtener_bootstrap(desde: str = None) -> dict:
+    """Datos de referencia indexados por id; con desde solo se incluyen las entidades que han cambiado"""
+    anteriores = _leer_token(desde) if desde else {}
+    guardadas = await versiones.obtener()
+    actuales = {nombre: guardadas.get(nombre, 0) for nombre in ENTIDADES}
+
+    cambiadas = [n for n in ENTIDADES if anteriores.get(n) != actuales[n]]
+    datos = await asyncio.gather(*(_cargar(n, actuales[n]) for n in cambiadas))
+
+    return {
+        "version": _token(actuales),
+        "completo": not desde,
+        **dict(zip(cambiadas, datos))
+    }
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+import metricas
+
+# Resultados guardados como máximo en la microcaché
+MAXIMO_CACHE = 256
+
+
+def clave_peticion(request, usuario: dict) -> tuple:
+    """Ruta, parámetros de la query normalizados (ordenados, sin vacíos) y rol del usuario"""
+    parametros = tuple(sorted((k, v) for k, v in request.query_params.multi_items() if v != ""))
+    return (request.url.path, parametros, usuario.get("rol"))
+
+
+class Coalescedor:
+    """Agrupa las peticiones idénticas simultáneas en un solo cálculo (single-flight).
+
+    La primera petición con una clave lanza el cálculo y las que llegan
+    mientras tanto esperan ese mismo resultado. Con ttl, el resultado se
+    sirve además desde memoria durante ttl segundos.
+    """
+
+    def __init__(self):
+        self._en_curso = {}  # clave -> tarea
+        self._cache = {}  # clave -> (caduca, resultado)
+
+    def _guardar(self, clave: tuple, resultado, ttl: float):
+        ahora = time.monotonic()
+        if len(self._cache) >= MAXIMO_CACHE:
+            self._cache = {c: v for c, v in self._cache.items() if v[0] > ahora}
+            if len(self._cache) >= MAXIMO_CACHE:
+                self._cache.clear()
+        self._cache[clave] = (ahora + ttl, resultado)
+
+    async def _calcular(self, clave: tuple, calcular, ttl: float):
+        try:
+            resultado = await calcular()
+            if ttl:
+                self._guardar(clave, resultado, ttl)
+            return resultado
+        finally:
+            self._en_curso.pop(clave, None)
+
+    async def ejecutar(self, nombre: str, clave: tuple, calcular, ttl: float = 0):
+        """Resultado de calcular() compartido con las peticiones simultáneas de la misma clave.
+
+        El resultado es el mismo objeto para todas: no se debe modificar.
+        """
+        if ttl:
+            en_cache = self._cache.get(clave)
+            if en_cache and en_cache[0] > time.monotonic():
+                metricas.incrementar(f"coalescencia.{nombre}.cache")
+                return en_cache[1]
+
+        tarea = self._en_curso.get(clave)
+        if tarea is None:
+            metricas.incrementar(f"coalescencia.{nombre}.calculos")
+            tarea = asyncio.ensure_future(self._calcular(clave, calcular, ttl))
+            # Recoge el error aunque todas las peticiones que esperaban se hayan cancelado
+            tarea.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._en_curso[clave] = tarea
+        else:
+            metricas.incrementar(f"coalescencia.{nombre}.compartidas")
+        # shield: cancelar una petición no cancela el cálculo del que dependen las demás
+        return await asyncio.shield(tarea)
+
+
+coalescedor = Coalescedor()
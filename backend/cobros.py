@@ -0,0 +1,146 @@
+import re
+from datetime import date, datetime, timezone
+
+from database import contratos_collection
+from tareas import fecha_vencimiento
+
+# mes_anio tal como se guarda en los pagos: la búsqueda es por igualdad de texto
+PATRON_MES = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+
+def mes_valido(mes_anio: str) -> bool:
+    """mes_anio en formato canónico YYYY-MM (no vale 2025-1)"""
+    return PATRON_MES.fullmatch(mes_anio) is not None
+
+
+def _limites_mes(mes_anio: str):
+    """Primer instante del mes y del mes siguiente"""
+    anio, mes = map(int, mes_anio.split("-"))
+    inicio = datetime(anio, mes, 1, tzinfo=timezone.utc)
+    siguiente = datetime(anio + mes // 12, mes % 12 + 1, 1, tzinfo=timezone.utc)
+    return inicio, siguiente
+
+
+def _pipeline_cobros(mes_anio: str, piso_id: str = None) -> list:
+    """Contratos activos con el pago de alquiler del mes sin crear o sin cobrar, agrupados por piso.
+
+    El $lookup hace de anti-join: los contratos sin pagos del mes quedan con
+    la lista vacía y se conservan junto a los que tienen el pago pendiente o
+    atrasado; los ya pagados o en revisión se descartan. Solo entran los
+    contratos cuya vigencia cubre algún día del mes.
+    """
+    inicio_mes, siguiente_mes = _limites_mes(mes_anio)
+    etapas = [
+        {"$match": {
+            "estado": "activo",
+            "archivado": {"$ne": True},
+            "fecha_inicio": {"$lt": siguiente_mes},
+            "fecha_fin": {"$gte": inicio_mes}
+        }},
+        {"$lookup": {
+            "from": "pagos",
+            "let": {"contrato_id": "$_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$contrato_id", "$$contrato_id"]},
+                    "tipo": "alquiler",
+                    "mes_anio": mes_anio
+                }},
+                {"$project": {"estado": 1, "importe": 1}}
+            ],
+            "as": "pagos"
+        }},
+        {"$match": {"$or": [
+            {"pagos": {"$size": 0}},
+            {"pagos.estado": {"$in": ["pendiente", "atrasado"]}}
+        ]}},
+        {"$lookup": {
+            "from": "habitaciones",
+            "let": {"habitacion_id": "$habitacion_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$habitacion_id"]}}},
+                {"$project": {"nombre": 1, "piso_id": 1}}
+            ],
+            "as": "habitacion"
+        }},
+        {"$unwind": "$habitacion"},
+    ]
+    if piso_id:
+        etapas.append({"$match": {"habitacion.piso_id": piso_id}})
+    etapas += [
+        {"$lookup": {
+            "from": "inquilinos",
+            "let": {"inquilino_id": "$inquilino_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$inquilino_id"]}}},
+                {"$project": {"nombre": 1, "telefono": 1}}
+            ],
+            "as": "inquilino"
+        }},
+        {"$project": {
+            "dia_pago": 1,
+            "renta_mensual": 1,
+            "habitacion": "$habitacion.nombre",
+            "piso_id": "$habitacion.piso_id",
+            "inquilino": {"$arrayElemAt": ["$inquilino", 0]},
+            "pago": {"$arrayElemAt": [
+                {"$filter": {"input": "$pagos", "cond": {"$in": ["$$this.estado", ["pendiente", "atrasado"]]}}}, 0
+            ]}
+        }},
+        {"$sort": {"habitacion": 1}},
+        {"$group": {"_id": "$piso_id", "cobros": {"$push": "$$ROOT"}}},
+        {"$lookup": {
+            "from": "pisos",
+            "let": {"piso_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$piso_id"]}}},
+                {"$project": {"nombre": 1, "direccion": 1}}
+            ],
+            "as": "piso"
+        }},
+        {"$sort": {"piso.nombre": 1}},
+    ]
+    return etapas
+
+
+def _cobro(doc: dict, mes_anio: str, hoy: date) -> dict:
+    """Fila compacta de la lista de cobros"""
+    pago = doc.get("pago")
+    inquilino = doc.get("inquilino") or {}
+    vencimiento = fecha_vencimiento(mes_anio, doc.get("dia_pago"))
+    return {
+        "contrato_id": doc["_id"],
+        "habitacion": doc.get("habitacion"),
+        "inquilino": inquilino.get("nombre"),
+        "telefono": inquilino.get("telefono"),
+        "importe": pago["importe"] if pago else doc.get("renta_mensual"),
+        "pago_id": pago["_id"] if pago else None,
+        "situacion": pago["estado"] if pago else "sin_pago",
+        "vencimiento": vencimiento,
+        "dias_retraso": max((hoy - vencimiento).days, 0) if vencimiento else 0
+    }
+
+
+async def lista_cobros(mes_anio: str, piso_id: str = None) -> dict:
+    """Lista de cobros del mes agrupada por piso (una sola agregación)"""
+    hoy = datetime.now(timezone.utc).date()
+    grupos = await contratos_collection.aggregate(_pipeline_cobros(mes_anio, piso_id)).to_list(None)
+
+    pisos = []
+    for grupo in grupos:
+        piso = grupo["piso"][0] if grupo.get("piso") else {}
+        cobros = [_cobro(doc, mes_anio, hoy) for doc in grupo["cobros"]]
+        pisos.append({
+            "piso_id": grupo["_id"],
+            "nombre": piso.get("nombre"),
+            "direccion": piso.get("direccion"),
+            "total_pendiente": round(sum(c["importe"] or 0 for c in cobros), 2),
+            "cobros": cobros
+        })
+    return {
+        "mes_anio": mes_anio,
+        "total_cobros": sum(len(p["cobros"]) for p in pisos),
+        "sin_pago": sum(1 for p in pisos for c in p["cobros"] if c["situacion"] == "sin_pago"),
+        "total_pendiente": round(sum(p["total_pendiente"] for p in pisos), 2),
+        "pisos": pisos
+    }
@@ -0,0 +1,66 @@
+import asyncio
+import os
+
+from database import ajustes_collection
+from vigilancia import vigilar
+
+# Cada cuántos segundos se comprueba la versión si no hay change streams (Mongo sin réplica)
+INTERVALO_SONDEO = int(os.environ.get("AJUSTES_INTERVALO_SONDEO", "5"))
+
+
+class CacheAjustes:
+    """Copia en memoria del documento único de ajustes.
+
+    Se carga al arrancar, se sustituye cuando actualizar_ajustes escribe y se
+    mantiene coherente entre workers con un change stream sobre ajustes o,
+    si el servidor no lo soporta, comprobando periódicamente el campo version.
+    """
+
+    def __init__(self):
+        self._ajustes = None
+        self._tarea = None
+
+    @property
+    def version(self) -> int:
+        """Versión de los ajustes en caché (-1 si aún no se han cargado)"""
+        return self._ajustes.get("version", 0) if self._ajustes else -1
+
+    def obtener(self):
+        """Devuelve los ajustes en caché (no modificar el diccionario devuelto)"""
+        return self._ajustes
+
+    def establecer(self, ajustes: dict):
+        """Sustituye la caché salvo que ya tenga una versión más reciente"""
+        if ajustes and ajustes.get("version", 0) >= self.version:
+            self._ajustes = ajustes
+
+    async def cargar(self):
+        """Lee los ajustes de Mongo (al arrancar o si cambia la versión)"""
+        self._ajustes = await ajustes_collection.find_one({})
+
+    async def _sondear(self):
+        """Recarga los ajustes cuando cambia su versión en Mongo"""
+        actual = await ajustes_collection.find_one({}, {"version": 1})
+        if actual and actual.get("version", 0) != self.version:
+            await self.cargar()
+
+    def iniciar(self):
+        """Empieza a seguir los cambios que hagan otros workers"""
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(vigilar(
+                "ajustes",
+                lambda: ajustes_collection.watch(full_document="updateLookup"),
+                lambda cambio: self.establecer(cambio.get("fullDocument")),
+                self._sondear,
+                INTERVALO_SONDEO
+            ))
+
+    async def detener(self):
+        """Deja de seguir los cambios"""
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+
+
+ajustes_cache = CacheAjustes()
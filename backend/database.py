@@ -1,4 +1,4 @@
-from motor.motor_asyncio import AsyncIOMotorClient
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
 import os
 from dotenv import load_dotenv
 from pathlib import Path
@@ -20,6 +20,61 @@ contratos_collection = db.contratos
 pagos_collection = db.pagos
 gastos_collection = db.gastos
 ajustes_collection = db.ajustes
+leases_collection = db.leases
+estado_tareas_collection = db.estado_tareas
+avisos_collection = db.avisos
+versiones_collection = db.versiones
+eliminados_collection = db.eliminados
+schema_migrations_collection = db.schema_migrations
+sesiones_collection = db.sesiones
+limites_login_collection = db.limites_login
+tickets_eventos_collection = db.tickets_eventos
+# Colecciones frías con los contratos finalizados archivados y sus pagos y gastos
+contratos_archivo_collection = db.contratos_archivo
+pagos_archivo_collection = db.pagos_archivo
+gastos_archivo_collection = db.gastos_archivo
+
+# Ficheros binarios (logos, imágenes), direccionados por su hash SHA-256
+_recursos_bucket = None
+
+def obtener_recursos_bucket():
+    """Bucket GridFS de recursos (se crea en el primer uso, dentro del event loop)"""
+    global _recursos_bucket
+    if _recursos_bucket is None:
+        _recursos_bucket = AsyncIOMotorGridFSBucket(db, bucket_name="recursos")
+    return _recursos_bucket
+
+async def crear_indices():
+    """Crea los índices que usan las consultas y procesos por lotes"""
+    await pagos_collection.create_index([("contrato_id", 1), ("tipo", 1)])
+    await pagos_collection.create_index([("estado", 1), ("mes_anio", 1)])
+    await pagos_collection.create_index([("contrato_id", 1), ("mes_anio", 1)])
+    await pagos_collection.create_index("fecha_creacion")
+    await pagos_collection.create_index("fecha_ultima_actualizacion")
+    await gastos_collection.create_index("contrato_id")
+    await contratos_collection.create_index("fecha_fin")
+    await contratos_collection.create_index([("estado", 1), ("fecha_inicio", 1)])
+    await contratos_collection.create_index([("estado", 1), ("fecha_fin", 1)])
+    await contratos_collection.create_index([("habitacion_id", 1), ("fecha_inicio", 1)])
+    await contratos_collection.create_index([("fecha_inicio", 1), ("fecha_fin", 1)])
+    await avisos_collection.create_index([("pago_id", 1), ("tipo", 1), ("canal", 1)], unique=True)
+    await avisos_collection.create_index([("canal", 1), ("estado", 1), ("proximo_intento", 1)])
+    await avisos_collection.create_index("lote", sparse=True)
+    for coleccion in (pisos_collection, habitaciones_collection, inquilinos_collection,
+                      contratos_collection, pagos_collection):
+        await coleccion.create_index("updated_at")
+    await eliminados_collection.create_index([("coleccion", 1), ("updated_at", 1)])
+    await sesiones_collection.create_index("expira", expireAfterSeconds=0)
+    await sesiones_collection.create_index([("usuario_id", 1), ("revocada", 1)])
+    await sesiones_collection.create_index([("revocada", 1), ("revocada_en", 1)])
+    await limites_login_collection.create_index("expira", expireAfterSeconds=0)
+    await tickets_eventos_collection.create_index("expira", expireAfterSeconds=0)
+    await contratos_archivo_collection.create_index("habitacion_id")
+    await contratos_archivo_collection.create_index("inquilino_id")
+    await pagos_archivo_collection.create_index("contrato_id")
+    await gastos_archivo_collection.create_index("contrato_id")
+    await db["recursos.files"].create_index("filename")
+    await db["recursos.files"].create_index("metadata.origen")
 
 async def cerrar_conexion():
     """Cierra la conexión a MongoDB"""
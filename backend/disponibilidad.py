@@ -0,0 +1,131 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from fechas import sin_zona
+from ocupacion import filtro_ocupan, fin_efectivo
+from repositorios import pisos_repo, habitaciones_repo, contratos_repo
+
+UN_DIA = timedelta(days=1)
+
+
+def ventanas_libres(ocupaciones: list, desde: datetime, hasta: datetime) -> list:
+    """Huecos de [desde, hasta) que no cubre ningún intervalo (inicio, fin).
+
+    Barrido en una sola pasada sobre los intervalos ordenados por inicio:
+    se avanza el cursor hasta el fin de cada ocupación y lo que queda entre
+    el cursor y el inicio de la siguiente es una ventana libre.
+    """
+    ventanas = []
+    cursor = desde
+    for inicio, fin in sorted(ocupaciones):
+        if inicio > cursor:
+            ventanas.append((cursor, min(inicio, hasta)))
+        cursor = max(cursor, fin)
+        if cursor >= hasta:
+            break
+    if cursor < hasta:
+        ventanas.append((cursor, hasta))
+    return ventanas
+
+
+async def calcular_disponibilidad(
+    desde: datetime,
+    hasta: datetime,
+    piso_id: str = None,
+    dias_minimos: int = 1,
+    calendario: bool = False
+) -> dict:
+    """Habitaciones con ventanas libres en el rango y, opcionalmente, su calendario de ocupación.
+
+    Todas las fechas son inclusivas, con la misma regla que al crear un
+    contrato: un contrato ocupa de fecha_inicio a fecha_fin, ambos días
+    incluidos, y una ventana libre se puede contratar tal cual.
+    """
+    desde, hasta = sin_zona(desde), sin_zona(hasta)
+    ahora = sin_zona(datetime.now(timezone.utc))
+
+    proyeccion_contratos = {
+        "habitacion_id": 1, "inquilino_id": 1, "fecha_inicio": 1, "fecha_fin": 1, "fecha_finalizacion": 1, "estado": 1
+    }
+    # Contratos que se solapan con el rango (índices habitacion_id/fecha_inicio y fecha_inicio/fecha_fin)
+    filtro_contratos = {
+        "fecha_inicio": {"$lte": hasta},
+        "fecha_fin": {"$gte": desde},
+        "archivado": {"$ne": True},
+        **filtro_ocupan(ahora)
+    }
+    proyeccion_habitaciones = {"piso_id": 1, "nombre": 1, "precio_base": 1}
+    if piso_id:
+        habitaciones, pisos = await asyncio.gather(
+            habitaciones_repo.listar({"piso_id": piso_id}, proyeccion_habitaciones, limite=None),
+            pisos_repo.listar({"_id": piso_id}, {"nombre": 1})
+        )
+        filtro_contratos["habitacion_id"] = {"$in": [h["_id"] for h in habitaciones]}
+        contratos = await contratos_repo.listar(filtro_contratos, proyeccion_contratos, limite=None)
+    else:
+        habitaciones, contratos, pisos = await asyncio.gather(
+            habitaciones_repo.listar({}, proyeccion_habitaciones, limite=None),
+            contratos_repo.listar(filtro_contratos, proyeccion_contratos, limite=None),
+            pisos_repo.listar({}, {"nombre": 1}, limite=None)
+        )
+    nombres_pisos = {p["_id"]: p["nombre"] for p in pisos}
+
+    contratos_por_habitacion = defaultdict(list)
+    for contrato in contratos:
+        # Los terminados antes de tiempo ocupan solo hasta su finalización
+        fin = fin_efectivo(contrato, ahora)
+        if fin is not None and fin >= desde:
+            contratos_por_habitacion[contrato["habitacion_id"]].append({**contrato, "fecha_fin": fin})
+
+    libres = []
+    calendario_habitaciones = []
+    for habitacion in sorted(habitaciones, key=lambda h: (nombres_pisos.get(h["piso_id"], ""), h["nombre"])):
+        propios = contratos_por_habitacion.get(habitacion["_id"], [])
+        # El barrido trabaja con intervalos semiabiertos: se suma un día a los finales inclusivos
+        ventanas = [
+            {"desde": inicio, "hasta": fin - UN_DIA, "dias": (fin - inicio).days}
+            for inicio, fin in ventanas_libres(
+                [(c["fecha_inicio"], c["fecha_fin"] + UN_DIA) for c in propios], desde, hasta + UN_DIA
+            )
+            if (fin - inicio).days >= dias_minimos
+        ]
+        datos_habitacion = {
+            "habitacion_id": habitacion["_id"],
+            "nombre": habitacion["nombre"],
+            "piso_id": habitacion["piso_id"],
+            "piso_nombre": nombres_pisos.get(habitacion["piso_id"]),
+            "precio_base": habitacion["precio_base"],
+        }
+        if ventanas:
+            libres.append({
+                **datos_habitacion,
+                "libre_todo_el_periodo": not propios,
+                "ventanas": ventanas
+            })
+        if calendario:
+            calendario_habitaciones.append({
+                **datos_habitacion,
+                "ocupaciones": [
+                    {
+                        "contrato_id": c["_id"],
+                        "inquilino_id": c["inquilino_id"],
+                        "desde": max(c["fecha_inicio"], desde),
+                        "hasta": min(c["fecha_fin"], hasta),
+                        "estado": c["estado"]
+                    }
+                    for c in sorted(propios, key=lambda c: c["fecha_inicio"])
+                ],
+                "ventanas_libres": ventanas
+            })
+
+    resultado = {
+        "desde": desde,
+        "hasta": hasta,
+        "total_habitaciones": len(habitaciones),
+        "habitaciones_libres": len(libres),
+        "libres": libres
+    }
+    if calendario:
+        resultado["calendario"] = calendario_habitaciones
+    return resultado
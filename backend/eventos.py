@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+
+from coalescencia import coalescedor
+from database import db
+from vigilancia import vigilar
+
+logger = logging.getLogger(__name__)
+
+# Colecciones cuyos cambios se publican como eventos
+COLECCIONES_EVENTOS = ("pagos", "contratos", "habitaciones")
+# Tipo de operación del change stream -> acción del evento
+ACCIONES_STREAM = {"insert": "creado", "update": "actualizado", "replace": "actualizado", "delete": "eliminado"}
+# Eventos pendientes por suscriptor; si un cliente lento la llena se descartan los más antiguos
+TAMANO_COLA = 100
+# Segundos que se agrupan los cambios antes de recalcular el dashboard
+ESPERA_DASHBOARD = float(os.environ.get("EVENTOS_ESPERA_DASHBOARD", "1"))
+
+
+class BusEventos:
+    """Pub/sub en memoria del proceso.
+
+    Los handlers de escritura publican eventos pequeños y cada conexión SSE
+    tiene su propia cola. Con EVENTOS_CHANGE_STREAMS=1 los eventos de datos
+    llegan del change stream de Mongo (y así se ven los de otros workers)
+    en lugar de publicarse desde el propio proceso.
+    """
+
+    def __init__(self):
+        self._suscriptores = set()
+        self._tarea_vigilancia = None
+        self.usa_change_stream = False
+
+    @property
+    def suscriptores(self) -> int:
+        return len(self._suscriptores)
+
+    def suscribir(self) -> asyncio.Queue:
+        """Crea la cola de un nuevo suscriptor"""
+        cola = asyncio.Queue(maxsize=TAMANO_COLA)
+        self._suscriptores.add(cola)
+        return cola
+
+    def cancelar(self, cola: asyncio.Queue):
+        """Elimina la cola de un suscriptor"""
+        self._suscriptores.discard(cola)
+
+    def publicar(self, evento: dict):
+        """Entrega el evento a todos los suscriptores sin bloquear"""
+        for cola in self._suscriptores:
+            if cola.full():
+                cola.get_nowait()
+            cola.put_nowait(evento)
+
+    def publicar_cambio(self, coleccion: str, accion: str, id: str = None):
+        """Publica el cambio de un documento (salvo si los cambios llegan por change stream)"""
+        if coleccion in COLECCIONES_EVENTOS and not self.usa_change_stream:
+            self.publicar({"tipo": coleccion, "accion": accion, "id": id})
+
+    def _publicar_del_stream(self, cambio: dict):
+        accion = ACCIONES_STREAM.get(cambio["operationType"])
+        if accion:
+            self.publicar({"tipo": cambio["ns"]["coll"], "accion": accion, "id": cambio.get("documentKey", {}).get("_id")})
+
+    def _conectado(self):
+        self.usa_change_stream = True
+
+    async def _vigilar(self):
+        """Publica los cambios que llegan del change stream de la base de datos.
+
+        Sin change streams (servidor standalone) se publica desde los handlers.
+        """
+        pipeline = [{"$match": {"ns.coll": {"$in": list(COLECCIONES_EVENTOS)}}}]
+        try:
+            await vigilar("eventos", lambda: db.watch(pipeline), self._publicar_del_stream, al_conectar=self._conectado)
+        finally:
+            self.usa_change_stream = False
+
+    def iniciar(self):
+        """Empieza a seguir el change stream si está activado"""
+        if os.environ.get("EVENTOS_CHANGE_STREAMS", "0") == "1" and self._tarea_vigilancia is None:
+            self._tarea_vigilancia = asyncio.create_task(self._vigilar())
+
+    async def detener(self):
+        """Deja de seguir el change stream"""
+        if self._tarea_vigilancia is not None:
+            self._tarea_vigilancia.cancel()
+            await asyncio.gather(self._tarea_vigilancia, return_exceptions=True)
+            self._tarea_vigilancia = None
+
+
+def _segundos_hasta_manana() -> float:
+    ahora = datetime.now(timezone.utc)
+    manana = (ahora + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (manana - ahora).total_seconds()
+
+
+class DifusorDashboard:
+    """Recalcula las estadísticas del dashboard una vez por ráfaga de cambios y las publica.
+
+    Hay un solo cálculo por proceso aunque haya muchas conexiones abiertas.
+    Las estadísticas dependen del día (mes actual, próximos vencimientos),
+    así que también se recalculan al cambiar de día.
+    """
+
+    def __init__(self, bus: BusEventos, calcular):
+        self.bus = bus
+        self.calcular = calcular
+        self.ultimas = None
+        self._dia = None
+        self._tarea = None
+
+    async def _recalcular(self) -> dict:
+        dia = datetime.now(timezone.utc).date()
+        estadisticas = await self.calcular()
+        self.ultimas, self._dia = estadisticas, dia
+        return estadisticas
+
+    async def _bucle(self):
+        cola = self.bus.suscribir()
+        try:
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=_segundos_hasta_manana())
+                except asyncio.TimeoutError:
+                    evento = {"tipo": "dia"}
+                if evento["tipo"] == "dashboard":
+                    continue
+                # Agrupar los cambios que lleguen mientras tanto
+                await asyncio.sleep(ESPERA_DASHBOARD)
+                while not cola.empty():
+                    cola.get_nowait()
+                if self.bus.suscriptores <= 1:
+                    # Nadie escucha: se recalculará cuando alguien se conecte
+                    self.ultimas = None
+                    continue
+                anteriores = self.ultimas
+                try:
+                    estadisticas = await self._recalcular()
+                except Exception:
+                    logger.exception("Error recalculando las estadísticas del dashboard")
+                    continue
+                if estadisticas != anteriores:
+                    self.bus.publicar({"tipo": "dashboard", "accion": "actualizado", "datos": estadisticas})
+        finally:
+            self.bus.cancelar(cola)
+
+    async def actuales(self) -> dict:
+        """Últimas estadísticas publicadas (las calcula si aún no hay o son de otro día).
+
+        Las conexiones que llegan a la vez esperan el mismo cálculo.
+        """
+        if self.ultimas is not None and self._dia == datetime.now(timezone.utc).date():
+            return self.ultimas
+        return await coalescedor.ejecutar("dashboard_sse", ("dashboard_sse",), self._recalcular)
+
+    def iniciar(self):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            await asyncio.gather(self._tarea, return_exceptions=True)
+            self._tarea = None
+
+
+def formatear_sse(evento: dict) -> str:
+    """Serializa un evento en formato text/event-stream"""
+    return f"event: {evento['tipo']}\ndata: {json.dumps(evento, default=str)}\n\n"
+
+
+bus_eventos = BusEventos()
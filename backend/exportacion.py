@@ -0,0 +1,188 @@
+import asyncio
+import csv
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from database import contratos_collection, pagos_collection, contratos_archivo_collection, pagos_archivo_collection
+from repositorios import (
+    usuarios_repo, pisos_repo, habitaciones_repo, inquilinos_repo, contratos_repo
+)
+
+# Número de documentos que se leen del cursor y se resuelven de una vez
+TAMANO_LOTE = 500
+
+COLUMNAS_PAGOS = [
+    "id", "mes_anio", "tipo", "estado", "importe", "metodo", "fecha_pago",
+    "fecha_creacion", "contrato_id", "piso", "habitacion", "inquilino", "dni",
+    "creado_por", "revisado_por", "notas"
+]
+
+COLUMNAS_MOROSIDAD = [
+    "inquilino_id", "inquilino", "dni", "pisos", "meses_pendientes",
+    "0-30", "31-60", "61-90", "90+", "total"
+]
+
+COLUMNAS_CONTRATOS = [
+    "id", "piso", "habitacion", "inquilino", "dni", "fecha_inicio", "fecha_fin",
+    "renta_mensual", "fianza", "gastos_mensuales_tarifa", "tiene_limpieza",
+    "importe_limpieza_mensual", "dia_pago", "estado", "archivado",
+    "liquidacion_fianza", "importe_a_devolver"
+]
+
+
+def _valor(v):
+    """Normaliza un valor para CSV/XLSX"""
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.isoformat()
+    return v
+
+
+async def _lotes(cursor):
+    """Agrupa un cursor de Motor en listas de como mucho TAMANO_LOTE documentos"""
+    lote = []
+    async for doc in cursor:
+        lote.append(doc)
+        if len(lote) >= TAMANO_LOTE:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+async def _lotes_con_archivo(coleccion, archivo, filtro: dict):
+    """Lotes de la colección activa y después los de su archivo (la exportación es el histórico completo)"""
+    for origen in (coleccion, archivo):
+        async for lote in _lotes(origen.find(filtro).sort("_id", 1).batch_size(TAMANO_LOTE)):
+            yield lote
+
+
+async def _contexto_contratos(contratos):
+    """Resuelve habitación, piso e inquilino de un lote de contratos"""
+    habitaciones = await habitaciones_repo.obtener_muchos(
+        [c.get("habitacion_id") for c in contratos], {"nombre": 1, "piso_id": 1}
+    )
+    pisos, inquilinos = await asyncio.gather(
+        pisos_repo.obtener_muchos([h.get("piso_id") for h in habitaciones.values()], {"nombre": 1}),
+        inquilinos_repo.obtener_muchos([c.get("inquilino_id") for c in contratos], {"nombre": 1, "dni": 1}),
+    )
+
+    contexto = {}
+    for c in contratos:
+        habitacion = habitaciones.get(c.get("habitacion_id"), {})
+        piso = pisos.get(habitacion.get("piso_id"), {})
+        inquilino = inquilinos.get(c.get("inquilino_id"), {})
+        contexto[c["_id"]] = {
+            "piso": piso.get("nombre"),
+            "habitacion": habitacion.get("nombre"),
+            "inquilino": inquilino.get("nombre"),
+            "dni": inquilino.get("dni"),
+        }
+    return contexto
+
+
+async def filas_pagos(filtro: dict):
+    """Genera lotes de filas de pagos con los nombres relacionados ya resueltos"""
+    async for lote in _lotes_con_archivo(pagos_collection, pagos_archivo_collection, filtro):
+        contratos = await contratos_repo.obtener_muchos(
+            [p.get("contrato_id") for p in lote], {"habitacion_id": 1, "inquilino_id": 1}, incluir_archivo=True
+        )
+        contexto, usuarios = await asyncio.gather(
+            _contexto_contratos(list(contratos.values())),
+            usuarios_repo.obtener_muchos(
+                [p.get("creado_por_usuario_id") for p in lote] + [p.get("revisado_por_usuario_id") for p in lote],
+                {"nombre": 1}
+            ),
+        )
+
+        filas = []
+        for p in lote:
+            ctx = contexto.get(p.get("contrato_id"), {})
+            creador = usuarios.get(p.get("creado_por_usuario_id"), {})
+            revisor = usuarios.get(p.get("revisado_por_usuario_id"), {})
+            filas.append([_valor(v) for v in (
+                p["_id"], p.get("mes_anio"), p.get("tipo"), p.get("estado"), p.get("importe"),
+                p.get("metodo"), p.get("fecha_pago"), p.get("fecha_creacion"), p.get("contrato_id"),
+                ctx.get("piso"), ctx.get("habitacion"), ctx.get("inquilino"), ctx.get("dni"),
+                creador.get("nombre"), revisor.get("nombre"), p.get("notas"),
+            )])
+        yield filas
+
+
+async def filas_contratos(filtro: dict):
+    """Genera lotes de filas de contratos con los nombres relacionados ya resueltos"""
+    async for lote in _lotes_con_archivo(contratos_collection, contratos_archivo_collection, filtro):
+        contexto = await _contexto_contratos(lote)
+
+        filas = []
+        for c in lote:
+            ctx = contexto[c["_id"]]
+            liquidacion = c.get("resultado_liquidacion_fianza") or {}
+            filas.append([_valor(v) for v in (
+                c["_id"], ctx["piso"], ctx["habitacion"], ctx["inquilino"], ctx["dni"],
+                c.get("fecha_inicio"), c.get("fecha_fin"), c.get("renta_mensual"), c.get("fianza"),
+                c.get("gastos_mensuales_tarifa"), c.get("tiene_limpieza"), c.get("importe_limpieza_mensual"),
+                c.get("dia_pago"), c.get("estado"), c.get("archivado"),
+                liquidacion.get("estado"), liquidacion.get("importe_a_devolver"),
+            )])
+        yield filas
+
+
+async def filas_morosidad(informe: dict):
+    """Filas de exportación del informe de morosidad (un solo lote: ya está calculado)"""
+    yield [
+        [
+            i["inquilino_id"], _valor(i["nombre"]), _valor(i["dni"]), ", ".join(p for p in i["pisos"] if p),
+            i["meses_pendientes"], i["0-30"], i["31-60"], i["61-90"], i["90+"], i["total"]
+        ]
+        for i in informe["inquilinos"]
+    ]
+
+
+async def stream_csv(columnas: list, lotes):
+    """Convierte lotes de filas en trozos CSV codificados en UTF-8 (con BOM para Excel)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("\ufeff")
+    writer.writerow(columnas)
+    async for filas in lotes:
+        writer.writerows(filas)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate(0)
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _anadir_filas(hoja, filas):
+    """Añade un lote de filas a la hoja (se ejecuta en un hilo de trabajo)"""
+    for fila in filas:
+        hoja.append(fila)
+
+
+async def generar_xlsx(columnas: list, lotes, titulo: str) -> str:
+    """Escribe los lotes en un XLSX temporal desde un hilo de trabajo y devuelve su ruta.
+
+    Se usa el modo write_only de openpyxl, que vuelca las filas a disco a medida
+    que se añaden, de modo que la memoria no depende del número de filas.
+    """
+    from openpyxl import Workbook
+
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet(title=titulo)
+    await asyncio.to_thread(hoja.append, columnas)
+
+    async for filas in lotes:
+        await asyncio.to_thread(_anadir_filas, hoja, filas)
+
+    descriptor, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(descriptor)
+    try:
+        await asyncio.to_thread(libro.save, ruta)
+    except Exception:
+        os.unlink(ruta)
+        raise
+    return ruta
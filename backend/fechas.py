@@ -0,0 +1,8 @@
+from datetime import datetime, timezone
+
+
+def sin_zona(fecha: datetime) -> datetime:
+    """Pasa la fecha a UTC sin zona horaria, como las devuelve Mongo"""
+    if fecha.tzinfo is not None:
+        fecha = fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+import versiones
+from database import contratos_collection
+
+TAMANO_LOTE = 500
+
+
+def _pipeline_liquidacion(filtro: dict) -> list:
+    """Pipeline que junta, por contrato, los gastos descontables y los pagos de fianza"""
+    return [
+        {"$match": filtro},
+        {"$lookup": {
+            "from": "gastos",
+            "let": {"contrato_id": "$_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$contrato_id", "$$contrato_id"]}, "descontar_fianza": True}},
+                {"$group": {"_id": None, "total": {"$sum": "$importe"}}}
+            ],
+            "as": "descuentos"
+        }},
+        {"$lookup": {
+            "from": "pagos",
+            "let": {"contrato_id": "$_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$contrato_id", "$$contrato_id"]},
+                    "tipo": {"$in": ["fianza_cobrada", "fianza_devuelta"]},
+                    "estado": "pagado"
+                }},
+                {"$group": {"_id": "$tipo", "total": {"$sum": "$importe"}}}
+            ],
+            "as": "movimientos_fianza"
+        }},
+        {"$project": {
+            "fianza": 1,
+            "fecha_fin": 1,
+            "estado": 1,
+            "descuentos": {"$ifNull": [{"$arrayElemAt": ["$descuentos.total", 0]}, 0]},
+            "movimientos_fianza": 1
+        }}
+    ]
+
+
+def calcular_liquidacion(doc: dict) -> dict:
+    """Calcula el importe a devolver a partir de una fila del pipeline.
+
+    La base es lo cobrado como fianza_cobrada; si no hay pagos de fianza
+    registrados se usa la fianza pactada en el contrato.
+    """
+    movimientos = {m["_id"]: m["total"] for m in doc.get("movimientos_fianza", [])}
+    cobrada = movimientos.get("fianza_cobrada", 0)
+    devuelta = movimientos.get("fianza_devuelta", 0)
+    base = cobrada if cobrada > 0 else doc.get("fianza", 0)
+    descuentos = doc.get("descuentos", 0)
+
+    importe_a_devolver = round(max(base - descuentos, 0), 2)
+    if devuelta <= 0:
+        estado = "calculada"
+    elif devuelta >= importe_a_devolver:
+        estado = "devuelta_total"
+    else:
+        estado = "devuelta_parcial"
+
+    return {
+        "contrato_id": doc["_id"],
+        "fecha_fin": doc.get("fecha_fin"),
+        "fianza_base": round(base, 2),
+        "descuentos": round(descuentos, 2),
+        "fianza_devuelta": round(devuelta, 2),
+        "importe_a_devolver": importe_a_devolver,
+        "pendiente_de_devolver": round(max(importe_a_devolver - devuelta, 0), 2),
+        "estado": estado
+    }
+
+
+async def liquidar_fianzas(filtro: dict, dry_run: bool = False) -> dict:
+    """Liquida las fianzas de los contratos que cumplen el filtro.
+
+    Con dry_run solo se devuelve la previsualización; si no, se escribe
+    resultado_liquidacion_fianza con bulk_write en lotes.
+    """
+    fecha_liquidacion = datetime.now(timezone.utc)
+    liquidaciones = []
+    operaciones = []
+    actualizados = 0
+
+    async for doc in contratos_collection.aggregate(_pipeline_liquidacion(filtro)):
+        liquidacion = calcular_liquidacion(doc)
+        liquidaciones.append(liquidacion)
+        if dry_run:
+            continue
+
+        operaciones.append(UpdateOne(
+            {"_id": doc["_id"]},
+            {"$set": {"resultado_liquidacion_fianza": {
+                "estado": liquidacion["estado"],
+                "importe_a_devolver": liquidacion["importe_a_devolver"],
+                "fecha_liquidacion": fecha_liquidacion
+            }, "updated_at": fecha_liquidacion}}
+        ))
+        if len(operaciones) >= TAMANO_LOTE:
+            resultado = await contratos_collection.bulk_write(operaciones, ordered=False)
+            actualizados += resultado.modified_count
+            operaciones = []
+
+    if operaciones:
+        resultado = await contratos_collection.bulk_write(operaciones, ordered=False)
+        actualizados += resultado.modified_count
+
+    if actualizados:
+        await versiones.incrementar("contratos")
+
+    return {
+        "dry_run": dry_run,
+        "total": len(liquidaciones),
+        "actualizados": actualizados,
+        "liquidaciones": liquidaciones
+    }
@@ -0,0 +1,314 @@
+import asyncio
+import codecs
+import csv
+from datetime import datetime, timezone
+from itertools import islice
+
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from fechas import sin_zona
+from models import PisoCreate, HabitacionCreate, InquilinoCreate, ContratoCreate
+from repositorios import pisos_repo, habitaciones_repo, inquilinos_repo, contratos_repo
+from tareas import notificar_cambio_ocupacion
+
+# Filas que se validan y escriben de una vez
+TAMANO_TROZO = 500
+# A partir de aquí se dejan de acumular errores (se siguen contando)
+MAXIMO_ERRORES = 500
+
+
+def _abrir_csv(fichero):
+    """Lector de filas del CSV; admite coma o punto y coma y el BOM de Excel"""
+    muestra = fichero.read(4096).decode("utf-8-sig", errors="ignore")
+    fichero.seek(0)
+    try:
+        dialecto = csv.Sniffer().sniff(muestra, delimiters=",;")
+    except csv.Error:
+        dialecto = csv.excel
+    return csv.DictReader(codecs.getreader("utf-8-sig")(fichero, errors="replace"), dialect=dialecto)
+
+
+def _limpiar(fila: dict) -> dict:
+    """Quita espacios y columnas vacías para que se apliquen los valores por defecto"""
+    return {
+        clave.strip(): valor.strip()
+        for clave, valor in fila.items()
+        if clave and isinstance(valor, str) and valor.strip()
+    }
+
+
+def _errores_validacion(error: ValidationError) -> list:
+    return [f"{'.'.join(str(p) for p in e['loc']) or 'fila'}: {e['msg']}" for e in error.errors()]
+
+
+def _mensaje_escritura(error: dict) -> str:
+    """Mensaje de un writeError de Mongo al insertar una fila"""
+    if error.get("code") == 11000:
+        return "Ya existe un registro con esos datos (clave duplicada)"
+    return f"Error al guardar la fila: {error.get('errmsg', 'desconocido')}"
+
+
+def _filas_numeradas(lector):
+    """(línea, fila) con la línea del fichero donde empieza cada fila.
+
+    Un campo entre comillas puede ocupar varias líneas, así que la línea se
+    toma de line_num del lector y no contando filas.
+    """
+    lector.fieldnames  # lee la cabecera
+    inicio = lector.line_num + 1
+    for fila in lector:
+        yield inicio, fila
+        inicio = lector.line_num + 1
+
+
+class Importacion:
+    """Estado de una importación: referencias ya resueltas y filas aceptadas del propio fichero"""
+
+    def __init__(self, entidad: str, dry_run: bool):
+        self.entidad = entidad
+        self.dry_run = dry_run
+        self.total_filas = 0
+        self.validas = 0
+        self.insertadas = 0
+        self.total_errores = 0
+        self.errores = []
+        # DNIs aceptados en filas anteriores del fichero
+        self.dnis = set()
+        # Ocupaciones (inicio, fin) por habitación: existentes y del fichero
+        self.ocupaciones = {}
+        self.habitaciones_ocupacion = set()
+
+    def error(self, numero_fila: int, mensajes: list):
+        self.total_errores += 1
+        if len(self.errores) < MAXIMO_ERRORES:
+            self.errores.append({"fila": numero_fila, "errores": mensajes})
+
+    # ---- Referencias (una consulta $in por trozo) ----
+
+    async def _ids_existentes(self, repo, ids: set) -> set:
+        if not ids:
+            return set()
+        documentos = await repo.coleccion.find({"_id": {"$in": list(ids)}}, {"_id": 1}).to_list(None)
+        return {d["_id"] for d in documentos}
+
+    async def _pisos_por_nombre(self, nombres: set) -> dict:
+        """nombre -> id, o None si el nombre es ambiguo"""
+        if not nombres:
+            return {}
+        resultado = {}
+        for piso in await pisos_repo.coleccion.find({"nombre": {"$in": list(nombres)}}, {"nombre": 1}).to_list(None):
+            resultado[piso["nombre"]] = None if piso["nombre"] in resultado else piso["_id"]
+        return resultado
+
+    # ---- Validación por entidad ----
+
+    async def _pisos(self, filas: list) -> list:
+        documentos = []
+        for numero, fila in filas:
+            try:
+                documentos.append((numero, PisoCreate(**fila).model_dump()))
+            except ValidationError as e:
+                self.error(numero, _errores_validacion(e))
+        return documentos
+
+    async def _habitaciones(self, filas: list) -> list:
+        pisos_nombre = await self._pisos_por_nombre({f["piso"] for _, f in filas if "piso" in f and "piso_id" not in f})
+        pisos_ids = await self._ids_existentes(pisos_repo, {f["piso_id"] for _, f in filas if "piso_id" in f})
+        documentos = []
+        for numero, fila in filas:
+            if "piso_id" not in fila and "piso" in fila:
+                piso_id = pisos_nombre.get(fila["piso"])
+                if piso_id is None:
+                    self.error(numero, [f"piso: {'nombre ambiguo' if fila['piso'] in pisos_nombre else 'no encontrado'} ({fila['piso']})"])
+                    continue
+                fila["piso_id"] = piso_id
+            elif "piso_id" in fila and fila["piso_id"] not in pisos_ids:
+                self.error(numero, ["piso_id: Piso no encontrado"])
+                continue
+            try:
+                documentos.append((numero, HabitacionCreate(**{k: v for k, v in fila.items() if k != "piso"}).model_dump()))
+            except ValidationError as e:
+                self.error(numero, _errores_validacion(e))
+        return documentos
+
+    async def _inquilinos(self, filas: list) -> list:
+        existentes = await self._inquilinos_por_dni({f["dni"] for _, f in filas if "dni" in f})
+        documentos = []
+        for numero, fila in filas:
+            try:
+                inquilino = InquilinoCreate(**fila)
+            except ValidationError as e:
+                self.error(numero, _errores_validacion(e))
+                continue
+            if inquilino.dni in existentes:
+                self.error(numero, ["dni: Ya existe un inquilino con ese DNI"])
+            elif inquilino.dni in self.dnis:
+                self.error(numero, ["dni: DNI repetido en el fichero"])
+            else:
+                self.dnis.add(inquilino.dni)
+                documentos.append((numero, inquilino.model_dump()))
+        return documentos
+
+    async def _inquilinos_por_dni(self, dnis: set) -> dict:
+        if not dnis:
+            return {}
+        documentos = await inquilinos_repo.coleccion.find({"dni": {"$in": list(dnis)}}, {"dni": 1}).to_list(None)
+        return {d["dni"]: d["_id"] for d in documentos}
+
+    async def _resolver_habitaciones(self, filas: list) -> dict:
+        """(piso, habitación) por nombre -> id de habitación, o None si es ambiguo"""
+        pares = {(f["piso"], f["habitacion"]) for _, f in filas
+                 if "habitacion_id" not in f and "piso" in f and "habitacion" in f}
+        if not pares:
+            return {}
+        pisos_nombre = await self._pisos_por_nombre({p for p, _ in pares})
+        pisos_validos = {i: n for n, i in pisos_nombre.items() if i}
+        habitaciones = await habitaciones_repo.coleccion.find(
+            {"piso_id": {"$in": list(pisos_validos)}, "nombre": {"$in": list({h for _, h in pares})}},
+            {"piso_id": 1, "nombre": 1}
+        ).to_list(None)
+        resultado = {}
+        for h in habitaciones:
+            clave = (pisos_validos[h["piso_id"]], h["nombre"])
+            resultado[clave] = None if clave in resultado else h["_id"]
+        return resultado
+
+    async def _cargar_ocupaciones(self, habitacion_ids: set):
+        """Contratos activos o programados de las habitaciones aún no cargadas"""
+        nuevas = habitacion_ids - self.habitaciones_ocupacion
+        if not nuevas:
+            return
+        self.habitaciones_ocupacion |= nuevas
+        contratos = await contratos_repo.coleccion.find(
+            {"habitacion_id": {"$in": list(nuevas)}, "estado": {"$in": ["activo", "programado"]}, "archivado": {"$ne": True}},
+            {"habitacion_id": 1, "fecha_inicio": 1, "fecha_fin": 1}
+        ).to_list(None)
+        for c in contratos:
+            self.ocupaciones.setdefault(c["habitacion_id"], []).append((c["fecha_inicio"], c["fecha_fin"]))
+
+    async def _contratos(self, filas: list) -> list:
+        habitaciones_nombre, habitaciones_ids, inquilinos_dni, inquilinos_ids = await asyncio.gather(
+            self._resolver_habitaciones(filas),
+            self._ids_existentes(habitaciones_repo, {f["habitacion_id"] for _, f in filas if "habitacion_id" in f}),
+            self._inquilinos_por_dni({f["dni"] for _, f in filas if "dni" in f and "inquilino_id" not in f}),
+            self._ids_existentes(inquilinos_repo, {f["inquilino_id"] for _, f in filas if "inquilino_id" in f})
+        )
+
+        validados = []
+        for numero, fila in filas:
+            mensajes = []
+            if "habitacion_id" in fila:
+                if fila["habitacion_id"] not in habitaciones_ids:
+                    mensajes.append("habitacion_id: Habitación no encontrada")
+            elif "piso" in fila and "habitacion" in fila:
+                clave = (fila["piso"], fila["habitacion"])
+                if habitaciones_nombre.get(clave):
+                    fila["habitacion_id"] = habitaciones_nombre[clave]
+                else:
+                    mensajes.append(f"habitacion: {'nombre ambiguo' if clave in habitaciones_nombre else 'no encontrada'} ({fila['piso']} / {fila['habitacion']})")
+            if "inquilino_id" in fila:
+                if fila["inquilino_id"] not in inquilinos_ids:
+                    mensajes.append("inquilino_id: Inquilino no encontrado")
+            elif "dni" in fila:
+                if fila["dni"] in inquilinos_dni:
+                    fila["inquilino_id"] = inquilinos_dni[fila["dni"]]
+                else:
+                    mensajes.append(f"dni: Inquilino no encontrado ({fila['dni']})")
+            if mensajes:
+                self.error(numero, mensajes)
+                continue
+            try:
+                contrato = ContratoCreate(**{k: v for k, v in fila.items() if k not in ("piso", "habitacion", "dni")})
+            except ValidationError as e:
+                self.error(numero, _errores_validacion(e))
+                continue
+            if contrato.fecha_inicio >= contrato.fecha_fin:
+                self.error(numero, ["La fecha de inicio debe ser anterior a la fecha fin"])
+            elif not 1 <= contrato.dia_pago <= 31:
+                self.error(numero, ["El día de pago debe estar entre 1 y 31"])
+            else:
+                validados.append((numero, contrato.model_dump()))
+
+        # Solapamientos en memoria: contratos existentes y filas ya aceptadas del fichero
+        await self._cargar_ocupaciones({c["habitacion_id"] for _, c in validados})
+        ahora = datetime.now(timezone.utc)
+        documentos = []
+        for numero, contrato in validados:
+            inicio, fin = sin_zona(contrato["fecha_inicio"]), sin_zona(contrato["fecha_fin"])
+            ocupaciones = self.ocupaciones.setdefault(contrato["habitacion_id"], [])
+            if any(inicio <= f and fin >= i for i, f in ocupaciones):
+                self.error(numero, ["Ya existe un contrato en esa habitación que se solapa con esas fechas"])
+                continue
+            ocupaciones.append((inicio, fin))
+            if contrato["fecha_inicio"].replace(tzinfo=timezone.utc) > ahora:
+                contrato["estado"] = "programado"
+            contrato["resultado_liquidacion_fianza"] = {
+                "estado": "pendiente",
+                "importe_a_devolver": None,
+                "fecha_liquidacion": None
+            }
+            documentos.append((numero, contrato))
+        return documentos
+
+    # ---- Escritura ----
+
+    async def procesar_trozo(self, filas: list):
+        """Valida un trozo de filas y, si no es simulación, inserta las válidas con un solo insert_many"""
+        self.total_filas += len(filas)
+        validar, repo = {
+            "pisos": (self._pisos, pisos_repo),
+            "habitaciones": (self._habitaciones, habitaciones_repo),
+            "inquilinos": (self._inquilinos, inquilinos_repo),
+            "contratos": (self._contratos, contratos_repo),
+        }[self.entidad]
+        validados = await validar(filas)
+        self.validas += len(validados)
+        if self.dry_run or not validados:
+            return
+        documentos = [documento for _, documento in validados]
+        for documento in documentos:
+            documento["_id"] = str(ObjectId())
+        try:
+            await repo.insertar_muchos(documentos)
+        except BulkWriteError as e:
+            # insert_many no ordenado: se insertan todas las filas salvo las de writeErrors
+            fallidos = set()
+            for error in e.details.get("writeErrors", []):
+                fallidos.add(error["index"])
+                self.error(validados[error["index"]][0], [_mensaje_escritura(error)])
+            documentos = [d for i, d in enumerate(documentos) if i not in fallidos]
+            self.validas -= len(fallidos)
+        self.insertadas += len(documentos)
+        if self.entidad == "contratos" and documentos:
+            notificar_cambio_ocupacion(list({d["habitacion_id"] for d in documentos}))
+
+    def resumen(self) -> dict:
+        return {
+            "entidad": self.entidad,
+            "dry_run": self.dry_run,
+            "total_filas": self.total_filas,
+            "validas": self.validas,
+            "insertadas": self.insertadas,
+            "total_errores": self.total_errores,
+            "errores": sorted(self.errores, key=lambda e: e["fila"])
+        }
+
+
+async def importar_csv(entidad: str, fichero, dry_run: bool = False) -> dict:
+    """Importa un CSV por trozos de TAMANO_TROZO filas.
+
+    Las filas con errores se informan con su número de línea y no se
+    insertan; el resto sí (salvo en simulación). Conviene lanzar antes
+    la importación con dry_run para revisar el informe.
+    """
+    importacion = Importacion(entidad, dry_run)
+    lector = await asyncio.to_thread(_abrir_csv, fichero)
+    numerada = _filas_numeradas(lector)
+    while True:
+        trozo = await asyncio.to_thread(lambda: list(islice(numerada, TAMANO_TROZO)))
+        if not trozo:
+            break
+        await importacion.procesar_trozo([(numero, _limpiar(fila)) for numero, fila in trozo])
+    return importacion.resumen()
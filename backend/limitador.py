@@ -0,0 +1,219 @@
+import math
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+
+import metricas
+from database import limites_login_collection
+
+# Cubo por IP: ráfaga de LOGIN_IP_CAPACIDAD intentos, recarga de LOGIN_IP_RECARGA por segundo
+IP_CAPACIDAD = float(os.environ.get("LOGIN_IP_CAPACIDAD", "20"))
+IP_RECARGA = float(os.environ.get("LOGIN_IP_RECARGA", "0.2"))
+# Cubo por email: pocos intentos y recarga lenta (uno por minuto)
+EMAIL_CAPACIDAD = float(os.environ.get("LOGIN_EMAIL_CAPACIDAD", "5"))
+EMAIL_RECARGA = float(os.environ.get("LOGIN_EMAIL_RECARGA", str(1 / 60)))
+# Fallos seguidos de un email a partir de los que se bloquea, con espera creciente
+FALLOS_SIN_BLOQUEO = 3
+MAXIMO_BLOQUEO = 300
+# Tras este tiempo sin fallos se olvida el contador de un email
+VENTANA_FALLOS = 900
+# Claves en memoria a partir de las que se purgan las que ya no limitan nada
+MAXIMO_CLAVES = 10000
+# Proxies de confianza delante de la API (ingress): la IP del cliente es la que añadió
+# el más externo a X-Forwarded-For. Con 0 se usa la dirección de la conexión.
+PROXIES_CONFIANZA = int(os.environ.get("LOGIN_PROXIES_CONFIANZA", "1"))
+
+
+def ip_cliente(request, proxies: int = None) -> str:
+    """IP del cliente según los proxies de confianza (las entradas anteriores de la cabecera las pone el cliente)"""
+    proxies = PROXIES_CONFIANZA if proxies is None else proxies
+    reenviadas = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    if proxies and reenviadas:
+        return reenviadas[-min(proxies, len(reenviadas))]
+    return request.client.host if request.client else "desconocida"
+
+
+def segundos_bloqueo(fallos: int) -> float:
+    """Espera exponencial (2, 4, 8... segundos) a partir de FALLOS_SIN_BLOQUEO fallos"""
+    if fallos <= FALLOS_SIN_BLOQUEO:
+        return 0
+    return min(2 ** (fallos - FALLOS_SIN_BLOQUEO), MAXIMO_BLOQUEO)
+
+
+class AlmacenMemoria:
+    """Cubos y contadores de fallos del propio proceso (cada worker limita por su cuenta)"""
+
+    def __init__(self):
+        self._cubos = {}  # clave -> (tokens, instante)
+        self._fallos = {}  # clave -> (fallos, ultimo_fallo, bloqueado_hasta)
+
+    def _purgar(self):
+        ahora = time.time()
+        self._cubos = {
+            clave: (tokens, instante) for clave, (tokens, instante) in self._cubos.items()
+            if ahora - instante < VENTANA_FALLOS
+        }
+        self._fallos = {
+            clave: valor for clave, valor in self._fallos.items()
+            if ahora - valor[1] < VENTANA_FALLOS
+        }
+
+    def _tokens(self, clave: str, capacidad: float, recarga: float, ahora: float) -> float:
+        tokens, instante = self._cubos.get(clave, (capacidad, ahora))
+        return min(capacidad, tokens + (ahora - instante) * recarga)
+
+    async def consultar(self, clave: str, capacidad: float, recarga: float) -> float:
+        """Como consumir, pero sin gastar el token"""
+        tokens = self._tokens(clave, capacidad, recarga, time.time())
+        return 0.0 if tokens >= 1 else (1 - tokens) / recarga
+
+    async def consumir(self, clave: str, capacidad: float, recarga: float) -> float:
+        """Gasta un token; devuelve 0 si había o los segundos hasta el siguiente"""
+        ahora = time.time()
+        tokens = self._tokens(clave, capacidad, recarga, ahora)
+        if tokens >= 1:
+            self._cubos[clave] = (tokens - 1, ahora)
+            espera = 0.0
+        else:
+            self._cubos[clave] = (tokens, ahora)
+            espera = (1 - tokens) / recarga
+        if len(self._cubos) > MAXIMO_CLAVES:
+            self._purgar()
+        return espera
+
+    async def bloqueado(self, clave: str) -> float:
+        """Segundos de bloqueo que le quedan a la clave"""
+        _, _, hasta = self._fallos.get(clave, (0, 0, 0))
+        return max(hasta - time.time(), 0)
+
+    async def registrar_fallo(self, clave: str) -> int:
+        ahora = time.time()
+        fallos, ultimo, _ = self._fallos.get(clave, (0, ahora, 0))
+        fallos = (fallos if ahora - ultimo < VENTANA_FALLOS else 0) + 1
+        self._fallos[clave] = (fallos, ahora, ahora + segundos_bloqueo(fallos))
+        if len(self._fallos) > MAXIMO_CLAVES:
+            self._purgar()
+        return fallos
+
+    async def reiniciar(self, clave: str):
+        self._fallos.pop(clave, None)
+
+
+class AlmacenMongo:
+    """Cubos y contadores compartidos por todos los workers (colección limites_login con TTL).
+
+    Cada cubo se recarga y consume con una sola actualización atómica por
+    pipeline, así que dos workers no pueden gastar el mismo token.
+    """
+
+    async def consumir(self, clave: str, capacidad: float, recarga: float) -> float:
+        ahora = datetime.now(timezone.utc)
+        transcurrido = {"$divide": [{"$subtract": [ahora, {"$ifNull": ["$instante", ahora]}]}, 1000]}
+        cubo = await limites_login_collection.find_one_and_update(
+            {"_id": f"cubo:{clave}"},
+            [
+                {"$set": {"tokens": {"$min": [
+                    capacidad,
+                    {"$add": [{"$ifNull": ["$tokens", capacidad]}, {"$multiply": [transcurrido, recarga]}]}
+                ]}}},
+                {"$set": {
+                    "admitido": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "instante": ahora,
+                    "expira": ahora + timedelta(seconds=VENTANA_FALLOS)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return 0.0 if cubo["admitido"] else (1 - cubo["tokens"]) / recarga
+
+    async def consultar(self, clave: str, capacidad: float, recarga: float) -> float:
+        cubo = await limites_login_collection.find_one({"_id": f"cubo:{clave}"}, {"tokens": 1, "instante": 1})
+        if not cubo:
+            return 0.0
+        transcurrido = (datetime.now(timezone.utc) - cubo["instante"].replace(tzinfo=timezone.utc)).total_seconds()
+        tokens = min(capacidad, cubo["tokens"] + transcurrido * recarga)
+        return 0.0 if tokens >= 1 else (1 - tokens) / recarga
+
+    async def bloqueado(self, clave: str) -> float:
+        documento = await limites_login_collection.find_one({"_id": f"fallos:{clave}"}, {"bloqueado_hasta": 1})
+        if not documento or not documento.get("bloqueado_hasta"):
+            return 0
+        hasta = documento["bloqueado_hasta"].replace(tzinfo=timezone.utc)
+        return max((hasta - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    async def registrar_fallo(self, clave: str) -> int:
+        ahora = datetime.now(timezone.utc)
+        documento = await limites_login_collection.find_one_and_update(
+            {"_id": f"fallos:{clave}"},
+            {"$inc": {"fallos": 1}, "$set": {"expira": ahora + timedelta(seconds=VENTANA_FALLOS)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        bloqueo = segundos_bloqueo(documento["fallos"])
+        if bloqueo:
+            await limites_login_collection.update_one(
+                {"_id": f"fallos:{clave}"},
+                {"$set": {"bloqueado_hasta": ahora + timedelta(seconds=bloqueo)}}
+            )
+        return documento["fallos"]
+
+    async def reiniciar(self, clave: str):
+        await limites_login_collection.delete_one({"_id": f"fallos:{clave}"})
+
+
+def _demasiados_intentos(espera: float) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Demasiados intentos de inicio de sesión, inténtalo más tarde",
+        headers={"Retry-After": str(max(math.ceil(espera), 1))}
+    )
+
+
+class LimitadorLogin:
+    """Control de admisión de /api/auth/login.
+
+    Se comprueba antes de buscar al usuario y de verificar la contraseña
+    con bcrypt, de modo que una ráfaga de intentos se rechaza sin coste.
+    Cada intento gasta del cubo de su IP; el cubo del email solo lo gastan
+    los fallos, así que entrar bien no agota el margen de nadie.
+    """
+
+    def __init__(self, almacen):
+        self.almacen = almacen
+
+    async def admitir(self, ip: str, email: str):
+        """Lanza 429 si el email está bloqueado o se ha agotado el cubo de la IP o del email"""
+        espera = await self.almacen.bloqueado(f"email:{email}")
+        if espera:
+            metricas.incrementar("login.rechazados.bloqueo")
+            raise _demasiados_intentos(espera)
+        espera = await self.almacen.consumir(f"ip:{ip}", IP_CAPACIDAD, IP_RECARGA)
+        if espera:
+            metricas.incrementar("login.rechazados.ip")
+            raise _demasiados_intentos(espera)
+        espera = await self.almacen.consultar(f"email:{email}", EMAIL_CAPACIDAD, EMAIL_RECARGA)
+        if espera:
+            metricas.incrementar("login.rechazados.email")
+            raise _demasiados_intentos(espera)
+        metricas.incrementar("login.admitidos")
+
+    async def fallo(self, email: str):
+        """Cuenta un fallo del email; a partir de unos cuantos seguidos se bloquea con espera creciente"""
+        metricas.incrementar("login.fallidos")
+        await self.almacen.consumir(f"email:{email}", EMAIL_CAPACIDAD, EMAIL_RECARGA)
+        if segundos_bloqueo(await self.almacen.registrar_fallo(f"email:{email}")):
+            metricas.incrementar("login.bloqueos")
+
+    async def exito(self, email: str):
+        metricas.incrementar("login.correctos")
+        await self.almacen.reiniciar(f"email:{email}")
+
+
+limitador_login = LimitadorLogin(
+    AlmacenMongo() if os.environ.get("LOGIN_LIMITADOR_COMPARTIDO", "0") == "1" else AlmacenMemoria()
+)
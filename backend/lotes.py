@@ -0,0 +1,92 @@
+import asyncio
+import json
+import logging
+
+import metricas
+from auth import usuario_lote
+
+logger = logging.getLogger(__name__)
+
+MAXIMO_PETICIONES = 20
+# Rutas que no se pueden ejecutar dentro de un lote (recursión o respuestas en streaming)
+RUTAS_EXCLUIDAS = ("/api/batch", "/api/eventos", "/api/export/")
+
+
+async def _despachar(app, cabeceras: list, cliente, peticion) -> dict:
+    """Ejecuta una subpetición contra la aplicación ASGI dentro del mismo proceso.
+
+    cliente es el (host, puerto) de la petición del lote, para que el
+    limitador de login y los logs vean la IP real.
+    """
+    ruta, _, query = peticion.ruta.partition("?")
+    if not ruta.startswith("/api/"):
+        return {"estado": 400, "cuerpo": {"detail": "La ruta debe empezar por /api/"}}
+    if ruta.startswith(RUTAS_EXCLUIDAS):
+        return {"estado": 400, "cuerpo": {"detail": "Ruta no permitida en un lote"}}
+
+    cuerpo = b"" if peticion.cuerpo is None else json.dumps(peticion.cuerpo).encode()
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": peticion.metodo,
+        "scheme": "http",
+        "path": ruta,
+        "raw_path": ruta.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": cabeceras + [(b"content-length", str(len(cuerpo)).encode())],
+        "client": cliente,
+        "server": None,
+    }
+    respuesta = {"estado": 500, "trozos": []}
+
+    async def receive():
+        return {"type": "http.request", "body": cuerpo, "more_body": False}
+
+    async def send(mensaje):
+        if mensaje["type"] == "http.response.start":
+            respuesta["estado"] = mensaje["status"]
+        elif mensaje["type"] == "http.response.body":
+            respuesta["trozos"].append(mensaje.get("body", b""))
+
+    try:
+        await app(scope, receive, send)
+    except Exception:
+        # Un fallo en una subpetición no tumba el resto del lote
+        metricas.incrementar("lotes.errores")
+        logger.exception("Error en la subpetición %s %s del lote", peticion.metodo, ruta)
+        return {"estado": 500, "cuerpo": {"detail": "Error interno del servidor"}}
+
+    contenido = b"".join(respuesta["trozos"])
+    try:
+        datos = json.loads(contenido) if contenido else None
+    except ValueError:
+        datos = contenido.decode(errors="replace")
+    return {"estado": respuesta["estado"], "cuerpo": datos}
+
+
+async def ejecutar_lote(app, usuario: dict, peticiones: list, cliente=None) -> list:
+    """Ejecuta las subpeticiones con el usuario ya autenticado.
+
+    Las lecturas consecutivas se lanzan a la vez; cada escritura espera a
+    las anteriores, así que el orden de las escrituras se respeta.
+    """
+    cabeceras = [(b"content-type", b"application/json")]
+    token = usuario_lote.set(usuario)
+    try:
+        resultados = []
+        lecturas = []
+        for peticion in peticiones:
+            if peticion.metodo == "GET":
+                lecturas.append(peticion)
+                continue
+            if lecturas:
+                resultados += await asyncio.gather(*(_despachar(app, cabeceras, cliente, p) for p in lecturas))
+                lecturas = []
+            resultados.append(await _despachar(app, cabeceras, cliente, peticion))
+        if lecturas:
+            resultados += await asyncio.gather(*(_despachar(app, cabeceras, cliente, p) for p in lecturas))
+        return resultados
+    finally:
+        usuario_lote.reset(token)
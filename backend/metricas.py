@@ -0,0 +1,45 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Métricas en memoria del proceso (contadores y tiempos)
+_contadores = defaultdict(int)
+_tiempos = defaultdict(lambda: {"llamadas": 0, "total_ms": 0.0, "max_ms": 0.0})
+
+
+def incrementar(nombre: str, cantidad: int = 1):
+    """Incrementa un contador"""
+    _contadores[nombre] += cantidad
+
+
+def registrar_tiempo(nombre: str, duracion_ms: float):
+    """Acumula la duración de una operación"""
+    tiempo = _tiempos[nombre]
+    tiempo["llamadas"] += 1
+    tiempo["total_ms"] += duracion_ms
+    tiempo["max_ms"] = max(tiempo["max_ms"], duracion_ms)
+
+
+@contextmanager
+def cronometrar(nombre: str):
+    """Mide la duración del bloque y la registra con el nombre indicado"""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        registrar_tiempo(nombre, (time.perf_counter() - inicio) * 1000)
+
+
+def instantanea() -> dict:
+    """Devuelve una copia de todas las métricas"""
+    return {
+        "contadores": dict(_contadores),
+        "tiempos": {
+            nombre: {
+                "llamadas": t["llamadas"],
+                "media_ms": round(t["total_ms"] / t["llamadas"], 3) if t["llamadas"] else 0,
+                "max_ms": round(t["max_ms"], 3)
+            }
+            for nombre, t in _tiempos.items()
+        }
+    }
@@ -0,0 +1,278 @@
+import asyncio
+import logging
+import os
+import re
+from datetime import datetime, timezone
+
+from pymongo import UpdateOne
+
+import metricas
+import versiones
+from configuracion import ajustes_cache
+from database import db, schema_migrations_collection
+from programador import adquirir_lease, liberar_lease
+from recursos import PREFIJO_URL, logo_a_recurso
+
+logger = logging.getLogger(__name__)
+
+# Documentos por bulk_write
+TAMANO_LOTE = int(os.environ.get("MIGRACIONES_TAMANO_LOTE", "500"))
+# Pausa entre lotes para que el backfill no compita con las peticiones
+PAUSA_ENTRE_LOTES = float(os.environ.get("MIGRACIONES_PAUSA", "0.2"))
+# Solo un worker ejecuta las migraciones; el lease se renueva en cada lote
+NOMBRE_LEASE = "migraciones"
+DURACION_LEASE = 120
+
+# El lease no distingue dos ejecuciones del mismo worker (arranque y endpoint)
+_ejecucion = asyncio.Lock()
+
+
+class Paso:
+    """Backfill de una colección: a cada documento del filtro se le aplica la
+    actualización que devuelva la corrutina transformar(doc) (None = sin cambios)"""
+
+    def __init__(self, coleccion: str, filtro: dict, transformar, proyeccion: dict = None, despues=None):
+        self.coleccion = coleccion
+        self.filtro = filtro
+        self.transformar = transformar
+        self.proyeccion = proyeccion
+        # Corrutina sin argumentos que se llama si el paso ha modificado algo
+        self.despues = despues
+
+
+class Migracion:
+    """Migración versionada formada por uno o varios pasos"""
+
+    def __init__(self, version: int, nombre: str, pasos: list):
+        self.version = version
+        self.nombre = nombre
+        self.pasos = pasos
+
+
+# ---- Migraciones ----
+
+async def _contrato_por_defecto(contrato: dict):
+    """Campos que los contratos antiguos no tienen"""
+    faltan = {}
+    if "archivado" not in contrato:
+        faltan["archivado"] = False
+    if "dia_pago" not in contrato:
+        faltan["dia_pago"] = 1
+    if "resultado_liquidacion_fianza" not in contrato:
+        faltan["resultado_liquidacion_fianza"] = {
+            "estado": "pendiente",
+            "importe_a_devolver": None,
+            "fecha_liquidacion": None
+        }
+    if not faltan:
+        return None
+    # updated_at: /api/sync envía el cambio a los clientes
+    return {"$set": {**faltan, "updated_at": datetime.now(timezone.utc)}}
+
+
+async def _updated_at_inicial(documento: dict):
+    """updated_at a partir de las fechas que ya tenga el documento (o ahora)"""
+    fecha = (
+        documento.get("fecha_ultima_actualizacion")
+        or documento.get("fecha_creacion")
+        or datetime.now(timezone.utc)
+    )
+    return {"$set": {"updated_at": fecha}}
+
+
+async def _logo_a_recurso(ajustes: dict):
+    """Logo guardado en base64 dentro de ajustes -> recurso en GridFS"""
+    logo = ajustes["datos_empresa"]["logo"]
+    try:
+        url = await logo_a_recurso(logo)
+    except ValueError:
+        # Un logo corrupto no debe dejar la migración atascada: se deja como está
+        metricas.incrementar("migraciones.documentos_omitidos")
+        logger.warning("Ajustes %s: el logo no es una imagen válida, se omite", ajustes["_id"])
+        return None
+    if url == logo:
+        return None
+    return {"$set": {"datos_empresa.logo": url}, "$inc": {"version": 1}}
+
+
+MIGRACIONES = [
+    Migracion(1, "contratos_campos_por_defecto", [
+        Paso(
+            "contratos",
+            {"$or": [
+                {"archivado": {"$exists": False}},
+                {"dia_pago": {"$exists": False}},
+                {"resultado_liquidacion_fianza": {"$exists": False}}
+            ]},
+            _contrato_por_defecto,
+            {"archivado": 1, "dia_pago": 1, "resultado_liquidacion_fianza": 1}
+        )
+    ]),
+    Migracion(2, "updated_at_inicial", [
+        Paso(
+            coleccion,
+            {"updated_at": {"$exists": False}},
+            _updated_at_inicial,
+            {"fecha_ultima_actualizacion": 1, "fecha_creacion": 1}
+        )
+        for coleccion in ("pisos", "habitaciones", "inquilinos", "contratos", "pagos", "gastos")
+    ]),
+    Migracion(3, "logo_a_recurso", [
+        Paso(
+            "ajustes",
+            {"datos_empresa.logo": {"$exists": True, "$nin": [None, ""], "$not": re.compile(f"^({PREFIJO_URL}|http)")}},
+            _logo_a_recurso,
+            {"datos_empresa.logo": 1},
+            despues=ajustes_cache.cargar
+        )
+    ]),
+]
+
+
+# ---- Ejecución ----
+
+async def _renovar_lease() -> bool:
+    """Adquiere o renueva el lease de migraciones; False si lo tiene otro worker"""
+    return await adquirir_lease(NOMBRE_LEASE, DURACION_LEASE)
+
+
+async def _guardar_estado(migracion: Migracion, cambios: dict):
+    await schema_migrations_collection.update_one(
+        {"_id": migracion.version},
+        {"$set": {"nombre": migracion.nombre, **cambios}},
+        upsert=True
+    )
+
+
+async def _ejecutar_paso(migracion: Migracion, indice: int, paso: Paso, estado: dict):
+    """Recorre la colección por _id desde el último checkpoint.
+
+    Devuelve el estado al terminar el paso, o None si se pierde el lease.
+    """
+    coleccion = db[paso.coleccion]
+    ultimo_id = estado.get("ultimo_id") if estado.get("paso", 0) == indice else None
+    procesados = estado.get("procesados", 0)
+    modificados = estado.get("modificados", 0)
+    hubo_cambios = False
+    while True:
+        filtro = dict(paso.filtro)
+        if ultimo_id is not None:
+            filtro = {"$and": [paso.filtro, {"_id": {"$gt": ultimo_id}}]}
+        documentos = await coleccion.find(filtro, paso.proyeccion).sort("_id", 1).limit(TAMANO_LOTE).to_list(None)
+        if not documentos:
+            break
+
+        operaciones = []
+        for documento in documentos:
+            actualizacion = await paso.transformar(documento)
+            if actualizacion:
+                operaciones.append(UpdateOne({"_id": documento["_id"]}, actualizacion))
+        if operaciones:
+            with metricas.cronometrar(f"migracion.{migracion.nombre}.lote"):
+                resultado = await coleccion.bulk_write(operaciones, ordered=False)
+            modificados += resultado.modified_count
+            hubo_cambios = hubo_cambios or resultado.modified_count > 0
+
+        ultimo_id = documentos[-1]["_id"]
+        procesados += len(documentos)
+        # Checkpoint: si el proceso se corta, se continúa desde aquí
+        await _guardar_estado(migracion, {
+            "paso": indice, "ultimo_id": ultimo_id, "procesados": procesados, "modificados": modificados
+        })
+        if not await _renovar_lease():
+            return None
+        await asyncio.sleep(PAUSA_ENTRE_LOTES)
+
+    if hubo_cambios:
+        await versiones.incrementar(paso.coleccion)
+        if paso.despues:
+            await paso.despues()
+    estado = {"paso": indice + 1, "ultimo_id": None, "procesados": procesados, "modificados": modificados}
+    await _guardar_estado(migracion, estado)
+    return estado
+
+
+async def ejecutar_migraciones() -> dict:
+    """Aplica en orden las migraciones pendientes; se puede interrumpir y reanudar"""
+    if _ejecucion.locked():
+        return {"ejecutadas": [], "motivo": "ya hay una ejecución en curso"}
+    async with _ejecucion:
+        return await _ejecutar_pendientes()
+
+
+async def _ejecutar_pendientes() -> dict:
+    if not await _renovar_lease():
+        return {"ejecutadas": [], "motivo": "otro worker tiene el lease"}
+    ejecutadas = []
+    try:
+        estados = {e["_id"]: e for e in await schema_migrations_collection.find({}).to_list(None)}
+        for migracion in sorted(MIGRACIONES, key=lambda m: m.version):
+            estado = estados.get(migracion.version, {})
+            if estado.get("estado") == "completada":
+                continue
+            await _guardar_estado(migracion, {
+                "estado": "en_curso",
+                "iniciada": estado.get("iniciada") or datetime.now(timezone.utc)
+            })
+            logger.info("Migración %s (%s)", migracion.version, migracion.nombre)
+            for indice, paso in enumerate(migracion.pasos):
+                if indice < estado.get("paso", 0):
+                    continue
+                estado = await _ejecutar_paso(migracion, indice, paso, estado)
+                if estado is None:
+                    return {"ejecutadas": ejecutadas, "motivo": "lease perdido"}
+            await _guardar_estado(migracion, {"estado": "completada", "completada": datetime.now(timezone.utc)})
+            ejecutadas.append(migracion.nombre)
+    finally:
+        await liberar_lease(NOMBRE_LEASE)
+    return {"ejecutadas": ejecutadas}
+
+
+async def estado_migraciones() -> list:
+    """Estado de cada migración registrada"""
+    estados = {e["_id"]: e for e in await schema_migrations_collection.find({}).to_list(None)}
+    return [
+        {
+            "version": m.version,
+            "nombre": m.nombre,
+            "pasos": len(m.pasos),
+            "estado": estados.get(m.version, {}).get("estado", "pendiente"),
+            **{k: v for k, v in estados.get(m.version, {}).items() if k not in ("_id", "nombre", "estado")}
+        }
+        for m in sorted(MIGRACIONES, key=lambda m: m.version)
+    ]
+
+
+class Migrador:
+    """Lanza las migraciones pendientes en segundo plano al arrancar"""
+
+    def __init__(self):
+        self._tarea = None
+
+    async def _ejecutar(self):
+        try:
+            resultado = await ejecutar_migraciones()
+            if resultado["ejecutadas"]:
+                logger.info("Migraciones aplicadas: %s", ", ".join(resultado["ejecutadas"]))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            metricas.incrementar("migraciones.errores")
+            logger.exception("Error al ejecutar las migraciones")
+
+    def iniciar(self):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._ejecutar())
+
+    async def detener(self):
+        """Cancela la migración en curso; se reanuda desde el checkpoint en el próximo arranque"""
+        if self._tarea is not None:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+
+migrador = Migrador()
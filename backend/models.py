@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import Optional, List, Literal
+from typing import Optional, List, Literal, Any
 from datetime import datetime, timezone
 from bson import ObjectId
 
@@ -145,6 +145,8 @@ class Contrato(ContratoBase):
     model_config = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
     id: str = Field(alias="_id")
     resultado_liquidacion_fianza: ResultadoLiquidacionFianza = Field(default_factory=lambda: ResultadoLiquidacionFianza())
+    # Cuándo se finalizó antes de su fecha_fin (None si terminó en su fecha)
+    fecha_finalizacion: Optional[datetime] = None
 
 # Pago
 class PagoBase(BaseModel):
@@ -176,6 +178,24 @@ class Pago(PagoBase):
     fecha_creacion: Optional[datetime] = None
     fecha_ultima_actualizacion: Optional[datetime] = None
 
+# Avisos (notificaciones)
+class AvisoCreate(BaseModel):
+    tipo: Literal["recordatorio", "recibo"]
+
+class Aviso(BaseModel):
+    model_config = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
+    id: str = Field(alias="_id")
+    pago_id: str
+    tipo: Literal["recordatorio", "recibo", "confirmacion_cobro"]
+    canal: Literal["email", "whatsapp"]
+    destinatario: str
+    asunto: str
+    estado: Literal["pendiente", "enviando", "enviado", "fallido"]
+    intentos: int = 0
+    creado_en: Optional[datetime] = None
+    enviado_en: Optional[datetime] = None
+    ultimo_error: Optional[str] = None
+
 # Gasto
 class GastoBase(BaseModel):
     contrato_id: str
@@ -204,7 +224,7 @@ class DatosEmpresa(BaseModel):
     direccion: Optional[str] = None
     email: Optional[str] = None
     telefono: Optional[str] = None
-    logo: Optional[str] = None
+    logo: Optional[str] = None  # URL del recurso: /api/recursos/<hash>
 
 class SMTPConfig(BaseModel):
     servidor: Optional[str] = None
@@ -228,6 +248,20 @@ class AjustesUpdate(BaseModel):
 class Ajustes(AjustesBase):
     model_config = ConfigDict(populate_by_name=True, arbitrary_types_allowed=True)
     id: str = Field(alias="_id")
+    version: int = 0
+
+# Lote de peticiones
+class PeticionLote(BaseModel):
+    metodo: Literal["GET", "POST", "PUT", "DELETE"]
+    ruta: str  # p. ej. /api/pagos?estado=pendiente
+    cuerpo: Optional[Any] = None
+
+class Lote(BaseModel):
+    peticiones: List[PeticionLote]
+
+class RespuestaLote(BaseModel):
+    estado: int
+    cuerpo: Optional[Any] = None
 
 # Auth
 class LoginRequest(BaseModel):
@@ -0,0 +1,338 @@
+import asyncio
+import logging
+import os
+import smtplib
+import time
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+
+import requests
+from bson import ObjectId
+from pymongo import UpdateOne, UpdateMany
+
+import metricas
+from database import avisos_collection
+from repositorios import usuarios_repo, inquilinos_repo, contratos_repo, pagos_repo
+from configuracion import ajustes_cache
+
+logger = logging.getLogger(__name__)
+
+MAX_INTENTOS = 5
+ESPERA_BASE_SEGUNDOS = 30
+# Un aviso que lleva más de este tiempo "enviando" se considera abandonado
+TIEMPO_MAXIMO_ENVIO = timedelta(minutes=10)
+
+PLANTILLAS = {
+    "recordatorio": (
+        "Recordatorio de pago {mes_anio}",
+        "Hola {nombre}, te recordamos que el pago de {tipo} de {mes_anio} por importe de {importe:.2f} € está pendiente."
+    ),
+    "recibo": (
+        "Recibo de pago {mes_anio}",
+        "Hola {nombre}, hemos recibido tu pago de {tipo} de {mes_anio} por importe de {importe:.2f} €. Gracias."
+    ),
+    "confirmacion_cobro": (
+        "Cobro confirmado {mes_anio}",
+        "Hola {nombre}, el cobro de {tipo} de {mes_anio} ({importe:.2f} €) que registraste ha sido confirmado."
+    ),
+}
+
+
+# ============= ENCOLADO =============
+def _aviso(pago: dict, tipo: str, canal: str, destinatario: str, nombre: str) -> UpdateOne:
+    """Operación de upsert que solo inserta si no existe ya el aviso (pago, tipo, canal)"""
+    asunto, cuerpo = PLANTILLAS[tipo]
+    datos = {"nombre": nombre, "tipo": pago["tipo"], "mes_anio": pago["mes_anio"], "importe": pago["importe"]}
+    ahora = datetime.now(timezone.utc)
+    return UpdateOne(
+        {"pago_id": pago["_id"], "tipo": tipo, "canal": canal},
+        {"$setOnInsert": {
+            "_id": str(ObjectId()),
+            "destinatario": destinatario,
+            "asunto": asunto.format(**datos),
+            "cuerpo": cuerpo.format(**datos),
+            "estado": "pendiente",
+            "intentos": 0,
+            "proximo_intento": ahora,
+            "creado_en": ahora,
+            "enviado_en": None,
+            "ultimo_error": None
+        }},
+        upsert=True
+    )
+
+
+async def encolar_avisos_pagos(pago_ids: list, tipo: str) -> int:
+    """Encola avisos de un tipo para varios pagos con consultas $in; devuelve cuántos son nuevos.
+
+    recordatorio y recibo van al inquilino por email y por WhatsApp (teléfono);
+    el recibo añade una confirmación por WhatsApp al usuario que registró el cobro.
+    """
+    pagos = list((await pagos_repo.obtener_muchos(pago_ids)).values())
+    if not pagos:
+        return 0
+
+    contratos = await contratos_repo.obtener_muchos((p["contrato_id"] for p in pagos), {"inquilino_id": 1})
+    inquilinos, usuarios = await asyncio.gather(
+        inquilinos_repo.obtener_muchos(
+            (c["inquilino_id"] for c in contratos.values()), {"nombre": 1, "email": 1, "telefono": 1}
+        ),
+        usuarios_repo.obtener_muchos((p.get("creado_por_usuario_id") for p in pagos), {"nombre": 1, "whatsapp": 1}),
+    )
+
+    operaciones = []
+    for pago in pagos:
+        contrato = contratos.get(pago["contrato_id"])
+        inquilino = inquilinos.get(contrato["inquilino_id"]) if contrato else None
+        if inquilino:
+            if inquilino.get("email"):
+                operaciones.append(_aviso(pago, tipo, "email", inquilino["email"], inquilino["nombre"]))
+            if inquilino.get("telefono"):
+                operaciones.append(_aviso(pago, tipo, "whatsapp", inquilino["telefono"], inquilino["nombre"]))
+        if tipo == "recibo":
+            usuario = usuarios.get(pago.get("creado_por_usuario_id"))
+            if usuario and usuario.get("whatsapp"):
+                operaciones.append(
+                    _aviso(pago, "confirmacion_cobro", "whatsapp", usuario["whatsapp"], usuario["nombre"])
+                )
+
+    if not operaciones:
+        return 0
+    resultado = await avisos_collection.bulk_write(operaciones, ordered=False)
+    metricas.incrementar("avisos.encolados", resultado.upserted_count)
+    return resultado.upserted_count
+
+
+# ============= LIMITACIÓN DE TASA =============
+class LimitadorTasa:
+    """Token bucket asíncrono: como mucho por_minuto envíos por minuto"""
+
+    def __init__(self, por_minuto: int):
+        self.capacidad = max(por_minuto, 1)
+        self.tokens = float(self.capacidad)
+        self.recarga_por_segundo = self.capacidad / 60
+        self.ultima_recarga = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def adquirir(self):
+        """Espera hasta que haya un token disponible"""
+        async with self._lock:
+            while True:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultima_recarga) * self.recarga_por_segundo)
+                self.ultima_recarga = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.recarga_por_segundo)
+
+
+# ============= EMISORES =============
+class EmisorEmail:
+    """Envía emails por SMTP reutilizando una conexión para todo el lote"""
+
+    canal = "email"
+
+    async def configuracion(self):
+        """Configuración SMTP de ajustes, o None si no hay servidor configurado"""
+        ajustes = ajustes_cache.obtener() or {}
+        smtp = ajustes.get("smtp_config") or {}
+        if not smtp.get("servidor"):
+            return None
+        empresa = ajustes.get("datos_empresa") or {}
+        return {**smtp, "remitente": smtp.get("usuario") or empresa.get("email") or "no-reply@localhost"}
+
+    def _conectar(self, config: dict):
+        """Abre la conexión SMTP (bloqueante, se llama desde un hilo)"""
+        usar_tls = config.get("usar_tls", True)
+        conexion = smtplib.SMTP(config["servidor"], config.get("puerto") or (587 if usar_tls else 25), timeout=30)
+        if usar_tls:
+            conexion.starttls()
+        if config.get("usuario") and config.get("contraseña"):
+            conexion.login(config["usuario"], config["contraseña"])
+        return conexion
+
+    async def enviar_lote(self, avisos: list, config: dict, limitador: LimitadorTasa, resultados: dict = None) -> dict:
+        """Envía el lote y devuelve {aviso_id: None | mensaje de error}.
+
+        Cada resultado se anota en resultados nada más enviarse el mensaje;
+        si se cae la conexión, los avisos que quedan se dejan sin resultado
+        (se reintentan) y los ya enviados no se vuelven a enviar.
+        """
+        resultados = {} if resultados is None else resultados
+        conexion = await asyncio.to_thread(self._conectar, config)
+        try:
+            for aviso in avisos:
+                await limitador.adquirir()
+                mensaje = EmailMessage()
+                mensaje["From"] = config["remitente"]
+                mensaje["To"] = aviso["destinatario"]
+                mensaje["Subject"] = aviso["asunto"]
+                mensaje.set_content(aviso["cuerpo"])
+                try:
+                    await asyncio.to_thread(conexion.send_message, mensaje)
+                    resultados[aviso["_id"]] = None
+                except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError) as e:
+                    resultados[aviso["_id"]] = str(e)
+                    break
+                except OSError as e:
+                    # SMTPException incluida: el servidor rechaza este mensaje, la conexión sigue
+                    resultados[aviso["_id"]] = str(e)
+        finally:
+            try:
+                await asyncio.to_thread(conexion.quit)
+            except OSError:
+                pass
+        return resultados
+
+
+class EmisorWhatsApp:
+    """Envía mensajes a una pasarela HTTP de WhatsApp (WHATSAPP_API_URL)"""
+
+    canal = "whatsapp"
+
+    async def configuracion(self):
+        """URL de la pasarela, o None si no está configurada"""
+        url = os.environ.get("WHATSAPP_API_URL")
+        if not url:
+            return None
+        return {"url": url, "token": os.environ.get("WHATSAPP_API_TOKEN")}
+
+    async def enviar_lote(self, avisos: list, config: dict, limitador: LimitadorTasa, resultados: dict = None) -> dict:
+        """Envía el lote y devuelve {aviso_id: None | mensaje de error} (anotados en resultados según se envían)"""
+        resultados = {} if resultados is None else resultados
+        with requests.Session() as sesion:
+            if config.get("token"):
+                sesion.headers["Authorization"] = f"Bearer {config['token']}"
+            for aviso in avisos:
+                await limitador.adquirir()
+                try:
+                    respuesta = await asyncio.to_thread(
+                        sesion.post, config["url"],
+                        json={"telefono": aviso["destinatario"], "mensaje": aviso["cuerpo"]}, timeout=30
+                    )
+                    respuesta.raise_for_status()
+                    resultados[aviso["_id"]] = None
+                except requests.RequestException as e:
+                    resultados[aviso["_id"]] = str(e)
+        return resultados
+
+
+# ============= DESPACHADOR =============
+class Despachador:
+    """Pool de trabajadores asyncio que vacía la colección avisos.
+
+    Cada trabajador reclama un lote de su canal de forma atómica, lo envía
+    con el emisor del canal y registra el resultado; los fallos se
+    reintentan con espera exponencial hasta MAX_INTENTOS.
+    """
+
+    def __init__(self, emisores=None, trabajadores_por_canal: int = 2, tamano_lote: int = 20, intervalo_espera: int = 10):
+        self.emisores = emisores or [EmisorEmail(), EmisorWhatsApp()]
+        self.trabajadores_por_canal = trabajadores_por_canal
+        self.tamano_lote = tamano_lote
+        self.intervalo_espera = intervalo_espera
+        self.limitadores = {
+            "email": LimitadorTasa(int(os.environ.get("AVISOS_EMAIL_POR_MINUTO", "60"))),
+            "whatsapp": LimitadorTasa(int(os.environ.get("AVISOS_WHATSAPP_POR_MINUTO", "20"))),
+        }
+        self._tareas = []
+
+    async def _reclamar_lote(self, canal: str) -> list:
+        """Marca como "enviando" hasta tamano_lote avisos listos del canal.
+
+        Se eligen los candidatos, se reclaman con un solo update_many que
+        repite el filtro (lo que otro trabajador haya reclamado entretanto ya
+        no coincide) y se leen los que llevan el token de este lote.
+        """
+        ahora = datetime.now(timezone.utc)
+        filtro = {"canal": canal, "$or": [
+            {"estado": "pendiente", "proximo_intento": {"$lte": ahora}},
+            {"estado": "enviando", "reclamado_en": {"$lt": ahora - TIEMPO_MAXIMO_ENVIO}}
+        ]}
+        candidatos = await (
+            avisos_collection.find(filtro, {"_id": 1}).sort("proximo_intento", 1).limit(self.tamano_lote).to_list(None)
+        )
+        if not candidatos:
+            return []
+        token = str(ObjectId())
+        await avisos_collection.update_many(
+            {**filtro, "_id": {"$in": [c["_id"] for c in candidatos]}},
+            {"$set": {"estado": "enviando", "reclamado_en": ahora, "lote": token}}
+        )
+        return await avisos_collection.find({"lote": token}).sort("proximo_intento", 1).to_list(None)
+
+    async def _registrar_resultados(self, avisos: list, resultados: dict):
+        """Marca los enviados y programa el reintento (o el fallo definitivo) del resto"""
+        ahora = datetime.now(timezone.utc)
+        operaciones = []
+        enviados = [a["_id"] for a in avisos if a["_id"] in resultados and resultados[a["_id"]] is None]
+        if enviados:
+            operaciones.append(UpdateMany(
+                {"_id": {"$in": enviados}},
+                {"$set": {"estado": "enviado", "enviado_en": ahora, "ultimo_error": None}}
+            ))
+        for aviso in avisos:
+            if aviso["_id"] in enviados:
+                continue
+            error = resultados.get(aviso["_id"], "No enviado")
+            intentos = aviso.get("intentos", 0) + 1
+            operaciones.append(UpdateOne({"_id": aviso["_id"]}, {"$set": {
+                "estado": "fallido" if intentos >= MAX_INTENTOS else "pendiente",
+                "intentos": intentos,
+                "proximo_intento": ahora + timedelta(seconds=ESPERA_BASE_SEGUNDOS * 2 ** intentos),
+                "ultimo_error": error
+            }}))
+        await avisos_collection.bulk_write(operaciones, ordered=False)
+        metricas.incrementar("avisos.enviados", len(enviados))
+        metricas.incrementar("avisos.errores", len(avisos) - len(enviados))
+
+    async def procesar_lote(self, emisor) -> int:
+        """Reclama y envía un lote del canal del emisor; devuelve cuántos avisos ha procesado"""
+        config = await emisor.configuracion()
+        if config is None:
+            return 0
+        avisos = await self._reclamar_lote(emisor.canal)
+        if not avisos:
+            return 0
+        resultados = {}
+        try:
+            await emisor.enviar_lote(avisos, config, self.limitadores[emisor.canal], resultados)
+        except Exception as e:
+            # Fallo de conexión: se reintentan los avisos que no se llegaron a enviar
+            logger.warning("Error enviando avisos por %s: %s", emisor.canal, e)
+            for aviso in avisos:
+                resultados.setdefault(aviso["_id"], str(e))
+        await self._registrar_resultados(avisos, resultados)
+        return len(avisos)
+
+    async def _trabajador(self, emisor):
+        while True:
+            try:
+                procesados = await self.procesar_lote(emisor)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error en el despachador de avisos (%s)", emisor.canal)
+                procesados = 0
+            if not procesados:
+                await asyncio.sleep(self.intervalo_espera)
+
+    def iniciar(self):
+        """Arranca los trabajadores de cada canal"""
+        if not self._tareas:
+            self._tareas = [
+                asyncio.create_task(self._trabajador(emisor))
+                for emisor in self.emisores
+                for _ in range(self.trabajadores_por_canal)
+            ]
+
+    async def detener(self):
+        """Cancela los trabajadores"""
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+
+despachador = Despachador()
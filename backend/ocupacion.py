@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pandas as pd
+
+# Regla única de qué contratos ocupan su habitación (disponibilidad y analítica).
+# Un contrato finalizado cuya fecha_fin aún no ha llegado se terminó antes de
+# tiempo: solo ocupa (y genera cuotas) hasta fecha_finalizacion, y si no se
+# guardó esa fecha (contratos anteriores a ella) no cuenta.
+
+
+def filtro_ocupan(ahora: datetime) -> dict:
+    """Filtro de Mongo de los contratos que ocupan u ocuparon su habitación"""
+    return {"$or": [
+        {"estado": {"$in": ["activo", "programado"]}},
+        {"estado": "finalizado", "fecha_fin": {"$lt": ahora}},
+        {"estado": "finalizado", "fecha_finalizacion": {"$ne": None}}
+    ]}
+
+
+def terminado_antes(contrato: dict, ahora: datetime) -> bool:
+    """El contrato se finalizó antes de su fecha_fin"""
+    return contrato.get("estado") == "finalizado" and contrato["fecha_fin"] >= ahora
+
+
+def fin_efectivo(contrato: dict, ahora: datetime):
+    """Hasta cuándo ocupa el contrato (None si se terminó antes de tiempo sin fecha)"""
+    if terminado_antes(contrato, ahora):
+        return contrato.get("fecha_finalizacion")
+    return contrato["fecha_fin"]
+
+
+def fines_efectivos(contratos: pd.DataFrame, ahora: datetime) -> pd.Series:
+    """fin_efectivo para un DataFrame de contratos (NaT si no ocupan)"""
+    fecha_fin = pd.to_datetime(contratos["fecha_fin"])
+    terminados = (contratos["estado"] == "finalizado") & (fecha_fin >= pd.Timestamp(ahora))
+    return fecha_fin.where(~terminados, pd.to_datetime(contratos["fecha_finalizacion"]))
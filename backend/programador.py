@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+from uuid import uuid4
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import metricas
+from database import leases_collection
+
+logger = logging.getLogger(__name__)
+
+# Identificador único de este proceso (para el lease entre workers)
+ID_TRABAJADOR = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:6]}"
+
+
+async def adquirir_lease(nombre: str, duracion: int) -> bool:
+    """Adquiere o renueva el lease nombre durante duracion segundos; False si lo tiene otro worker"""
+    ahora = datetime.now(timezone.utc)
+    try:
+        lease = await leases_collection.find_one_and_update(
+            {"_id": nombre, "$or": [{"titular": ID_TRABAJADOR}, {"expira": {"$lt": ahora}}]},
+            {"$set": {"titular": ID_TRABAJADOR, "expira": ahora + timedelta(seconds=duracion)}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        # Otro worker tiene el lease vigente
+        return False
+    return lease is not None and lease["titular"] == ID_TRABAJADOR
+
+
+async def liberar_lease(nombre: str):
+    """Libera el lease si lo tiene este worker"""
+    await leases_collection.delete_one({"_id": nombre, "titular": ID_TRABAJADOR})
+
+
+class Tarea:
+    """Tarea periódica registrada en el programador"""
+
+    def __init__(self, nombre: str, funcion, intervalo_segundos: int):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.intervalo = intervalo_segundos
+        self.proxima_ejecucion = 0.0
+        self.ejecuciones = 0
+        self.errores = 0
+        self.ultima_ejecucion = None
+        self.ultima_duracion_ms = None
+        self.ultimo_resultado = None
+        self.ultimo_error = None
+
+    def estado(self) -> dict:
+        """Métricas de ejecución de la tarea"""
+        return {
+            "nombre": self.nombre,
+            "intervalo_segundos": self.intervalo,
+            "ejecuciones": self.ejecuciones,
+            "errores": self.errores,
+            "ultima_ejecucion": self.ultima_ejecucion,
+            "ultima_duracion_ms": self.ultima_duracion_ms,
+            "ultimo_resultado": self.ultimo_resultado,
+            "ultimo_error": self.ultimo_error
+        }
+
+
+class Programador:
+    """Ejecuta tareas periódicas dentro del proceso.
+
+    Solo el worker que tiene el lease (documento en la colección leases)
+    ejecuta las tareas; los demás se limitan a intentar renovarlo.
+    """
+
+    def __init__(self, nombre_lease: str = "programador", duracion_lease: int = 60, intervalo_tick: int = 15):
+        self.nombre_lease = nombre_lease
+        self.duracion_lease = duracion_lease
+        self.intervalo_tick = intervalo_tick
+        self.tareas = {}
+        self.es_lider = False
+        self._tarea_bucle = None
+
+    def registrar(self, nombre: str, funcion, intervalo_segundos: int):
+        """Registra una corrutina sin argumentos para ejecutarla cada intervalo_segundos"""
+        self.tareas[nombre] = Tarea(nombre, funcion, intervalo_segundos)
+
+    async def _adquirir_lease(self) -> bool:
+        """Adquiere o renueva el lease; devuelve True si este worker es el líder"""
+        return await adquirir_lease(self.nombre_lease, self.duracion_lease)
+
+    async def _liberar_lease(self):
+        """Libera el lease si lo tiene este worker"""
+        await liberar_lease(self.nombre_lease)
+
+    async def ejecutar(self, nombre: str):
+        """Ejecuta una tarea inmediatamente y actualiza sus métricas"""
+        tarea = self.tareas[nombre]
+        inicio = time.perf_counter()
+        tarea.ultima_ejecucion = datetime.now(timezone.utc)
+        try:
+            resultado = await tarea.funcion()
+            tarea.ultimo_resultado = resultado
+            tarea.ultimo_error = None
+            return resultado
+        except Exception as e:
+            tarea.errores += 1
+            tarea.ultimo_error = str(e)
+            metricas.incrementar(f"tarea.{nombre}.errores")
+            logger.exception("Error en la tarea %s", nombre)
+            raise
+        finally:
+            tarea.ejecuciones += 1
+            tarea.ultima_duracion_ms = round((time.perf_counter() - inicio) * 1000, 3)
+            metricas.registrar_tiempo(f"tarea.{nombre}", tarea.ultima_duracion_ms)
+
+    async def _bucle(self):
+        while True:
+            try:
+                self.es_lider = await self._adquirir_lease()
+                for tarea in self.tareas.values():
+                    if not self.es_lider:
+                        break
+                    if time.monotonic() >= tarea.proxima_ejecucion:
+                        # Renovar antes de cada tarea: las anteriores pueden haber consumido el lease
+                        self.es_lider = await self._adquirir_lease()
+                        if not self.es_lider:
+                            metricas.incrementar("programador.lease_perdido")
+                            logger.warning("Lease del programador perdido antes de la tarea %s", tarea.nombre)
+                            break
+                        tarea.proxima_ejecucion = time.monotonic() + tarea.intervalo
+                        try:
+                            await self.ejecutar(tarea.nombre)
+                        except Exception:
+                            pass  # ya registrado en ejecutar()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error en el bucle del programador")
+            await asyncio.sleep(self.intervalo_tick)
+
+    def iniciar(self):
+        """Arranca el bucle del programador en segundo plano"""
+        if self._tarea_bucle is None:
+            self._tarea_bucle = asyncio.create_task(self._bucle())
+
+    async def detener(self):
+        """Detiene el bucle y libera el lease"""
+        if self._tarea_bucle is not None:
+            self._tarea_bucle.cancel()
+            try:
+                await self._tarea_bucle
+            except asyncio.CancelledError:
+                pass
+            self._tarea_bucle = None
+        if self.es_lider:
+            await self._liberar_lease()
+            self.es_lider = False
+
+    def estado(self) -> dict:
+        """Estado del programador y de sus tareas"""
+        return {
+            "trabajador": ID_TRABAJADOR,
+            "es_lider": self.es_lider,
+            "tareas": [t.estado() for t in self.tareas.values()]
+        }
+
+
+programador = Programador()
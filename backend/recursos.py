@@ -0,0 +1,102 @@
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+
+from gridfs.errors import NoFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from database import db, obtener_recursos_bucket
+
+recursos_ficheros = db["recursos.files"]
+
+TAMANO_MAXIMO_SUBIDA = 5 * 1024 * 1024
+# Lado máximo (px) de cada variante que se guarda
+VARIANTES = {"original": 512, "miniatura": 128}
+PREFIJO_URL = "/api/recursos/"
+
+
+def _procesar_imagen(contenido: bytes) -> dict:
+    """Redimensiona la imagen a cada variante y la codifica en PNG (bloqueante, va en un hilo)"""
+    try:
+        with Image.open(io.BytesIO(contenido)) as imagen:
+            imagen.load()
+            imagen = ImageOps.exif_transpose(imagen)
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("El fichero no es una imagen válida") from e
+
+    modo = "RGBA" if imagen.mode in ("RGBA", "LA", "P") else "RGB"
+    imagen = imagen.convert(modo)
+
+    variantes = {}
+    for nombre, lado in VARIANTES.items():
+        copia = imagen.copy()
+        copia.thumbnail((lado, lado))
+        buffer = io.BytesIO()
+        copia.save(buffer, format="PNG", optimize=True)
+        variantes[nombre] = buffer.getvalue()
+    return variantes
+
+
+async def _guardar(contenido: bytes, metadatos: dict) -> str:
+    """Guarda el contenido en GridFS con su SHA-256 como nombre (si no existe ya)"""
+    hash_contenido = hashlib.sha256(contenido).hexdigest()
+    existente = await recursos_ficheros.find_one({"filename": hash_contenido}, {"_id": 1})
+    if not existente:
+        await obtener_recursos_bucket().upload_from_stream(hash_contenido, contenido, metadata=metadatos)
+    return hash_contenido
+
+
+async def guardar_imagen(contenido: bytes) -> dict:
+    """Procesa una imagen una sola vez y guarda sus variantes; devuelve las URLs"""
+    variantes = await asyncio.to_thread(_procesar_imagen, contenido)
+    hash_original = await _guardar(variantes["original"], {"content_type": "image/png", "variante": "original"})
+    await _guardar(
+        variantes["miniatura"],
+        {"content_type": "image/png", "variante": "miniatura", "origen": hash_original}
+    )
+    return {
+        "hash": hash_original,
+        "url": f"{PREFIJO_URL}{hash_original}",
+        "miniatura_url": f"{PREFIJO_URL}{hash_original}/miniatura"
+    }
+
+
+async def logo_a_recurso(logo):
+    """Convierte un logo en data URL (data:image/...;base64,...) en un recurso y devuelve su URL.
+
+    Cualquier otro valor (URLs, texto, vacío) se devuelve sin cambios. Lanza
+    ValueError si el data URL no contiene una imagen válida.
+    """
+    if not logo or not logo.startswith("data:image/") or "," not in logo:
+        return logo
+    try:
+        contenido = base64.b64decode(logo.split(",", 1)[1], validate=True)
+    except (binascii.Error, ValueError) as e:
+        raise ValueError("El logo no es una imagen válida") from e
+    return (await guardar_imagen(contenido))["url"]
+
+
+async def abrir_recurso(hash_contenido: str, variante: str = "original"):
+    """Devuelve el flujo de lectura de GridFS del recurso, o None si no existe"""
+    if variante != "original":
+        fichero = await recursos_ficheros.find_one(
+            {"metadata.origen": hash_contenido, "metadata.variante": variante}, {"filename": 1}
+        )
+        # Si la variante es idéntica al original (imagen pequeña) solo se guardó el original
+        if fichero:
+            hash_contenido = fichero["filename"]
+    try:
+        return await obtener_recursos_bucket().open_download_stream_by_name(hash_contenido)
+    except NoFile:
+        return None
+
+
+async def leer_por_trozos(flujo):
+    """Itera el contenido de un fichero de GridFS trozo a trozo"""
+    while True:
+        trozo = await flujo.readchunk()
+        if not trozo:
+            break
+        yield trozo
@@ -0,0 +1,256 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import metricas
+import versiones
+from eventos import bus_eventos
+from database import (
+    eliminados_collection, usuarios_collection, pisos_collection, habitaciones_collection,
+    inquilinos_collection, contratos_collection, pagos_collection,
+    gastos_collection, contratos_archivo_collection, pagos_archivo_collection,
+    gastos_archivo_collection
+)
+from models import Piso, Habitacion, Inquilino, Contrato, Pago, Gasto
+
+
+def datos_actualizacion(datos) -> dict:
+    """Campos enviados (y no nulos) de un modelo *Update; 400 si no hay ninguno"""
+    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
+    if not update_data:
+        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    return update_data
+
+
+def proyeccion_campos(fields: Optional[str], modelo) -> Optional[dict]:
+    """Proyección de Mongo para ?fields=a,b (None si no se piden); 400 si algún campo no existe en el modelo"""
+    if not fields:
+        return None
+    campos = {c.strip() for c in fields.split(",") if c.strip()}
+    permitidos = {c for c in modelo.model_fields if c != "id"}
+    desconocidos = campos - permitidos - {"_id", "id"}
+    if desconocidos:
+        raise HTTPException(status_code=400, detail=f"Campos no válidos: {', '.join(sorted(desconocidos))}")
+    # El _id se devuelve siempre
+    return {c: 1 for c in campos & permitidos} or {"_id": 1}
+
+
+def lista_ids(ids: Optional[str]) -> Optional[list]:
+    """Convierte ?ids=a,b,c en lista (None si no se piden ids)"""
+    if ids is None:
+        return None
+    return [i.strip() for i in ids.split(",") if i.strip()]
+
+
+def respuesta_parcial(documentos: list) -> JSONResponse:
+    """Devuelve documentos proyectados tal cual (con _id), sin validarlos contra el modelo completo"""
+    return JSONResponse(content=jsonable_encoder(documentos))
+
+
+def proyeccion_modelo(modelo) -> dict:
+    """Proyección con los campos del modelo de respuesta (más updated_at, que usa /api/sync)"""
+    return {**{c: 1 for c in modelo.model_fields if c != "id"}, "updated_at": 1}
+
+
+def _ordenar(documentos: list, orden) -> list:
+    """Ordena en memoria como lo haría Mongo con sort(orden) (los nulos primero en ascendente)"""
+    if isinstance(orden, str):
+        orden = [(orden, 1)]
+    for campo, sentido in reversed(orden):
+        documentos.sort(key=lambda d: (d.get(campo) is not None, d.get(campo)), reverse=sentido == -1)
+    return documentos
+
+
+async def en_paralelo(**consultas) -> dict:
+    """Lanza a la vez consultas independientes y devuelve sus resultados por nombre"""
+    resultados = await asyncio.gather(*consultas.values())
+    return dict(zip(consultas, resultados))
+
+
+class Repositorio:
+    """Acceso a una colección con proyección por defecto, 404 uniforme y métricas por operación"""
+
+    def __init__(self, nombre: str, coleccion, mensaje_no_encontrado: str, proyeccion: dict = None, archivo=None):
+        self.nombre = nombre
+        self.coleccion = coleccion
+        self.mensaje_no_encontrado = mensaje_no_encontrado
+        self.proyeccion = proyeccion
+        # Colección fría con los documentos archivados (solo se lee si se pide)
+        self.archivo = archivo
+
+    def _metrica(self, operacion: str):
+        """Cronómetro de la operación para las métricas del proceso"""
+        return metricas.cronometrar(f"repo.{self.nombre}.{operacion}")
+
+    async def _registrar_cambio(self, accion: str, id: str):
+        """Incrementa la versión de la colección y publica el evento del cambio"""
+        await versiones.incrementar(self.nombre)
+        bus_eventos.publicar_cambio(self.nombre, accion, id)
+
+    def _no_encontrado(self):
+        """Excepción 404 con el mensaje de la entidad"""
+        return HTTPException(status_code=404, detail=self.mensaje_no_encontrado)
+
+    async def buscar(self, id: str, proyeccion: dict = None, incluir_archivo: bool = False):
+        """Devuelve el documento (o el archivado, si se pide) o None"""
+        with self._metrica("buscar"):
+            documento = await self.coleccion.find_one({"_id": id}, proyeccion or self.proyeccion)
+            if documento is None and incluir_archivo and self.archivo is not None:
+                documento = await self.archivo.find_one({"_id": id}, proyeccion or self.proyeccion)
+            return documento
+
+    async def obtener(self, id: str, proyeccion: dict = None, incluir_archivo: bool = False) -> dict:
+        """Devuelve el documento o lanza 404"""
+        documento = await self.buscar(id, proyeccion, incluir_archivo)
+        if not documento:
+            raise self._no_encontrado()
+        return documento
+
+    async def existe(self, id: str) -> bool:
+        """Comprueba si existe el documento leyendo solo su _id"""
+        with self._metrica("existe"):
+            return await self.coleccion.find_one({"_id": id}, {"_id": 1}) is not None
+
+    async def comprobar_existe(self, id: str):
+        """Lanza 404 si el documento no existe (solo lee el _id)"""
+        if not await self.existe(id):
+            raise self._no_encontrado()
+
+    async def listar(
+        self, filtro: dict = None, proyeccion: dict = None, orden=None, limite: int = 1000,
+        incluir_archivo: bool = False
+    ) -> list:
+        """Lista los documentos del filtro (como mucho limite).
+
+        Con incluir_archivo se leen a la vez las dos colecciones y se mezclan
+        respetando el orden; sin orden, los archivados van detrás.
+        """
+        def consulta(coleccion):
+            cursor = coleccion.find(filtro or {}, proyeccion or self.proyeccion)
+            if orden:
+                cursor = cursor.sort(orden)
+            return cursor.to_list(limite)
+
+        with self._metrica("listar"):
+            if not (incluir_archivo and self.archivo is not None):
+                return await consulta(self.coleccion)
+            activos, archivados = await asyncio.gather(consulta(self.coleccion), consulta(self.archivo))
+            documentos = activos + archivados
+            if orden:
+                _ordenar(documentos, orden)
+            return documentos[:limite] if limite else documentos
+
+    async def obtener_muchos(self, ids, proyeccion: dict = None, incluir_archivo: bool = False) -> dict:
+        """Diccionario id -> documento para todos los ids, con una sola consulta $in
+        (y otra al archivo para los que falten, si se pide)"""
+        ids = list({i for i in ids if i})
+        if not ids:
+            return {}
+        with self._metrica("obtener_muchos"):
+            documentos = await self.coleccion.find(
+                {"_id": {"$in": ids}}, proyeccion or self.proyeccion
+            ).to_list(None)
+            faltan = set(ids) - {d["_id"] for d in documentos}
+            if faltan and incluir_archivo and self.archivo is not None:
+                documentos += await self.archivo.find(
+                    {"_id": {"$in": list(faltan)}}, proyeccion or self.proyeccion
+                ).to_list(None)
+        return {d["_id"]: d for d in documentos}
+
+    async def insertar(self, documento: dict) -> dict:
+        """Inserta el documento y lo devuelve"""
+        documento["updated_at"] = datetime.now(timezone.utc)
+        with self._metrica("insertar"):
+            await self.coleccion.insert_one(documento)
+        await self._registrar_cambio("creado", documento["_id"])
+        return documento
+
+    async def insertar_muchos(self, documentos: list) -> list:
+        """Inserta los documentos con un solo insert_many y los devuelve.
+
+        Si algún documento falla se propaga el BulkWriteError (con los
+        índices fallidos en writeErrors) tras registrar el cambio de los demás.
+        """
+        if not documentos:
+            return documentos
+        ahora = datetime.now(timezone.utc)
+        for documento in documentos:
+            documento["updated_at"] = ahora
+        try:
+            with self._metrica("insertar_muchos"):
+                await self.coleccion.insert_many(documentos, ordered=False)
+        except BulkWriteError as e:
+            # Sin orden, el resto de documentos sí se ha insertado
+            if e.details.get("nInserted"):
+                await versiones.incrementar(self.nombre)
+                bus_eventos.publicar_cambio(self.nombre, "importados")
+            raise
+        await versiones.incrementar(self.nombre)
+        bus_eventos.publicar_cambio(self.nombre, "importados")
+        return documentos
+
+    async def actualizar(self, id: str, cambios: dict, proyeccion: dict = None) -> dict:
+        """Aplica $set y devuelve el documento actualizado en un solo viaje; 404 si no existe"""
+        with self._metrica("actualizar"):
+            documento = await self.coleccion.find_one_and_update(
+                {"_id": id},
+                {"$set": {**cambios, "updated_at": datetime.now(timezone.utc)}},
+                projection=proyeccion or self.proyeccion,
+                return_document=ReturnDocument.AFTER
+            )
+        if not documento:
+            raise self._no_encontrado()
+        await self._registrar_cambio("actualizado", id)
+        return documento
+
+    async def eliminar(self, id: str):
+        """Elimina el documento y deja una marca en eliminados para la sincronización; 404 si no existe"""
+        with self._metrica("eliminar"):
+            resultado = await self.coleccion.delete_one({"_id": id})
+        if resultado.deleted_count == 0:
+            raise self._no_encontrado()
+        await self.marcar_eliminados([id])
+        await self._registrar_cambio("eliminado", id)
+
+    async def marcar_eliminados(self, ids: list):
+        """Deja una marca en eliminados por cada id para que /api/sync los notifique"""
+        ahora = datetime.now(timezone.utc)
+        for i in range(0, len(ids), 1000):
+            await eliminados_collection.bulk_write([
+                UpdateOne(
+                    {"_id": f"{self.nombre}:{id}"},
+                    {"$set": {"coleccion": self.nombre, "documento_id": id, "updated_at": ahora}},
+                    upsert=True
+                )
+                for id in ids[i:i + 1000]
+            ], ordered=False)
+
+    async def quitar_marcas_eliminados(self, ids: list):
+        """Borra las marcas de eliminados (al restaurar documentos)"""
+        await eliminados_collection.delete_many({"_id": {"$in": [f"{self.nombre}:{id}" for id in ids]}})
+
+
+usuarios_repo = Repositorio("usuarios", usuarios_collection, "Usuario no encontrado", proyeccion={"contraseña_hash": 0})
+pisos_repo = Repositorio("pisos", pisos_collection, "Piso no encontrado", proyeccion=proyeccion_modelo(Piso))
+habitaciones_repo = Repositorio(
+    "habitaciones", habitaciones_collection, "Habitación no encontrada", proyeccion=proyeccion_modelo(Habitacion)
+)
+inquilinos_repo = Repositorio(
+    "inquilinos", inquilinos_collection, "Inquilino no encontrado", proyeccion=proyeccion_modelo(Inquilino)
+)
+contratos_repo = Repositorio(
+    "contratos", contratos_collection, "Contrato no encontrado",
+    proyeccion=proyeccion_modelo(Contrato), archivo=contratos_archivo_collection
+)
+pagos_repo = Repositorio(
+    "pagos", pagos_collection, "Pago no encontrado", proyeccion=proyeccion_modelo(Pago), archivo=pagos_archivo_collection
+)
+gastos_repo = Repositorio(
+    "gastos", gastos_collection, "Gasto no encontrado", proyeccion=proyeccion_modelo(Gasto), archivo=gastos_archivo_collection
+)
@@ -1,12 +1,18 @@
-from fastapi import FastAPI, HTTPException, Depends, status, Query
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Path, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, FileResponse, Response
+from starlette.background import BackgroundTask
 from contextlib import asynccontextmanager
+from collections import Counter
+import asyncio
+import csv
 import os
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from bson import ObjectId
 from typing import List, Optional
 from pydantic import BaseModel
 from typing import Literal
+from pymongo import ReturnDocument
 
 from models import (
     Usuario, UsuarioCreate, UsuarioUpdate,
@@ -16,18 +22,49 @@ from models import (
     Contrato, ContratoCreate, ContratoUpdate,
     Pago, PagoCreate, PagoUpdate,
     Gasto, GastoCreate, GastoUpdate,
+    Aviso, AvisoCreate,
     Ajustes, AjustesUpdate,
+    Lote, RespuestaLote,
     LoginRequest, LoginResponse
 )
 from auth import (
-    crear_access_token, verificar_contraseña, obtener_hash_contraseña,
-    obtener_usuario_actual, verificar_rol
+    ACCESS_TOKEN_EXPIRE_MINUTES, crear_access_token, verificar_contraseña, obtener_hash_contraseña,
+    obtener_usuario_actual, obtener_usuario_cabecera_o_ticket, verificar_rol
 )
 from database import (
-    usuarios_collection, pisos_collection, habitaciones_collection,
+    usuarios_collection, habitaciones_collection,
     inquilinos_collection, contratos_collection, pagos_collection,
-    gastos_collection, ajustes_collection, cerrar_conexion
+    ajustes_collection, avisos_collection, crear_indices, cerrar_conexion
 )
+from exportacion import (
+    COLUMNAS_PAGOS, COLUMNAS_CONTRATOS, COLUMNAS_MOROSIDAD,
+    filas_pagos, filas_contratos, filas_morosidad, stream_csv, generar_xlsx
+)
+from fianzas import liquidar_fianzas
+from programador import programador
+from tareas import transicionar_contratos, detectar_atrasos, notificar_cambio_ocupacion
+from notificaciones import despachador, encolar_avisos_pagos
+from recursos import TAMANO_MAXIMO_SUBIDA, guardar_imagen, logo_a_recurso, abrir_recurso, leer_por_trozos
+from configuracion import ajustes_cache
+from bootstrap import obtener_bootstrap
+from sincronizacion import sincronizar
+from lotes import MAXIMO_PETICIONES, ejecutar_lote
+from disponibilidad import calcular_disponibilidad
+from fechas import sin_zona
+from analitica import ocupacion_e_ingresos, proyeccion_rentas, morosidad
+from cobros import lista_cobros, mes_valido
+from archivo import archivar_contratos, restaurar_contrato
+from importacion import importar_csv
+from sesiones import registro_sesiones, DURACION_TICKET
+from limitador import limitador_login, ip_cliente
+from coalescencia import coalescedor, clave_peticion
+from migraciones import migrador, ejecutar_migraciones, estado_migraciones
+from eventos import bus_eventos, DifusorDashboard, formatear_sse
+from repositorios import (
+    datos_actualizacion, proyeccion_campos, lista_ids, respuesta_parcial, en_paralelo, usuarios_repo, pisos_repo, habitaciones_repo,
+    inquilinos_repo, contratos_repo, pagos_repo, gastos_repo
+)
+import metricas
 
 # Inicialización de datos
 async def inicializar_datos():
@@ -54,7 +91,8 @@ async def inicializar_datos():
             "datos_empresa": {},
             "smtp_config": {},
             "dia_cobro_por_defecto": 5,
-            "gastos_mensuales_tarifa_defecto": 50.0
+            "gastos_mensuales_tarifa_defecto": 50.0,
+            "version": 0
         }
         await ajustes_collection.insert_one(ajustes_defecto)
         print("✓ Ajustes por defecto creados")
@@ -62,9 +100,32 @@ async def inicializar_datos():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
+    await crear_indices()
     await inicializar_datos()
+    await ajustes_cache.cargar()
+    ajustes_cache.iniciar()
+    await registro_sesiones.cargar()
+    registro_sesiones.iniciar()
+    programador.registrar("transiciones_contratos", transicionar_contratos, 300)
+    programador.registrar("deteccion_atrasos", detectar_atrasos, 3600)
+    programador.registrar("archivado", archivar_contratos, 86400)
+    if os.environ.get("PROGRAMADOR_ACTIVO", "1") == "1":
+        programador.iniciar()
+    if os.environ.get("AVISOS_ACTIVO", "1") == "1":
+        despachador.iniciar()
+    if os.environ.get("MIGRACIONES_ACTIVO", "1") == "1":
+        migrador.iniciar()
+    bus_eventos.iniciar()
+    difusor_dashboard.iniciar()
     yield
     # Shutdown
+    await migrador.detener()
+    await difusor_dashboard.detener()
+    await bus_eventos.detener()
+    await despachador.detener()
+    await programador.detener()
+    await ajustes_cache.detener()
+    await registro_sesiones.detener()
     await cerrar_conexion()
 
 app = FastAPI(title="Sistema de Gestión de Alquileres", lifespan=lifespan)
@@ -92,26 +153,35 @@ app.add_middleware(
 
 # ============= AUTH =============
 @app.post("/api/auth/login", response_model=LoginResponse)
-async def login(datos: LoginRequest):
+async def login(datos: LoginRequest, request: Request):
     """Login de usuario"""
+    # Control de admisión antes de consultar Mongo o verificar con bcrypt
+    email = datos.email.strip().lower()
+    await limitador_login.admitir(ip_cliente(request), email)
+
     usuario_db = await usuarios_collection.find_one({"email": datos.email}, {"_id": 1, "nombre": 1, "email": 1, "whatsapp": 1, "rol": 1, "activo": 1, "contraseña_hash": 1})
     
     if not usuario_db:
+        await limitador_login.fallo(email)
         raise HTTPException(status_code=401, detail="Email o contraseña incorrectos")
     
     if not usuario_db.get("activo"):
         raise HTTPException(status_code=403, detail="Usuario inactivo")
     
     if not verificar_contraseña(datos.contraseña, usuario_db["contraseña_hash"]):
+        await limitador_login.fallo(email)
         raise HTTPException(status_code=401, detail="Email o contraseña incorrectos")
     
-    # Crear token
+    await limitador_login.exito(email)
+    # Crear token con su sesión (jti) para poder revocarlo
+    duracion = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     token_data = {
         "sub": usuario_db["_id"],
         "email": usuario_db["email"],
-        "rol": usuario_db["rol"]
+        "rol": usuario_db["rol"],
+        "jti": await registro_sesiones.crear(usuario_db["_id"], datetime.now(timezone.utc) + duracion)
     }
-    access_token = crear_access_token(token_data)
+    access_token = crear_access_token(token_data, duracion)
     
     # Preparar usuario sin contraseña
     del usuario_db["contraseña_hash"]
@@ -121,19 +191,52 @@ async def login(datos: LoginRequest):
         usuario=Usuario(**usuario_db)
     )
 
+@app.post("/api/auth/logout")
+async def logout(usuario_actual: dict = Depends(obtener_usuario_actual)):
+    """Cierra la sesión: el token deja de ser válido en todos los workers"""
+    if usuario_actual.get("jti"):
+        await registro_sesiones.revocar(usuario_actual["jti"])
+    return {"mensaje": "Sesión cerrada"}
+
 @app.get("/api/auth/me", response_model=Usuario)
 async def obtener_perfil(usuario_actual: dict = Depends(obtener_usuario_actual)):
-    """Obtiene el perfil del usuario actual"""
-    usuario_db = await usuarios_collection.find_one({"_id": usuario_actual["sub"]}, {"_id": 1, "nombre": 1, "email": 1, "whatsapp": 1, "rol": 1, "activo": 1})
+    """Obtiene el perfil del usuario actual (en caché)"""
+    usuario_db = await registro_sesiones.perfil(usuario_actual["sub"])
     if not usuario_db:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     return Usuario(**usuario_db)
 
+# ============= BOOTSTRAP =============
+@app.get("/api/bootstrap")
+async def bootstrap(
+    desde: Optional[str] = Query(None, description="Token de versión de una respuesta anterior"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
+    """Pisos, habitaciones, inquilinos y contratos indexados por id en una sola llamada"""
+    return await obtener_bootstrap(desde)
+
+# ============= SINCRONIZACIÓN =============
+@app.get("/api/sync")
+async def sync(
+    since: Optional[str] = Query(None, description="Token devuelto por la sincronización anterior"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
+    """Pisos, habitaciones, inquilinos, contratos y pagos modificados o eliminados desde el token"""
+    return await sincronizar(since)
+
+# ============= LOTES =============
+@app.post("/api/batch", response_model=List[RespuestaLote])
+async def batch(datos: Lote, request: Request, usuario_actual: dict = Depends(obtener_usuario_actual)):
+    """Ejecuta varias peticiones a la API en una sola llamada (lecturas en paralelo, escrituras en orden)"""
+    if len(datos.peticiones) > MAXIMO_PETICIONES:
+        raise HTTPException(status_code=400, detail=f"Demasiadas peticiones en el lote (máximo {MAXIMO_PETICIONES})")
+    return await ejecutar_lote(request.app, usuario_actual, datos.peticiones, request.scope.get("client"))
+
 # ============= USUARIOS (solo admin) =============
 @app.get("/api/usuarios", response_model=List[Usuario])
 async def listar_usuarios(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
     """Lista todos los usuarios"""
-    usuarios = await usuarios_collection.find({}, {"contraseña_hash": 0}).to_list(1000)
+    usuarios = await usuarios_repo.listar()
     return [Usuario(**u) for u in usuarios]
 
 @app.post("/api/usuarios", response_model=Usuario, status_code=status.HTTP_201_CREATED)
@@ -149,39 +252,31 @@ async def crear_usuario(datos: UsuarioCreate, usuario_actual: dict = Depends(ver
     usuario_dict["contraseña_hash"] = obtener_hash_contraseña(contraseña)
     usuario_dict["_id"] = str(ObjectId())
     
-    await usuarios_collection.insert_one(usuario_dict)
+    await usuarios_repo.insertar(usuario_dict)
     del usuario_dict["contraseña_hash"]
     return Usuario(**usuario_dict)
 
 @app.get("/api/usuarios/{usuario_id}", response_model=Usuario)
 async def obtener_usuario(usuario_id: str, usuario_actual: dict = Depends(verificar_rol(["admin"]))):
     """Obtiene un usuario por ID"""
-    usuario = await usuarios_collection.find_one({"_id": usuario_id}, {"contraseña_hash": 0})
-    if not usuario:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    usuario = await usuarios_repo.obtener(usuario_id)
     return Usuario(**usuario)
 
 @app.put("/api/usuarios/{usuario_id}", response_model=Usuario)
 async def actualizar_usuario(usuario_id: str, datos: UsuarioUpdate, usuario_actual: dict = Depends(verificar_rol(["admin"]))):
     """Actualiza un usuario"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
+    update_data = datos_actualizacion(datos)
     
     if "contraseña" in update_data:
         contraseña = update_data.pop("contraseña")
         update_data["contraseña_hash"] = obtener_hash_contraseña(contraseña)
     
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
-    
-    resultado = await usuarios_collection.update_one(
-        {"_id": usuario_id},
-        {"$set": update_data}
-    )
-    
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    
-    usuario = await usuarios_collection.find_one({"_id": usuario_id}, {"contraseña_hash": 0})
+    usuario = await usuarios_repo.actualizar(usuario_id, update_data)
+    # Desactivar, cambiar el rol o la contraseña cierra las sesiones abiertas
+    if update_data.get("activo") is False or "rol" in update_data or "contraseña_hash" in update_data:
+        await registro_sesiones.revocar_usuario(usuario_id)
+    else:
+        registro_sesiones.invalidar_perfil(usuario_id)
     return Usuario(**usuario)
 
 @app.delete("/api/usuarios/{usuario_id}")
@@ -190,75 +285,64 @@ async def eliminar_usuario(usuario_id: str, usuario_actual: dict = Depends(verif
     if usuario_id == usuario_actual["sub"]:
         raise HTTPException(status_code=400, detail="No puedes eliminar tu propio usuario")
     
-    resultado = await usuarios_collection.delete_one({"_id": usuario_id})
-    if resultado.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    await usuarios_repo.eliminar(usuario_id)
+    await registro_sesiones.revocar_usuario(usuario_id)
     return {"mensaje": "Usuario eliminado correctamente"}
 
 # ============= PISOS =============
 @app.get("/api/pisos", response_model=List[Piso])
-async def listar_pisos(usuario_actual: dict = Depends(obtener_usuario_actual)):
+async def listar_pisos(
+    fields: Optional[str] = Query(None, description="Campos a devolver separados por comas"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
     """Lista todos los pisos"""
-    pisos = await pisos_collection.find({}).to_list(1000)
+    proyeccion = proyeccion_campos(fields, Piso)
+    pisos = await pisos_repo.listar(proyeccion=proyeccion)
+    if proyeccion:
+        return respuesta_parcial(pisos)
     return [Piso(**p) for p in pisos]
 
 @app.get("/api/pisos/con-conteo")
 async def listar_pisos_con_conteo(usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Lista todos los pisos con conteo de habitaciones"""
-    pisos = await pisos_collection.find({}).to_list(1000)
+    # Tres consultas en total, sea cual sea el número de pisos
+    datos = await en_paralelo(
+        pisos=pisos_repo.listar(),
+        habitaciones=habitaciones_repo.listar({}, {"piso_id": 1}, limite=None),
+        ocupadas=contratos_collection.distinct("habitacion_id", {"estado": "activo"})
+    )
+    ocupadas = set(datos["ocupadas"])
+    total_por_piso = Counter(h["piso_id"] for h in datos["habitaciones"])
+    ocupadas_por_piso = Counter(h["piso_id"] for h in datos["habitaciones"] if h["_id"] in ocupadas)
     
-    resultado = []
-    for piso in pisos:
-        total_habitaciones = await habitaciones_collection.count_documents({"piso_id": piso["_id"]})
-        
-        # Contar habitaciones ocupadas
-        habitaciones = await habitaciones_collection.find({"piso_id": piso["_id"]}).to_list(1000)
-        habitaciones_ocupadas = 0
-        for habitacion in habitaciones:
-            contrato_activo = await contratos_collection.find_one({
-                "habitacion_id": habitacion["_id"],
-                "estado": "activo"
-            })
-            if contrato_activo:
-                habitaciones_ocupadas += 1
-        
-        resultado.append({
+    return [
+        {
             "piso": piso,
-            "total_habitaciones": total_habitaciones,
-            "habitaciones_ocupadas": habitaciones_ocupadas,
-            "habitaciones_libres": total_habitaciones - habitaciones_ocupadas
-        })
-    
-    return resultado
+            "total_habitaciones": total_por_piso[piso["_id"]],
+            "habitaciones_ocupadas": ocupadas_por_piso[piso["_id"]],
+            "habitaciones_libres": total_por_piso[piso["_id"]] - ocupadas_por_piso[piso["_id"]]
+        }
+        for piso in datos["pisos"]
+    ]
 
 @app.post("/api/pisos", response_model=Piso, status_code=status.HTTP_201_CREATED)
 async def crear_piso(datos: PisoCreate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Crea un nuevo piso"""
     piso_dict = datos.model_dump()
     piso_dict["_id"] = str(ObjectId())
-    await pisos_collection.insert_one(piso_dict)
+    await pisos_repo.insertar(piso_dict)
     return Piso(**piso_dict)
 
 @app.get("/api/pisos/{piso_id}", response_model=Piso)
 async def obtener_piso(piso_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Obtiene un piso por ID"""
-    piso = await pisos_collection.find_one({"_id": piso_id})
-    if not piso:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
+    piso = await pisos_repo.obtener(piso_id)
     return Piso(**piso)
 
 @app.put("/api/pisos/{piso_id}", response_model=Piso)
 async def actualizar_piso(piso_id: str, datos: PisoUpdate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Actualiza un piso"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
-    
-    resultado = await pisos_collection.update_one({"_id": piso_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
-    
-    piso = await pisos_collection.find_one({"_id": piso_id})
+    piso = await pisos_repo.actualizar(piso_id, datos_actualizacion(datos))
     return Piso(**piso)
 
 @app.delete("/api/pisos/{piso_id}")
@@ -269,40 +353,42 @@ async def eliminar_piso(piso_id: str, usuario_actual: dict = Depends(verificar_r
     if habitaciones:
         raise HTTPException(status_code=400, detail="No se puede eliminar un piso con habitaciones")
     
-    resultado = await pisos_collection.delete_one({"_id": piso_id})
-    if resultado.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
+    await pisos_repo.eliminar(piso_id)
     return {"mensaje": "Piso eliminado correctamente"}
 
 @app.get("/api/pisos/{piso_id}/habitaciones")
 async def listar_habitaciones_piso(piso_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Lista todas las habitaciones de un piso específico con estado de ocupación"""
     # Verificar que el piso existe
-    piso = await pisos_collection.find_one({"_id": piso_id})
-    if not piso:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
+    datos = await en_paralelo(
+        piso=pisos_repo.comprobar_existe(piso_id),
+        habitaciones=habitaciones_repo.listar({"piso_id": piso_id})
+    )
+    habitaciones = datos["habitaciones"]
     
-    habitaciones = await habitaciones_collection.find({"piso_id": piso_id}).to_list(1000)
+    # Contratos activos e inquilinos de todas las habitaciones con una consulta $in cada uno
+    contratos = await contratos_repo.listar(
+        {"habitacion_id": {"$in": [h["_id"] for h in habitaciones]}, "estado": "activo"},
+        {"habitacion_id": 1, "inquilino_id": 1},
+        limite=None
+    )
+    contrato_por_habitacion = {c["habitacion_id"]: c for c in contratos}
+    inquilinos = await inquilinos_repo.obtener_muchos(
+        (c["inquilino_id"] for c in contratos), {"nombre": 1, "email": 1, "telefono": 1}
+    )
     
-    # Enriquecer con estado de ocupación
     resultado = []
     for habitacion in habitaciones:
-        # Buscar contrato activo
-        contrato_activo = await contratos_collection.find_one({
-            "habitacion_id": habitacion["_id"],
-            "estado": "activo"
-        })
-        
+        contrato_activo = contrato_por_habitacion.get(habitacion["_id"])
+        inquilino = inquilinos.get(contrato_activo["inquilino_id"]) if contrato_activo else None
         inquilino_actual = None
-        if contrato_activo:
-            inquilino = await inquilinos_collection.find_one({"_id": contrato_activo["inquilino_id"]})
-            if inquilino:
-                inquilino_actual = {
-                    "id": inquilino["_id"],
-                    "nombre": inquilino["nombre"],
-                    "email": inquilino["email"],
-                    "telefono": inquilino["telefono"]
-                }
+        if inquilino:
+            inquilino_actual = {
+                "id": inquilino["_id"],
+                "nombre": inquilino["nombre"],
+                "email": inquilino["email"],
+                "telefono": inquilino["telefono"]
+            }
         
         resultado.append({
             "habitacion": Habitacion(**habitacion),
@@ -316,23 +402,19 @@ async def listar_habitaciones_piso(piso_id: str, usuario_actual: dict = Depends(
 @app.get("/api/pisos/{piso_id}/detalle")
 async def obtener_detalle_piso(piso_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Obtiene el detalle completo de un piso con sus habitaciones y estadísticas"""
-    piso = await pisos_collection.find_one({"_id": piso_id})
-    if not piso:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
-    
-    # Obtener todas las habitaciones del piso
-    habitaciones = await habitaciones_collection.find({"piso_id": piso_id}).to_list(1000)
-    total_habitaciones = len(habitaciones)
+    datos = await en_paralelo(
+        piso=pisos_repo.obtener(piso_id),
+        habitaciones=habitaciones_repo.listar({"piso_id": piso_id}, {"_id": 1}, limite=None)
+    )
+    piso = datos["piso"]
+    total_habitaciones = len(datos["habitaciones"])
     
-    # Contar habitaciones ocupadas
-    habitaciones_ocupadas = 0
-    for habitacion in habitaciones:
-        contrato_activo = await contratos_collection.find_one({
-            "habitacion_id": habitacion["_id"],
-            "estado": "activo"
-        })
-        if contrato_activo:
-            habitaciones_ocupadas += 1
+    # Habitaciones ocupadas: las que tienen algún contrato activo (una sola consulta)
+    ocupadas = await contratos_collection.distinct("habitacion_id", {
+        "habitacion_id": {"$in": [h["_id"] for h in datos["habitaciones"]]},
+        "estado": "activo"
+    })
+    habitaciones_ocupadas = len(ocupadas)
     
     return {
         "piso": Piso(**piso),
@@ -345,90 +427,87 @@ async def obtener_detalle_piso(piso_id: str, usuario_actual: dict = Depends(obte
 @app.get("/api/habitaciones", response_model=List[Habitacion])
 async def listar_habitaciones(
     piso_id: Optional[str] = Query(None),
+    ids: Optional[str] = Query(None, description="IDs separados por comas"),
+    fields: Optional[str] = Query(None, description="Campos a devolver separados por comas"),
     usuario_actual: dict = Depends(obtener_usuario_actual)
 ):
-    """Lista todas las habitaciones o filtra por piso"""
+    """Lista todas las habitaciones o filtra por piso o por IDs"""
     filtro = {"piso_id": piso_id} if piso_id else {}
-    habitaciones = await habitaciones_collection.find(filtro).to_list(1000)
+    ids = lista_ids(ids)
+    if ids is not None:
+        filtro["_id"] = {"$in": ids}
+    proyeccion = proyeccion_campos(fields, Habitacion)
+    habitaciones = await habitaciones_repo.listar(filtro, proyeccion)
+    if proyeccion:
+        return respuesta_parcial(habitaciones)
     return [Habitacion(**h) for h in habitaciones]
 
 @app.post("/api/habitaciones", response_model=Habitacion, status_code=status.HTTP_201_CREATED)
 async def crear_habitacion(datos: HabitacionCreate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Crea una nueva habitación"""
     # Verificar que el piso existe
-    piso = await pisos_collection.find_one({"_id": datos.piso_id})
-    if not piso:
-        raise HTTPException(status_code=404, detail="Piso no encontrado")
+    await pisos_repo.comprobar_existe(datos.piso_id)
     
     habitacion_dict = datos.model_dump()
     habitacion_dict["_id"] = str(ObjectId())
-    await habitaciones_collection.insert_one(habitacion_dict)
+    await habitaciones_repo.insertar(habitacion_dict)
     return Habitacion(**habitacion_dict)
 
 @app.get("/api/habitaciones/{habitacion_id}", response_model=Habitacion)
 async def obtener_habitacion(habitacion_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Obtiene una habitación por ID"""
-    habitacion = await habitaciones_collection.find_one({"_id": habitacion_id})
-    if not habitacion:
-        raise HTTPException(status_code=404, detail="Habitación no encontrada")
+    habitacion = await habitaciones_repo.obtener(habitacion_id)
     return Habitacion(**habitacion)
 
 @app.put("/api/habitaciones/{habitacion_id}", response_model=Habitacion)
 async def actualizar_habitacion(habitacion_id: str, datos: HabitacionUpdate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Actualiza una habitación"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
-    
-    resultado = await habitaciones_collection.update_one({"_id": habitacion_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Habitación no encontrada")
-    
-    habitacion = await habitaciones_collection.find_one({"_id": habitacion_id})
+    habitacion = await habitaciones_repo.actualizar(habitacion_id, datos_actualizacion(datos))
     return Habitacion(**habitacion)
 
 @app.delete("/api/habitaciones/{habitacion_id}")
 async def eliminar_habitacion(habitacion_id: str, usuario_actual: dict = Depends(verificar_rol(["admin"]))):
     """Elimina una habitación"""
-    # Verificar que no tenga contratos
-    contratos = await contratos_collection.find_one({"habitacion_id": habitacion_id})
+    # Verificar que no tenga contratos (tampoco archivados, que siguen apuntando a ella)
+    contratos = await contratos_repo.listar({"habitacion_id": habitacion_id}, {"_id": 1}, limite=1, incluir_archivo=True)
     if contratos:
         raise HTTPException(status_code=400, detail="No se puede eliminar una habitación con contratos")
     
-    resultado = await habitaciones_collection.delete_one({"_id": habitacion_id})
-    if resultado.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Habitación no encontrada")
+    await habitaciones_repo.eliminar(habitacion_id)
     return {"mensaje": "Habitación eliminada correctamente"}
 
 @app.get("/api/habitaciones/{habitacion_id}/detalle")
-async def obtener_detalle_habitacion(habitacion_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
+async def obtener_detalle_habitacion(
+    habitacion_id: str,
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
     """Obtiene el detalle completo de una habitación con contrato actual e historial"""
-    habitacion = await habitaciones_collection.find_one({"_id": habitacion_id})
-    if not habitacion:
-        raise HTTPException(status_code=404, detail="Habitación no encontrada")
-    
-    piso = await pisos_collection.find_one({"_id": habitacion["piso_id"]})
-    
-    # Buscar contrato activo
-    contrato_activo = await contratos_collection.find_one({
-        "habitacion_id": habitacion_id,
-        "estado": "activo"
-    })
+    # La habitación y su historial de contratos no dependen entre sí
+    datos = await en_paralelo(
+        habitacion=habitaciones_repo.obtener(habitacion_id),
+        historial=contratos_repo.listar(
+            {"habitacion_id": habitacion_id}, orden=[("fecha_inicio", -1)], incluir_archivo=incluir_archivo
+        )
+    )
+    habitacion = datos["habitacion"]
+    contratos_historial = sorted(datos["historial"], key=lambda c: c["fecha_inicio"], reverse=True)
+    contrato_activo = next((c for c in contratos_historial if c["estado"] == "activo"), None)
+    
+    # Piso e inquilinos de todo el historial (una consulta $in)
+    datos = await en_paralelo(
+        piso=pisos_repo.buscar(habitacion["piso_id"]),
+        inquilinos=inquilinos_repo.obtener_muchos(c["inquilino_id"] for c in contratos_historial)
+    )
+    piso, inquilinos = datos["piso"], datos["inquilinos"]
     
     inquilino_actual = None
-    if contrato_activo:
-        inquilino = await inquilinos_collection.find_one({"_id": contrato_activo["inquilino_id"]})
-        if inquilino:
-            inquilino_actual = Inquilino(**inquilino)
-    
-    # Obtener historial de contratos
-    contratos_historial = await contratos_collection.find({
-        "habitacion_id": habitacion_id
-    }).sort("fecha_inicio", -1).to_list(1000)
+    if contrato_activo and contrato_activo["inquilino_id"] in inquilinos:
+        inquilino_actual = Inquilino(**inquilinos[contrato_activo["inquilino_id"]])
     
     historial = []
     for contrato in contratos_historial:
-        inquilino = await inquilinos_collection.find_one({"_id": contrato["inquilino_id"]})
+        inquilino = inquilinos.get(contrato["inquilino_id"])
         historial.append({
             "contrato": Contrato(**contrato),
             "inquilino": Inquilino(**inquilino) if inquilino else None
@@ -442,15 +521,35 @@ async def obtener_detalle_habitacion(habitacion_id: str, usuario_actual: dict =
         "historial_contratos": historial
     }
 
+# ============= DISPONIBILIDAD =============
+@app.get("/api/disponibilidad")
+async def obtener_disponibilidad(
+    desde: datetime = Query(...),
+    hasta: datetime = Query(...),
+    piso_id: Optional[str] = Query(None),
+    dias_minimos: int = Query(1, ge=1, description="Duración mínima de las ventanas libres"),
+    calendario: bool = Query(False, description="Incluir el calendario de ocupación por habitación"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
+    """Habitaciones libres entre dos fechas con sus ventanas libres y precio"""
+    if hasta <= desde:
+        raise HTTPException(status_code=400, detail="La fecha hasta debe ser posterior a desde")
+    return await calcular_disponibilidad(desde, hasta, piso_id, dias_minimos, calendario)
+
 # ============= INQUILINOS =============
 @app.get("/api/inquilinos", response_model=List[Inquilino])
 async def listar_inquilinos(
     busqueda: Optional[str] = Query(None),
     activo: Optional[bool] = Query(None),
+    ids: Optional[str] = Query(None, description="IDs separados por comas"),
+    fields: Optional[str] = Query(None, description="Campos a devolver separados por comas"),
     usuario_actual: dict = Depends(obtener_usuario_actual)
 ):
     """Lista todos los inquilinos con búsqueda opcional"""
     filtro = {}
+    ids = lista_ids(ids)
+    if ids is not None:
+        filtro["_id"] = {"$in": ids}
     if activo is not None:
         filtro["activo"] = activo
     if busqueda:
@@ -461,7 +560,10 @@ async def listar_inquilinos(
             {"dni": {"$regex": busqueda, "$options": "i"}}
         ]
     
-    inquilinos = await inquilinos_collection.find(filtro).to_list(1000)
+    proyeccion = proyeccion_campos(fields, Inquilino)
+    inquilinos = await inquilinos_repo.listar(filtro, proyeccion)
+    if proyeccion:
+        return respuesta_parcial(inquilinos)
     return [Inquilino(**i) for i in inquilinos]
 
 @app.post("/api/inquilinos", response_model=Inquilino, status_code=status.HTTP_201_CREATED)
@@ -474,29 +576,19 @@ async def crear_inquilino(datos: InquilinoCreate, usuario_actual: dict = Depends
     
     inquilino_dict = datos.model_dump()
     inquilino_dict["_id"] = str(ObjectId())
-    await inquilinos_collection.insert_one(inquilino_dict)
+    await inquilinos_repo.insertar(inquilino_dict)
     return Inquilino(**inquilino_dict)
 
 @app.get("/api/inquilinos/{inquilino_id}", response_model=Inquilino)
 async def obtener_inquilino(inquilino_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Obtiene un inquilino por ID"""
-    inquilino = await inquilinos_collection.find_one({"_id": inquilino_id})
-    if not inquilino:
-        raise HTTPException(status_code=404, detail="Inquilino no encontrado")
+    inquilino = await inquilinos_repo.obtener(inquilino_id)
     return Inquilino(**inquilino)
 
 @app.put("/api/inquilinos/{inquilino_id}", response_model=Inquilino)
 async def actualizar_inquilino(inquilino_id: str, datos: InquilinoUpdate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Actualiza un inquilino"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
-    
-    resultado = await inquilinos_collection.update_one({"_id": inquilino_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Inquilino no encontrado")
-    
-    inquilino = await inquilinos_collection.find_one({"_id": inquilino_id})
+    inquilino = await inquilinos_repo.actualizar(inquilino_id, datos_actualizacion(datos))
     return Inquilino(**inquilino)
 
 # ============= CONTRATOS =============
@@ -506,13 +598,19 @@ async def listar_contratos(
     habitacion_id: Optional[str] = Query(None),
     inquilino_id: Optional[str] = Query(None),
     estado: Optional[str] = Query(None),
+    ids: Optional[str] = Query(None, description="IDs separados por comas"),
+    fields: Optional[str] = Query(None, description="Campos a devolver separados por comas"),
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
     usuario_actual: dict = Depends(obtener_usuario_actual)
 ):
     """Lista todos los contratos con filtros opcionales"""
     filtro = {}
+    ids = lista_ids(ids)
+    if ids is not None:
+        filtro["_id"] = {"$in": ids}
     if piso_id:
         # Obtener habitaciones del piso
-        habitaciones = await habitaciones_collection.find({"piso_id": piso_id}).to_list(1000)
+        habitaciones = await habitaciones_repo.listar({"piso_id": piso_id}, {"_id": 1})
         habitaciones_ids = [h["_id"] for h in habitaciones]
         filtro["habitacion_id"] = {"$in": habitaciones_ids}
     if habitacion_id:
@@ -522,7 +620,10 @@ async def listar_contratos(
     if estado:
         filtro["estado"] = estado
     
-    contratos = await contratos_collection.find(filtro).to_list(1000)
+    proyeccion = proyeccion_campos(fields, Contrato)
+    contratos = await contratos_repo.listar(filtro, proyeccion, incluir_archivo=incluir_archivo)
+    if proyeccion:
+        return respuesta_parcial(contratos)
     return [Contrato(**c) for c in contratos]
 
 @app.post("/api/contratos", response_model=Contrato, status_code=status.HTTP_201_CREATED)
@@ -534,13 +635,8 @@ async def crear_contrato(datos: ContratoCreate, usuario_actual: dict = Depends(v
         raise HTTPException(status_code=400, detail="La fecha de inicio debe ser anterior a la fecha fin")
 
     # 1) Verificar que habitación e inquilino existen
-    habitacion = await habitaciones_collection.find_one({"_id": datos.habitacion_id})
-    if not habitacion:
-        raise HTTPException(status_code=404, detail="Habitación no encontrada")
-
-    inquilino = await inquilinos_collection.find_one({"_id": datos.inquilino_id})
-    if not inquilino:
-        raise HTTPException(status_code=404, detail="Inquilino no encontrado")
+    await habitaciones_repo.comprobar_existe(datos.habitacion_id)
+    await inquilinos_repo.comprobar_existe(datos.inquilino_id)
 
     # 2) Validar día de pago (1–31) (si no llega, por defecto es 1)
     dia_pago = getattr(datos, "dia_pago", 1)
@@ -576,15 +672,18 @@ async def crear_contrato(datos: ContratoCreate, usuario_actual: dict = Depends(v
         "fecha_liquidacion": None
     }
 
-    await contratos_collection.insert_one(contrato_dict)
+    await contratos_repo.insertar(contrato_dict)
+    notificar_cambio_ocupacion([contrato_dict["habitacion_id"]])
     return Contrato(**contrato_dict)
 
 @app.get("/api/contratos/{contrato_id}", response_model=Contrato)
-async def obtener_contrato(contrato_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
+async def obtener_contrato(
+    contrato_id: str,
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
     """Obtiene un contrato por ID"""
-    contrato = await contratos_collection.find_one({"_id": contrato_id})
-    if not contrato:
-        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    contrato = await contratos_repo.obtener(contrato_id, incluir_archivo=incluir_archivo)
     return Contrato(**contrato)
     
 
@@ -596,14 +695,12 @@ async def actualizar_contrato(
 ):
     """Actualiza un contrato"""
     # 1) Buscar el contrato actual
-    contrato_actual = await contratos_collection.find_one({"_id": contrato_id})
-    if not contrato_actual:
-        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    contrato_actual = await contratos_repo.obtener(
+        contrato_id, {"habitacion_id": 1, "fecha_inicio": 1, "fecha_fin": 1, "estado": 1}
+    )
 
     # 2) Datos que llegan para actualizar
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    update_data = datos_actualizacion(datos)
 
     # 3) Validar día de pago si lo envían
     if "dia_pago" in update_data:
@@ -634,29 +731,39 @@ async def actualizar_contrato(
                 detail="Ya existe un contrato en esa habitación que se solapa con esas fechas"
             )
 
-    # 6) Hacer update en BD
-    resultado = await contratos_collection.update_one({"_id": contrato_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    # Finalizar antes de fecha_fin: se guarda cuándo, para que la ocupación y las cuotas acaben ahí
+    if update_data.get("estado") == "finalizado" and contrato_actual["estado"] != "finalizado":
+        ahora = datetime.now(timezone.utc)
+        if sin_zona(nueva_fecha_fin) >= sin_zona(ahora):
+            update_data["fecha_finalizacion"] = ahora
+    elif update_data.get("estado") in ("activo", "programado"):
+        update_data["fecha_finalizacion"] = None
 
-    contrato = await contratos_collection.find_one({"_id": contrato_id})
+    # 6) Hacer update en BD
+    contrato = await contratos_repo.actualizar(contrato_id, update_data)
+    if "estado" in update_data or "habitacion_id" in update_data:
+        notificar_cambio_ocupacion([contrato_actual["habitacion_id"], contrato["habitacion_id"]])
     return Contrato(**contrato)
 
 
 
+@app.post("/api/contratos/{contrato_id}/restaurar")
+async def restaurar_contrato_archivado(contrato_id: str, usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Devuelve un contrato archivado, con sus pagos y gastos, a los datos activos"""
+    restaurados = await restaurar_contrato(contrato_id)
+    return {"mensaje": "Contrato restaurado correctamente", "restaurados": restaurados}
+
 # ============= PAGOS =============
-@app.get("/api/pagos/enriquecidos")
-async def listar_pagos_enriquecidos(
-    contrato_id: Optional[str] = Query(None),
-    tipo: Optional[str] = Query(None),
-    estado: Optional[str] = Query(None),
-    mes_anio: Optional[str] = Query(None),
-    piso_id: Optional[str] = Query(None),
-    habitacion_id: Optional[str] = Query(None),
-    inquilino_id: Optional[str] = Query(None),
-    usuario_actual: dict = Depends(obtener_usuario_actual)
-):
-    """Lista todos los pagos con información enriquecida y filtros avanzados"""
+async def _pagos_enriquecidos(
+    contrato_id: Optional[str],
+    tipo: Optional[str],
+    estado: Optional[str],
+    mes_anio: Optional[str],
+    piso_id: Optional[str],
+    habitacion_id: Optional[str],
+    inquilino_id: Optional[str]
+) -> list:
+    """Pagos con contrato, habitación, piso, inquilino y nombres de usuario"""
     # Construir filtro de pagos
     filtro_pagos = {}
     if contrato_id:
@@ -668,12 +775,24 @@ async def listar_pagos_enriquecidos(
     if mes_anio:
         filtro_pagos["mes_anio"] = mes_anio
     
-    pagos = await pagos_collection.find(filtro_pagos).to_list(1000)
+    pagos = await pagos_repo.listar(filtro_pagos)
+    
+    # Cargar datos relacionados con una consulta $in por colección
+    contratos = await contratos_repo.obtener_muchos(p["contrato_id"] for p in pagos)
+    habitaciones, inquilinos, usuarios = await asyncio.gather(
+        habitaciones_repo.obtener_muchos(c["habitacion_id"] for c in contratos.values()),
+        inquilinos_repo.obtener_muchos(c["inquilino_id"] for c in contratos.values()),
+        usuarios_repo.obtener_muchos(
+            [p.get("creado_por_usuario_id") for p in pagos] + [p.get("revisado_por_usuario_id") for p in pagos],
+            {"nombre": 1}
+        )
+    )
+    pisos = await pisos_repo.obtener_muchos(h["piso_id"] for h in habitaciones.values())
     
     # Enriquecer con datos relacionados
     resultado = []
     for pago in pagos:
-        contrato = await contratos_collection.find_one({"_id": pago["contrato_id"]})
+        contrato = contratos.get(pago["contrato_id"])
         if not contrato:
             continue
             
@@ -681,29 +800,22 @@ async def listar_pagos_enriquecidos(
         if inquilino_id and contrato["inquilino_id"] != inquilino_id:
             continue
             
-        habitacion = await habitaciones_collection.find_one({"_id": contrato["habitacion_id"]})
+        habitacion = habitaciones.get(contrato["habitacion_id"])
         if not habitacion:
             continue
             
         if habitacion_id and habitacion["_id"] != habitacion_id:
             continue
             
-        piso = await pisos_collection.find_one({"_id": habitacion["piso_id"]})
+        piso = pisos.get(habitacion["piso_id"])
         if piso_id and piso and piso["_id"] != piso_id:
             continue
             
-        inquilino = await inquilinos_collection.find_one({"_id": contrato["inquilino_id"]})
+        inquilino = inquilinos.get(contrato["inquilino_id"])
         
-        # Obtener nombres de usuarios para trazabilidad
-        creado_por = None
-        if pago.get("creado_por_usuario_id"):
-            usuario_creador = await usuarios_collection.find_one({"_id": pago["creado_por_usuario_id"]}, {"_id": 0, "nombre": 1})
-            creado_por = usuario_creador["nombre"] if usuario_creador else None
-        
-        revisado_por = None
-        if pago.get("revisado_por_usuario_id"):
-            usuario_revisor = await usuarios_collection.find_one({"_id": pago["revisado_por_usuario_id"]}, {"_id": 0, "nombre": 1})
-            revisado_por = usuario_revisor["nombre"] if usuario_revisor else None
+        # Nombres de usuarios para trazabilidad
+        usuario_creador = usuarios.get(pago.get("creado_por_usuario_id"))
+        usuario_revisor = usuarios.get(pago.get("revisado_por_usuario_id"))
         
         resultado.append({
             "pago": pago,
@@ -711,12 +823,34 @@ async def listar_pagos_enriquecidos(
             "habitacion": habitacion,
             "piso": piso,
             "inquilino": inquilino,
-            "creado_por_nombre": creado_por,
-            "revisado_por_nombre": revisado_por
+            "creado_por_nombre": usuario_creador["nombre"] if usuario_creador else None,
+            "revisado_por_nombre": usuario_revisor["nombre"] if usuario_revisor else None
         })
     
     return resultado
 
+@app.get("/api/pagos/enriquecidos")
+async def listar_pagos_enriquecidos(
+    request: Request,
+    contrato_id: Optional[str] = Query(None),
+    tipo: Optional[str] = Query(None),
+    estado: Optional[str] = Query(None),
+    mes_anio: Optional[str] = Query(None),
+    piso_id: Optional[str] = Query(None),
+    habitacion_id: Optional[str] = Query(None),
+    inquilino_id: Optional[str] = Query(None),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
+    """Lista todos los pagos con información enriquecida y filtros avanzados.
+
+    Las peticiones idénticas simultáneas comparten un único cálculo.
+    """
+    return await coalescedor.ejecutar(
+        "pagos_enriquecidos",
+        clave_peticion(request, usuario_actual),
+        lambda: _pagos_enriquecidos(contrato_id, tipo, estado, mes_anio, piso_id, habitacion_id, inquilino_id)
+    )
+
 @app.get("/api/pagos/pendientes/mes")
 async def pagos_pendientes_por_mes(
     mes_anio: str = Query(..., description="Formato: YYYY-MM"),
@@ -729,14 +863,22 @@ async def pagos_pendientes_por_mes(
         "estado": {"$in": ["pendiente", "atrasado"]}
     }).to_list(1000)
     
-    # Enriquecer con datos de contrato, habitación, piso e inquilino
+    # Enriquecer con datos de contrato, habitación, piso e inquilino (una consulta $in por colección)
+    contratos = await contratos_repo.obtener_muchos(p["contrato_id"] for p in pagos)
+    datos = await en_paralelo(
+        habitaciones=habitaciones_repo.obtener_muchos(c["habitacion_id"] for c in contratos.values()),
+        inquilinos=inquilinos_repo.obtener_muchos(c["inquilino_id"] for c in contratos.values())
+    )
+    habitaciones, inquilinos = datos["habitaciones"], datos["inquilinos"]
+    pisos = await pisos_repo.obtener_muchos(h["piso_id"] for h in habitaciones.values())
+    
     resultado = []
     for pago in pagos:
-        contrato = await contratos_collection.find_one({"_id": pago["contrato_id"]})
+        contrato = contratos.get(pago["contrato_id"])
         if contrato:
-            habitacion = await habitaciones_collection.find_one({"_id": contrato["habitacion_id"]})
-            piso = await pisos_collection.find_one({"_id": habitacion["piso_id"]}) if habitacion else None
-            inquilino = await inquilinos_collection.find_one({"_id": contrato["inquilino_id"]})
+            habitacion = habitaciones.get(contrato["habitacion_id"])
+            piso = pisos.get(habitacion["piso_id"]) if habitacion else None
+            inquilino = inquilinos.get(contrato["inquilino_id"])
             
             resultado.append({
                 "pago": Pago(**pago),
@@ -754,6 +896,7 @@ async def listar_pagos(
     tipo: Optional[str] = Query(None),
     estado: Optional[str] = Query(None),
     mes_anio: Optional[str] = Query(None),
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
     usuario_actual: dict = Depends(obtener_usuario_actual)
 ):
     """Lista todos los pagos con filtros opcionales"""
@@ -767,16 +910,14 @@ async def listar_pagos(
     if mes_anio:
         filtro["mes_anio"] = mes_anio
     
-    pagos = await pagos_collection.find(filtro).to_list(1000)
+    pagos = await pagos_repo.listar(filtro, incluir_archivo=incluir_archivo)
     return [Pago(**p) for p in pagos]
 
 @app.post("/api/pagos", response_model=Pago, status_code=status.HTTP_201_CREATED)
 async def crear_pago(datos: PagoCreate, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Crea un nuevo pago"""
     # Verificar que el contrato existe
-    contrato = await contratos_collection.find_one({"_id": datos.contrato_id})
-    if not contrato:
-        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    await contratos_repo.comprobar_existe(datos.contrato_id)
     
     pago_dict = datos.model_dump()
     pago_dict["_id"] = str(ObjectId())
@@ -787,23 +928,23 @@ async def crear_pago(datos: PagoCreate, usuario_actual: dict = Depends(obtener_u
     if usuario_actual["rol"] == "cobros" and pago_dict["estado"] == "pendiente":
         pago_dict["estado"] = "en_revision"
     
-    await pagos_collection.insert_one(pago_dict)
+    await pagos_repo.insertar(pago_dict)
     return Pago(**pago_dict)
 
 @app.get("/api/pagos/{pago_id}", response_model=Pago)
-async def obtener_pago(pago_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
+async def obtener_pago(
+    pago_id: str,
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
     """Obtiene un pago por ID"""
-    pago = await pagos_collection.find_one({"_id": pago_id})
-    if not pago:
-        raise HTTPException(status_code=404, detail="Pago no encontrado")
+    pago = await pagos_repo.obtener(pago_id, incluir_archivo=incluir_archivo)
     return Pago(**pago)
 
 @app.put("/api/pagos/{pago_id}", response_model=Pago)
 async def actualizar_pago(pago_id: str, datos: PagoUpdate, usuario_actual: dict = Depends(obtener_usuario_actual)):
     """Actualiza un pago"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
+    update_data = datos_actualizacion(datos)
     
     # Validar permisos para cambiar estado
     if "estado" in update_data:
@@ -816,72 +957,143 @@ async def actualizar_pago(pago_id: str, datos: PagoUpdate, usuario_actual: dict
     # Actualizar fecha de última modificación
     update_data["fecha_ultima_actualizacion"] = datetime.now(timezone.utc)
     
-    resultado = await pagos_collection.update_one({"_id": pago_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Pago no encontrado")
-    
-    pago = await pagos_collection.find_one({"_id": pago_id})
+    pago = await pagos_repo.actualizar(pago_id, update_data)
+    if update_data.get("estado") == "pagado":
+        await encolar_avisos_pagos([pago_id], "recibo")
     return Pago(**pago)
 
+# ============= COBROS =============
+@app.get("/api/cobros")
+async def obtener_lista_cobros(
+    mes_anio: str = Query(..., description="Formato: YYYY-MM"),
+    piso_id: Optional[str] = Query(None),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
+    """Cobros del mes por piso: contratos activos sin pago de alquiler creado o con el pago pendiente/atrasado"""
+    if not mes_valido(mes_anio):
+        raise HTTPException(status_code=400, detail="Formato de mes_anio no válido (YYYY-MM)")
+    return await lista_cobros(mes_anio, piso_id)
+
+# ============= AVISOS =============
+@app.post("/api/pagos/{pago_id}/avisos")
+async def encolar_avisos_pago(pago_id: str, datos: AvisoCreate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
+    """Encola un recordatorio o recibo de un pago (no se duplica si ya existe)"""
+    await pagos_repo.comprobar_existe(pago_id)
+    return {"encolados": await encolar_avisos_pagos([pago_id], datos.tipo)}
+
+@app.post("/api/avisos/recordatorios")
+async def encolar_recordatorios(
+    mes_anio: Optional[str] = Query(None, description="Formato: YYYY-MM"),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Encola recordatorios para todos los pagos atrasados (opcionalmente de un mes)"""
+    filtro = {"estado": "atrasado"}
+    if mes_anio:
+        filtro["mes_anio"] = mes_anio
+    
+    encolados = 0
+    pago_ids = []
+    async for pago in pagos_collection.find(filtro, {"_id": 1}):
+        pago_ids.append(pago["_id"])
+        if len(pago_ids) >= 500:
+            encolados += await encolar_avisos_pagos(pago_ids, "recordatorio")
+            pago_ids = []
+    if pago_ids:
+        encolados += await encolar_avisos_pagos(pago_ids, "recordatorio")
+    return {"encolados": encolados}
+
+@app.get("/api/avisos", response_model=List[Aviso])
+async def listar_avisos(
+    estado: Optional[str] = Query(None),
+    pago_id: Optional[str] = Query(None),
+    usuario_actual: dict = Depends(verificar_rol(["admin"]))
+):
+    """Lista los avisos de la cola de salida"""
+    filtro = {}
+    if estado:
+        filtro["estado"] = estado
+    if pago_id:
+        filtro["pago_id"] = pago_id
+    
+    avisos = await avisos_collection.find(filtro).sort("creado_en", -1).to_list(1000)
+    return [Aviso(**a) for a in avisos]
+
 # ============= GASTOS =============
 @app.get("/api/gastos", response_model=List[Gasto])
 async def listar_gastos(
     contrato_id: Optional[str] = Query(None),
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
     usuario_actual: dict = Depends(obtener_usuario_actual)
 ):
     """Lista todos los gastos"""
     filtro = {"contrato_id": contrato_id} if contrato_id else {}
-    gastos = await gastos_collection.find(filtro).to_list(1000)
+    gastos = await gastos_repo.listar(filtro, incluir_archivo=incluir_archivo)
     return [Gasto(**g) for g in gastos]
 
 @app.post("/api/gastos", response_model=Gasto, status_code=status.HTTP_201_CREATED)
 async def crear_gasto(datos: GastoCreate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Crea un nuevo gasto"""
     # Verificar que el contrato existe
-    contrato = await contratos_collection.find_one({"_id": datos.contrato_id})
-    if not contrato:
-        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    await contratos_repo.comprobar_existe(datos.contrato_id)
     
     gasto_dict = datos.model_dump()
     gasto_dict["_id"] = str(ObjectId())
-    await gastos_collection.insert_one(gasto_dict)
+    await gastos_repo.insertar(gasto_dict)
     return Gasto(**gasto_dict)
 
 @app.get("/api/gastos/{gasto_id}", response_model=Gasto)
-async def obtener_gasto(gasto_id: str, usuario_actual: dict = Depends(obtener_usuario_actual)):
+async def obtener_gasto(
+    gasto_id: str,
+    incluir_archivo: bool = Query(False, description="Incluir también los datos archivados"),
+    usuario_actual: dict = Depends(obtener_usuario_actual)
+):
     """Obtiene un gasto por ID"""
-    gasto = await gastos_collection.find_one({"_id": gasto_id})
-    if not gasto:
-        raise HTTPException(status_code=404, detail="Gasto no encontrado")
+    gasto = await gastos_repo.obtener(gasto_id, incluir_archivo=incluir_archivo)
     return Gasto(**gasto)
 
 @app.put("/api/gastos/{gasto_id}", response_model=Gasto)
 async def actualizar_gasto(gasto_id: str, datos: GastoUpdate, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Actualiza un gasto"""
-    update_data = {k: v for k, v in datos.model_dump(exclude_unset=True).items() if v is not None}
-    if not update_data:
-        raise HTTPException(status_code=400, detail="No hay datos para actualizar")
-    
-    resultado = await gastos_collection.update_one({"_id": gasto_id}, {"$set": update_data})
-    if resultado.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Gasto no encontrado")
-    
-    gasto = await gastos_collection.find_one({"_id": gasto_id})
+    gasto = await gastos_repo.actualizar(gasto_id, datos_actualizacion(datos))
     return Gasto(**gasto)
 
 @app.delete("/api/gastos/{gasto_id}")
 async def eliminar_gasto(gasto_id: str, usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))):
     """Elimina un gasto"""
-    resultado = await gastos_collection.delete_one({"_id": gasto_id})
-    if resultado.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Gasto no encontrado")
+    await gastos_repo.eliminar(gasto_id)
     return {"mensaje": "Gasto eliminado correctamente"}
 
+# ============= FIANZAS =============
+@app.post("/api/contratos/{contrato_id}/liquidacion-fianza")
+async def liquidar_fianza_contrato(
+    contrato_id: str,
+    dry_run: bool = Query(False),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Calcula (y guarda salvo dry_run) la liquidación de fianza de un contrato"""
+    resultado = await liquidar_fianzas({"_id": contrato_id}, dry_run=dry_run)
+    if resultado["total"] == 0:
+        raise HTTPException(status_code=404, detail="Contrato no encontrado")
+    return {"dry_run": dry_run, "liquidacion": resultado["liquidaciones"][0]}
+
+@app.post("/api/fianzas/liquidar")
+async def liquidar_fianzas_periodo(
+    desde: datetime = Query(..., description="Fecha fin de contrato desde"),
+    hasta: datetime = Query(..., description="Fecha fin de contrato hasta"),
+    dry_run: bool = Query(False),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Liquida las fianzas de todos los contratos que terminan en el periodo indicado"""
+    if desde > hasta:
+        raise HTTPException(status_code=400, detail="La fecha desde debe ser anterior a la fecha hasta")
+    
+    return await liquidar_fianzas({"fecha_fin": {"$gte": desde, "$lte": hasta}}, dry_run=dry_run)
+
 # ============= AJUSTES (solo admin) =============
 @app.get("/api/ajustes", response_model=Ajustes)
 async def obtener_ajustes(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
     """Obtiene la configuración del sistema"""
-    ajustes = await ajustes_collection.find_one({})
+    ajustes = ajustes_cache.obtener()
     if not ajustes:
         raise HTTPException(status_code=404, detail="Ajustes no encontrados")
     return Ajustes(**ajustes)
@@ -893,22 +1105,198 @@ async def actualizar_ajustes(datos: AjustesUpdate, usuario_actual: dict = Depend
     if not update_data:
         raise HTTPException(status_code=400, detail="No hay datos para actualizar")
     
-    ajustes = await ajustes_collection.find_one({})
+    # Un logo enviado como base64 se guarda como recurso y se sustituye por su URL
+    if update_data.get("datos_empresa", {}).get("logo"):
+        try:
+            update_data["datos_empresa"]["logo"] = await logo_a_recurso(update_data["datos_empresa"]["logo"])
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    ajustes = await ajustes_collection.find_one_and_update(
+        {},
+        {"$set": update_data, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
     if not ajustes:
         raise HTTPException(status_code=404, detail="Ajustes no encontrados")
     
-    resultado = await ajustes_collection.update_one(
-        {"_id": ajustes["_id"]},
-        {"$set": update_data}
+    ajustes_cache.establecer(ajustes)
+    return Ajustes(**ajustes)
+
+# ============= EXPORTACIÓN =============
+async def _respuesta_exportacion(nombre: str, columnas: list, lotes, formato: str):
+    """Devuelve la exportación en streaming (CSV) o como fichero generado en un hilo (XLSX)"""
+    fecha = datetime.now(timezone.utc).strftime("%Y%m%d")
+    if formato == "xlsx":
+        ruta = await generar_xlsx(columnas, lotes, nombre)
+        return FileResponse(
+            ruta,
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            filename=f"{nombre}_{fecha}.xlsx",
+            background=BackgroundTask(os.unlink, ruta)
+        )
+    return StreamingResponse(
+        stream_csv(columnas, lotes),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}_{fecha}.csv"'}
     )
+
+@app.get("/api/export/pagos")
+async def exportar_pagos(
+    formato: Literal["csv", "xlsx"] = Query("csv"),
+    mes_desde: Optional[str] = Query(None, description="Formato: YYYY-MM"),
+    mes_hasta: Optional[str] = Query(None, description="Formato: YYYY-MM"),
+    tipo: Optional[str] = Query(None),
+    estado: Optional[str] = Query(None),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Exporta todos los pagos (sin límite de filas) con nombres de piso, habitación e inquilino"""
+    filtro = {}
+    if mes_desde or mes_hasta:
+        filtro["mes_anio"] = {}
+        if mes_desde:
+            filtro["mes_anio"]["$gte"] = mes_desde
+        if mes_hasta:
+            filtro["mes_anio"]["$lte"] = mes_hasta
+    if tipo:
+        filtro["tipo"] = tipo
+    if estado:
+        filtro["estado"] = estado
     
-    ajustes_actualizados = await ajustes_collection.find_one({"_id": ajustes["_id"]})
-    return Ajustes(**ajustes_actualizados)
+    return await _respuesta_exportacion("pagos", COLUMNAS_PAGOS, filas_pagos(filtro), formato)
+
+@app.get("/api/export/contratos")
+async def exportar_contratos(
+    formato: Literal["csv", "xlsx"] = Query("csv"),
+    estado: Optional[str] = Query(None),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Exporta todos los contratos (sin límite de filas) con nombres de piso, habitación e inquilino"""
+    filtro = {"estado": estado} if estado else {}
+    return await _respuesta_exportacion("contratos", COLUMNAS_CONTRATOS, filas_contratos(filtro), formato)
+
+# ============= IMPORTACIÓN =============
+@app.post("/api/importar/{entidad}")
+async def importar(
+    entidad: Literal["pisos", "habitaciones", "inquilinos", "contratos"],
+    archivo: UploadFile = File(...),
+    dry_run: bool = Query(False, description="Solo valida y devuelve el informe, sin insertar"),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Importa un CSV (cabecera con los campos del alta); devuelve los errores por fila"""
+    try:
+        return await importar_csv(entidad, archivo.file, dry_run)
+    except csv.Error as e:
+        raise HTTPException(status_code=400, detail=f"CSV no válido: {e}")
+
+# ============= TAREAS Y MÉTRICAS (solo admin) =============
+@app.get("/api/tareas")
+async def estado_tareas(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Estado del programador de tareas periódicas"""
+    return programador.estado()
+
+@app.post("/api/tareas/{nombre}/ejecutar")
+async def ejecutar_tarea(nombre: str, usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Ejecuta una tarea periódica inmediatamente"""
+    if nombre not in programador.tareas:
+        raise HTTPException(status_code=404, detail="Tarea no encontrada")
+    return {"tarea": nombre, "resultado": await programador.ejecutar(nombre)}
+
+@app.get("/api/migraciones")
+async def obtener_migraciones(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Estado de las migraciones de esquema (schema_migrations)"""
+    return await estado_migraciones()
+
+@app.post("/api/migraciones/ejecutar")
+async def lanzar_migraciones(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Aplica ahora las migraciones pendientes (continúa desde el último checkpoint)"""
+    return await ejecutar_migraciones()
+
+@app.get("/api/metricas")
+async def obtener_metricas(usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Métricas internas del proceso"""
+    return metricas.instantanea()
+
+# ============= RECURSOS (logos e imágenes) =============
+@app.post("/api/ajustes/logo")
+async def subir_logo(archivo: UploadFile = File(...), usuario_actual: dict = Depends(verificar_rol(["admin"]))):
+    """Sube el logo de la empresa; se redimensiona una vez y se guarda por hash"""
+    contenido = await archivo.read(TAMANO_MAXIMO_SUBIDA + 1)
+    if len(contenido) > TAMANO_MAXIMO_SUBIDA:
+        raise HTTPException(status_code=413, detail="La imagen es demasiado grande")
+    
+    try:
+        recurso = await guardar_imagen(contenido)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    ajustes = await ajustes_collection.find_one_and_update(
+        {},
+        {"$set": {"datos_empresa.logo": recurso["url"]}, "$inc": {"version": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if not ajustes:
+        raise HTTPException(status_code=404, detail="Ajustes no encontrados")
+    
+    ajustes_cache.establecer(ajustes)
+    return recurso
+
+@app.get("/api/recursos/{hash_contenido}")
+@app.get("/api/recursos/{hash_contenido}/{variante}")
+async def obtener_recurso(
+    request: Request,
+    hash_contenido: str = Path(..., pattern="^[0-9a-f]{64}$"),
+    variante: Literal["original", "miniatura"] = "original"
+):
+    """Sirve un recurso por su hash. Es público (se usa en <img>) y cacheable indefinidamente"""
+    etag = f'"{hash_contenido}-{variante}"'
+    cabeceras = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    # Primero se comprueba que exista (la variante pedida puede no estar guardada)
+    flujo = await abrir_recurso(hash_contenido, variante)
+    if flujo is None:
+        raise HTTPException(status_code=404, detail="Recurso no encontrado")
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cabeceras)
+    
+    media_type = (flujo.metadata or {}).get("content_type", "application/octet-stream")
+    cabeceras["Content-Length"] = str(flujo.length)
+    return StreamingResponse(leer_por_trozos(flujo), media_type=media_type, headers=cabeceras)
+
+# ============= ANALÍTICA =============
+@app.get("/api/analitica/ocupacion-ingresos")
+async def analitica_ocupacion_ingresos(
+    anios: int = Query(1, ge=1, le=20),
+    granularidad: Literal["diaria", "mensual"] = Query("mensual"),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Tasa de ocupación (diaria o mensual) e ingresos esperados frente a cobrados por mes"""
+    return await ocupacion_e_ingresos(anios, granularidad)
+
+# ============= REPORTES =============
+@app.get("/api/reportes/proyeccion")
+async def reporte_proyeccion(
+    meses: int = Query(12, ge=1, le=36),
+    probabilidad_renovacion: float = Query(0.0, ge=0, le=1, description="Probabilidad de que un contrato se renueve al vencer"),
+    incremento_renovacion: float = Query(0.0, ge=-1, le=1, description="Variación de la cuota al renovar (0.03 = +3%)"),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Ingresos contratados de los próximos meses por piso, con escenario de renovaciones"""
+    return await proyeccion_rentas(meses, probabilidad_renovacion, incremento_renovacion)
+
+@app.get("/api/reportes/morosidad")
+async def reporte_morosidad(
+    formato: Literal["json", "csv", "xlsx"] = Query("json"),
+    usuario_actual: dict = Depends(verificar_rol(["admin", "supervisor"]))
+):
+    """Deuda pendiente por inquilino y por piso en tramos de 0-30, 31-60, 61-90 y más de 90 días"""
+    informe = await morosidad()
+    if formato == "json":
+        return informe
+    return await _respuesta_exportacion("morosidad", COLUMNAS_MOROSIDAD, filas_morosidad(informe), formato)
 
 # ============= DASHBOARD =============
-@app.get("/api/dashboard/stats")
-async def obtener_estadisticas(usuario_actual: dict = Depends(obtener_usuario_actual)):
-    """Obtiene estadísticas para el dashboard"""
+async def calcular_estadisticas() -> dict:
+    """Estadísticas del dashboard"""
     # Total de habitaciones
     total_habitaciones = await habitaciones_collection.count_documents({})
     
@@ -948,3 +1336,57 @@ async def obtener_estadisticas(usuario_actual: dict = Depends(obtener_usuario_ac
         "pagos_pendientes": pagos_pendientes,
         "contratos_proximos_vencer": contratos_proximos
     }
+
+difusor_dashboard = DifusorDashboard(bus_eventos, calcular_estadisticas)
+
+# Segundos que se reutilizan las estadísticas ya calculadas
+ESTADISTICAS_MICROCACHE = float(os.environ.get("ESTADISTICAS_MICROCACHE", "2"))
+
+@app.get("/api/dashboard/stats")
+async def obtener_estadisticas(request: Request, usuario_actual: dict = Depends(obtener_usuario_actual)):
+    """Obtiene estadísticas para el dashboard (un cálculo compartido por las peticiones simultáneas)"""
+    return await coalescedor.ejecutar(
+        "dashboard", clave_peticion(request, usuario_actual), calcular_estadisticas, ESTADISTICAS_MICROCACHE
+    )
+
+# ============= EVENTOS (SSE) =============
+INTERVALO_KEEPALIVE = 15
+
+@app.post("/api/eventos/ticket")
+async def ticket_eventos(usuario_actual: dict = Depends(obtener_usuario_actual)):
+    """Ticket de un solo uso (válido unos segundos) para abrir /api/eventos?ticket= desde EventSource"""
+    return {"ticket": await registro_sesiones.crear_ticket(usuario_actual), "expira_en": DURACION_TICKET}
+
+@app.get("/api/eventos")
+async def eventos(
+    request: Request,
+    temas: Optional[str] = Query(None, description="pagos,contratos,habitaciones,dashboard (por defecto todos)"),
+    usuario_actual: dict = Depends(obtener_usuario_cabecera_o_ticket)
+):
+    """Flujo SSE con los cambios de pagos, contratos y estadísticas del dashboard"""
+    filtro_temas = set(temas.split(",")) if temas else None
+
+    async def generar():
+        cola = bus_eventos.suscribir()
+        try:
+            if filtro_temas is None or "dashboard" in filtro_temas:
+                datos = await difusor_dashboard.actuales()
+                yield formatear_sse({"tipo": "dashboard", "accion": "inicial", "datos": datos})
+            while True:
+                try:
+                    evento = await asyncio.wait_for(cola.get(), timeout=INTERVALO_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": keepalive\n\n"
+                    continue
+                if filtro_temas is None or evento["tipo"] in filtro_temas:
+                    yield formatear_sse(evento)
+        finally:
+            bus_eventos.cancelar(cola)
+
+    return StreamingResponse(
+        generar(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
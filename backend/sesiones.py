@@ -0,0 +1,189 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from secrets import token_urlsafe
+from uuid import uuid4
+
+from database import sesiones_collection, usuarios_collection, versiones_collection, tickets_eventos_collection
+from fechas import sin_zona
+from vigilancia import vigilar
+
+# Cada cuántos segundos se buscan revocaciones nuevas si no hay change streams
+INTERVALO_SONDEO = int(os.environ.get("SESIONES_INTERVALO_SONDEO", "5"))
+# Segundos que se sirve /api/auth/me desde memoria
+PERFIL_TTL = int(os.environ.get("SESIONES_PERFIL_TTL", "60"))
+# Margen al buscar revocaciones por si los relojes de los workers no coinciden
+MARGEN_SEGURIDAD = timedelta(seconds=5)
+# Segundos que vale un ticket de /api/eventos antes de canjearlo
+DURACION_TICKET = 30
+PROYECCION_PERFIL = {"_id": 1, "nombre": 1, "email": 1, "whatsapp": 1, "rol": 1, "activo": 1}
+
+
+class RegistroSesiones:
+    """Sesiones emitidas (una por jti) y conjunto en memoria de las revocadas.
+
+    Comprobar si un token está revocado no consulta Mongo: cada worker
+    mantiene el conjunto de jti revocados (hasta que caducan) siguiendo el
+    change stream de sesiones o, si no está disponible, buscando
+    periódicamente las revocadas desde la última comprobación. Los perfiles
+    en caché se olvidan igual cuando otro worker modifica el usuario.
+    """
+
+    def __init__(self):
+        self._revocadas = {}  # jti -> expira
+        self._perfiles = {}  # usuario_id -> (caduca, perfil)
+        self._ultima_revocacion = datetime(1970, 1, 1)
+        self._version_usuarios = None
+        self._tareas = []
+
+    # ---- Sesiones ----
+
+    async def crear(self, usuario_id: str, expira: datetime) -> str:
+        """Registra una sesión nueva y devuelve su jti"""
+        jti = uuid4().hex
+        await sesiones_collection.insert_one({
+            "_id": jti,
+            "usuario_id": usuario_id,
+            "creada": datetime.now(timezone.utc),
+            "expira": expira,
+            "revocada": False
+        })
+        return jti
+
+    def revocada(self, jti: str) -> bool:
+        return jti in self._revocadas
+
+    def _anotar(self, sesiones: list):
+        for sesion in sesiones:
+            self._revocadas[sesion["_id"]] = sin_zona(sesion["expira"])
+            self._perfiles.pop(sesion.get("usuario_id"), None)
+            if sesion.get("revocada_en"):
+                self._ultima_revocacion = max(self._ultima_revocacion, sin_zona(sesion["revocada_en"]))
+
+    async def _revocar(self, filtro: dict) -> int:
+        ahora = datetime.now(timezone.utc)
+        filtro = {**filtro, "revocada": False, "expira": {"$gt": ahora}}
+        sesiones = await sesiones_collection.find(filtro, {"usuario_id": 1, "expira": 1}).to_list(None)
+        if not sesiones:
+            return 0
+        await sesiones_collection.update_many(
+            {"_id": {"$in": [s["_id"] for s in sesiones]}},
+            {"$set": {"revocada": True, "revocada_en": ahora}}
+        )
+        self._anotar(sesiones)
+        return len(sesiones)
+
+    async def revocar(self, jti: str) -> int:
+        """Revoca una sesión (logout)"""
+        return await self._revocar({"_id": jti})
+
+    async def revocar_usuario(self, usuario_id: str) -> int:
+        """Revoca todas las sesiones abiertas de un usuario (desactivación, cambio de rol o contraseña)"""
+        self.invalidar_perfil(usuario_id)
+        return await self._revocar({"usuario_id": usuario_id})
+
+    # ---- Perfil (/api/auth/me) ----
+
+    async def perfil(self, usuario_id: str):
+        """Perfil del usuario desde memoria; se relee de Mongo cada PERFIL_TTL segundos"""
+        en_cache = self._perfiles.get(usuario_id)
+        if en_cache and en_cache[0] > time.monotonic():
+            return en_cache[1]
+        perfil = await usuarios_collection.find_one({"_id": usuario_id}, PROYECCION_PERFIL)
+        if perfil:
+            self._perfiles[usuario_id] = (time.monotonic() + PERFIL_TTL, perfil)
+        return perfil
+
+    def invalidar_perfil(self, usuario_id: str):
+        self._perfiles.pop(usuario_id, None)
+
+    # ---- Tickets de /api/eventos ----
+
+    async def crear_ticket(self, usuario: dict) -> str:
+        """Ticket de un solo uso para abrir el flujo SSE (EventSource no envía cabeceras y el JWT no debe ir en la URL)"""
+        ticket = token_urlsafe(32)
+        await tickets_eventos_collection.insert_one({
+            "_id": ticket,
+            "usuario": {c: usuario.get(c) for c in ("sub", "email", "rol", "jti")},
+            "expira": datetime.now(timezone.utc) + timedelta(seconds=DURACION_TICKET)
+        })
+        return ticket
+
+    async def canjear_ticket(self, ticket: str):
+        """Usuario del ticket, que se borra al canjearlo (None si no existe, ha caducado o su sesión está revocada)"""
+        documento = await tickets_eventos_collection.find_one_and_delete(
+            {"_id": ticket, "expira": {"$gt": datetime.now(timezone.utc)}}
+        )
+        if not documento or self.revocada(documento["usuario"]["jti"]):
+            return None
+        return documento["usuario"]
+
+    # ---- Sincronización entre workers ----
+
+    def _purgar(self):
+        """Olvida las revocaciones de tokens ya caducados"""
+        ahora = sin_zona(datetime.now(timezone.utc))
+        for jti in [j for j, expira in self._revocadas.items() if expira <= ahora]:
+            del self._revocadas[jti]
+
+    async def cargar(self):
+        """Lee las sesiones revocadas que aún no han caducado (al arrancar)"""
+        self._anotar(await sesiones_collection.find(
+            {"revocada": True, "expira": {"$gt": datetime.now(timezone.utc)}},
+            {"usuario_id": 1, "expira": 1, "revocada_en": 1}
+        ).to_list(None))
+
+    async def _sondear(self):
+        """Incorpora las revocaciones hechas por otros workers"""
+        self._anotar(await sesiones_collection.find(
+            {"revocada": True, "revocada_en": {"$gt": self._ultima_revocacion - MARGEN_SEGURIDAD}},
+            {"usuario_id": 1, "expira": 1, "revocada_en": 1}
+        ).to_list(None))
+        self._purgar()
+
+    def _aplicar_cambio(self, cambio: dict):
+        if cambio.get("fullDocument"):
+            self._anotar([cambio["fullDocument"]])
+        self._purgar()
+
+    async def _sondear_usuarios(self):
+        """Olvida los perfiles en caché si ha cambiado la versión de usuarios"""
+        documento = await versiones_collection.find_one({"_id": "usuarios"})
+        version = documento["version"] if documento else 0
+        if self._version_usuarios is not None and version != self._version_usuarios:
+            self._perfiles.clear()
+        self._version_usuarios = version
+
+    def _aplicar_cambio_usuario(self, cambio: dict):
+        self.invalidar_perfil(cambio.get("documentKey", {}).get("_id"))
+
+    def iniciar(self):
+        """Empieza a seguir las revocaciones y los cambios de usuarios que hagan otros workers"""
+        if not self._tareas:
+            filtro = [{"$match": {"operationType": "update", "updateDescription.updatedFields.revocada": True}}]
+            self._tareas = [
+                asyncio.create_task(vigilar(
+                    "sesiones",
+                    lambda: sesiones_collection.watch(filtro, full_document="updateLookup"),
+                    self._aplicar_cambio,
+                    self._sondear,
+                    INTERVALO_SONDEO
+                )),
+                asyncio.create_task(vigilar(
+                    "usuarios",
+                    lambda: usuarios_collection.watch([{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]),
+                    self._aplicar_cambio_usuario,
+                    self._sondear_usuarios,
+                    INTERVALO_SONDEO
+                )),
+            ]
+
+    async def detener(self):
+        for tarea in self._tareas:
+            tarea.cancel()
+        await asyncio.gather(*self._tareas, return_exceptions=True)
+        self._tareas = []
+
+
+registro_sesiones = RegistroSesiones()
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+
+from database import eliminados_collection
+from repositorios import pisos_repo, habitaciones_repo, inquilinos_repo, contratos_repo, pagos_repo
+
+ENTIDADES = {
+    "pisos": pisos_repo,
+    "habitaciones": habitaciones_repo,
+    "inquilinos": inquilinos_repo,
+    "contratos": contratos_repo,
+    "pagos": pagos_repo,
+}
+
+# Margen para no perder escrituras que empezaron antes de la consulta pero terminaron después
+MARGEN_SEGURIDAD = timedelta(seconds=5)
+
+
+def _crear_token(momento: datetime) -> str:
+    """Token opaco (milisegundos desde epoch) para la siguiente sincronización"""
+    return str(int(momento.timestamp() * 1000))
+
+
+def _leer_token(token: str) -> datetime:
+    """Momento codificado en un token de sincronización; 400 si no es válido"""
+    if not token.isdigit():
+        raise HTTPException(status_code=400, detail="Token de sincronización no válido")
+    return datetime.fromtimestamp(int(token) / 1000, tz=timezone.utc)
+
+
+async def _cambios(nombre: str, desde: datetime) -> dict:
+    """Documentos modificados y ids eliminados de una entidad desde un momento (o todo si desde es None)"""
+    repo = ENTIDADES[nombre]
+    if desde is None:
+        return {"cambiados": await repo.listar(limite=None), "eliminados": []}
+
+    cambiados, eliminados = await asyncio.gather(
+        repo.listar({"updated_at": {"$gte": desde}}, limite=None),
+        eliminados_collection.find(
+            {"coleccion": nombre, "updated_at": {"$gte": desde}}, {"documento_id": 1}
+        ).to_list(None)
+    )
+    return {"cambiados": cambiados, "eliminados": [e["documento_id"] for e in eliminados]}
+
+
+async def sincronizar(since: str = None) -> dict:
+    """Cambios de las entidades desde el token; sin token devuelve todos los documentos"""
+    desde = _leer_token(since) if since else None
+    inicio = datetime.now(timezone.utc)
+    resultados = await asyncio.gather(*(_cambios(nombre, desde) for nombre in ENTIDADES))
+    return {
+        # Solapa un poco con esta consulta: el cliente puede recibir duplicados, pero no pierde cambios
+        "token": _crear_token(inicio - MARGEN_SEGURIDAD),
+        "completo": desde is None,
+        **dict(zip(ENTIDADES, resultados))
+    }
@@ -0,0 +1,160 @@
+import calendar
+from datetime import date, datetime, timezone
+
+import versiones
+from eventos import bus_eventos
+from database import contratos_collection, pagos_collection, estado_tareas_collection
+
+# Pagos que se marcan como atrasados en cada update_many
+TAMANO_TROZO_ATRASOS = 1000
+
+
+def notificar_cambio_ocupacion(habitacion_ids):
+    """Publica un evento por cada habitación cuya ocupación ha cambiado (para los clientes SSE)"""
+    for habitacion_id in sorted(set(habitacion_ids)):
+        bus_eventos.publicar_cambio("habitaciones", "ocupacion", habitacion_id)
+
+
+async def _transicionar(filtro: dict, nuevo_estado: str):
+    """Cambia de estado los contratos del filtro; devuelve (modificados, habitaciones afectadas).
+
+    Se actualizan por _id los contratos leídos (repitiendo el filtro), así
+    que las habitaciones devueltas son las de esos mismos contratos.
+    """
+    contratos = await contratos_collection.find(filtro, {"habitacion_id": 1}).to_list(None)
+    if not contratos:
+        return 0, []
+    resultado = await contratos_collection.update_many(
+        {**filtro, "_id": {"$in": [c["_id"] for c in contratos]}},
+        {"$set": {"estado": nuevo_estado, "updated_at": datetime.now(timezone.utc)}}
+    )
+    if resultado.modified_count:
+        await versiones.incrementar("contratos")
+        bus_eventos.publicar_cambio("contratos", "actualizados")
+    return resultado.modified_count, [c["habitacion_id"] for c in contratos]
+
+
+async def transicionar_contratos(ahora: datetime = None) -> dict:
+    """Pasa a finalizado los contratos vencidos y a activo los programados que ya han empezado"""
+    ahora = ahora or datetime.now(timezone.utc)
+
+    finalizados, habitaciones_finalizadas = await _transicionar(
+        {"estado": {"$in": ["activo", "programado"]}, "fecha_fin": {"$lt": ahora}},
+        "finalizado"
+    )
+    activados, habitaciones_activadas = await _transicionar(
+        {"estado": "programado", "fecha_inicio": {"$lte": ahora}, "fecha_fin": {"$gte": ahora}},
+        "activo"
+    )
+
+    notificar_cambio_ocupacion([*habitaciones_finalizadas, *habitaciones_activadas])
+    return {"finalizados": finalizados, "activados": activados}
+
+
+def fecha_vencimiento(mes_anio: str, dia_pago: int):
+    """Fecha en que vence un pago de mes_anio ("YYYY-MM") según el día de pago del contrato.
+
+    Si el mes no tiene ese día (p. ej. 31 en febrero) vence el último día del mes.
+    Devuelve None si mes_anio no tiene un formato válido.
+    """
+    try:
+        anio, mes = (int(x) for x in mes_anio.split("-"))
+        ultimo_dia = calendar.monthrange(anio, mes)[1]
+    except (ValueError, AttributeError, calendar.IllegalMonthError):
+        return None
+    return date(anio, mes, min(max(dia_pago or 1, 1), ultimo_dia))
+
+
+def _meses_entre(desde: datetime, hasta: datetime) -> list:
+    """Lista de "YYYY-MM" desde el mes de desde hasta el de hasta (ambos incluidos)"""
+    meses = []
+    anio, mes = desde.year, desde.month
+    while (anio, mes) <= (hasta.year, hasta.month):
+        meses.append(f"{anio:04d}-{mes:02d}")
+        anio, mes = (anio + 1, 1) if mes == 12 else (anio, mes + 1)
+    return meses
+
+
+async def detectar_atrasos(ahora: datetime = None) -> dict:
+    """Marca como atrasados los pagos pendientes cuyo día de pago ya ha pasado.
+
+    Es incremental: tras la primera ejecución solo revisa los meses cuyo
+    vencimiento ha podido pasar desde la última ejecución y los meses con
+    pagos creados o modificados desde entonces.
+    """
+    ahora = ahora or datetime.now(timezone.utc)
+    hoy = ahora.date()
+    estado = await estado_tareas_collection.find_one({"_id": "atrasos"})
+    ultima_ejecucion = estado["ultima_ejecucion"] if estado else None
+
+    filtro = {"estado": "pendiente", "tipo": {"$in": ["alquiler", "gastos"]}}
+    meses_procesados = None
+    if ultima_ejecucion:
+        meses_modificados = await pagos_collection.distinct("mes_anio", {
+            **filtro,
+            "$or": [
+                {"fecha_creacion": {"$gte": ultima_ejecucion}},
+                {"fecha_ultima_actualizacion": {"$gte": ultima_ejecucion}}
+            ]
+        })
+        meses_procesados = sorted(set(_meses_entre(ultima_ejecucion, ahora)) | set(meses_modificados))
+        filtro["mes_anio"] = {"$in": meses_procesados}
+
+    # Pagos candidatos con el día de pago de su contrato; se leen con un cursor
+    # y se marcan por trozos, sin acumular todos los ids en un solo documento
+    pipeline = [
+        {"$match": filtro},
+        {"$lookup": {
+            "from": "contratos",
+            "let": {"contrato_id": "$contrato_id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$contrato_id"]}}},
+                {"$project": {"dia_pago": 1}}
+            ],
+            "as": "contrato"
+        }},
+        {"$project": {
+            "mes_anio": 1,
+            "dia_pago": {"$ifNull": [{"$arrayElemAt": ["$contrato.dia_pago", 0]}, 1]}
+        }}
+    ]
+
+    async def marcar(ids: list) -> int:
+        resultado = await pagos_collection.update_many(
+            {"_id": {"$in": ids}, "estado": "pendiente"},
+            {"$set": {"estado": "atrasado", "fecha_ultima_actualizacion": ahora, "updated_at": ahora}}
+        )
+        return resultado.modified_count
+
+    revisados = 0
+    marcados = 0
+    vencidos = {}  # (mes_anio, dia_pago) -> ¿vencido?
+    trozo = []
+    async for pago in pagos_collection.aggregate(pipeline):
+        revisados += 1
+        clave = (pago["mes_anio"], pago["dia_pago"])
+        if clave not in vencidos:
+            vencimiento = fecha_vencimiento(*clave)
+            vencidos[clave] = vencimiento is not None and vencimiento < hoy
+        if vencidos[clave]:
+            trozo.append(pago["_id"])
+            if len(trozo) >= TAMANO_TROZO_ATRASOS:
+                marcados += await marcar(trozo)
+                trozo = []
+    if trozo:
+        marcados += await marcar(trozo)
+
+    if marcados:
+        await versiones.incrementar("pagos")
+        bus_eventos.publicar_cambio("pagos", "actualizados")
+
+    await estado_tareas_collection.update_one(
+        {"_id": "atrasos"},
+        {"$set": {"ultima_ejecucion": ahora}},
+        upsert=True
+    )
+    return {
+        "meses_procesados": meses_procesados if meses_procesados is not None else "todos",
+        "revisados": revisados,
+        "marcados_atrasados": marcados
+    }
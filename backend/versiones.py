@@ -0,0 +1,13 @@
+from database import versiones_collection
+
+
+async def incrementar(*colecciones: str):
+    """Incrementa el contador de versión de cada colección modificada"""
+    for coleccion in colecciones:
+        await versiones_collection.update_one({"_id": coleccion}, {"$inc": {"version": 1}}, upsert=True)
+
+
+async def obtener() -> dict:
+    """Versión actual de cada colección (las que nunca se han modificado no aparecen)"""
+    documentos = await versiones_collection.find({}).to_list(None)
+    return {d["_id"]: d["version"] for d in documentos}
@@ -0,0 +1,35 @@
+import asyncio
+import logging
+
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+
+async def vigilar(nombre: str, abrir, al_cambio, sondear=None, intervalo: float = 5, al_conectar=None):
+    """Sigue los cambios que hacen otros workers.
+
+    abrir() devuelve el change stream (p. ej. coleccion.watch(...)) y cada
+    cambio se pasa a al_cambio. Si el servidor no tiene change streams
+    (standalone) o el stream se corta, se llama a la corrutina sondear cada
+    intervalo segundos; sin sondear, simplemente se termina.
+    """
+    try:
+        async with abrir() as cambios:
+            if al_conectar:
+                al_conectar()
+            async for cambio in cambios:
+                al_cambio(cambio)
+    except OperationFailure:
+        # Servidor standalone: sin change streams
+        pass
+    except Exception:
+        logger.exception("Error en el change stream de %s", nombre)
+    if sondear is None:
+        return
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await sondear()
+        except Exception:
+            logger.exception("Error comprobando los cambios de %s", nombre)
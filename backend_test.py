@@ -1,8 +1,13 @@
 import requests
 import sys
 import json
+import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
+# PNG de 1x1 píxeles para las pruebas de subida de imágenes
+PNG_1X1 = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+
 class RentalSystemAPITester:
     def __init__(self, base_url="https://roomrent-manager-1.preview.emergentagent.com/api"):
         self.base_url = base_url
@@ -340,6 +345,17 @@ class RentalSystemAPITester:
         # List Pagos
         self.run_test("List Pagos", "GET", "pagos", 200)
 
+        # Enqueue reminder (idempotent)
+        if self.created_ids['pago']:
+            self.run_test(
+                "Encolar Recordatorio Pago",
+                "POST",
+                f"pagos/{self.created_ids['pago']}/avisos",
+                200,
+                data={"tipo": "recordatorio"}
+            )
+            self.run_test("List Avisos", "GET", f"avisos?pago_id={self.created_ids['pago']}", 200)
+
         # Get Pagos Pendientes
         self.run_test(
             "Get Pagos Pendientes",
@@ -429,6 +445,433 @@ class RentalSystemAPITester:
 
         return success
 
+    def test_ajustes_cache(self):
+        """Test ajustes writes are visible right away and bump the version"""
+        success, antes = self.run_test("Get Ajustes (antes)", "GET", "ajustes", 200)
+        if not success:
+            return False
+        dia = 5 if antes["dia_cobro_por_defecto"] != 5 else 6
+        ok, actualizados = self.run_test("Update Ajustes (versión)", "PUT", "ajustes", 200, data={"dia_cobro_por_defecto": dia})
+        if ok and actualizados["version"] != antes["version"] + 1:
+            print(f"❌ Versión {actualizados['version']}, se esperaba {antes['version'] + 1}")
+            success = False
+        ok, despues = self.run_test("Get Ajustes (después)", "GET", "ajustes", 200)
+        if ok and (despues["dia_cobro_por_defecto"], despues["version"]) != (dia, antes["version"] + 1):
+            print(f"❌ La caché devuelve ajustes antiguos: día {despues['dia_cobro_por_defecto']}, versión {despues['version']}")
+            success = False
+        self.run_test("Restaurar Ajustes", "PUT", "ajustes", 200, data={"dia_cobro_por_defecto": antes["dia_cobro_por_defecto"]})
+        return success and ok
+
+    def test_recursos(self):
+        """Test logo upload as content-addressed resource and logo validation in ajustes"""
+        _, ajustes = self.run_test("Get Ajustes (logo actual)", "GET", "ajustes", 200)
+        logo_anterior = (ajustes.get("datos_empresa") or {}).get("logo")
+
+        self.tests_run += 1
+        print("\n🔍 Testing Subir logo...")
+        response = requests.post(
+            f"{self.base_url}/ajustes/logo",
+            files={"archivo": ("logo.png", base64.b64decode(PNG_1X1), "image/png")},
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        success = response.status_code == 200
+        if success:
+            self.tests_passed += 1
+            recurso = response.json()
+            print(f"✅ Passed - {recurso['url']}")
+            ruta = recurso["url"].replace("/api/", "", 1)
+            etag = f'"{recurso["hash"]}-original"'
+            self.run_test("Descargar recurso", "GET", ruta, 200)
+            self.run_test("Recurso no modificado", "GET", ruta, 304, headers={"If-None-Match": etag})
+            self.run_test("Miniatura", "GET", f"{ruta}/miniatura", 200)
+        else:
+            print(f"❌ Failed - Status: {response.status_code}, {response.text}")
+
+        inexistente = "0" * 64
+        self.run_test(
+            "Recurso inexistente con ETag", "GET", f"recursos/{inexistente}/miniatura", 404,
+            headers={"If-None-Match": f'"{inexistente}-miniatura"'}
+        )
+        ok, ajustes = self.run_test("Logo que no es data URL", "PUT", "ajustes", 200, data={"datos_empresa": {"logo": "logo"}})
+        if ok and ajustes["datos_empresa"]["logo"] != "logo":
+            print(f"❌ El logo debería quedar igual: {ajustes['datos_empresa']['logo']}")
+        self.run_test(
+            "Data URL que no es imagen", "PUT", "ajustes", 400,
+            data={"datos_empresa": {"logo": "data:image/png;base64,bG9nbw=="}}
+        )
+        if ok:
+            self.run_test("Restaurar logo", "PUT", "ajustes", 200, data={"datos_empresa": {**ajustes["datos_empresa"], "logo": logo_anterior}})
+        return success
+
+    def test_liquidacion_fianza(self):
+        """Test deposit settlement preview"""
+        if not self.created_ids['contrato']:
+            print("❌ Cannot test liquidación without contrato")
+            return False
+
+        success, response = self.run_test(
+            "Preview Liquidación Fianza",
+            "POST",
+            f"contratos/{self.created_ids['contrato']}/liquidacion-fianza?dry_run=true",
+            200
+        )
+        if success and 'liquidacion' in response:
+            print(f"   Importe a devolver: {response['liquidacion'].get('importe_a_devolver')}")
+        return success
+
+    def test_tareas(self):
+        """Test scheduler status and manual run"""
+        success, response = self.run_test("Estado Tareas", "GET", "tareas", 200)
+        self.run_test(
+            "Ejecutar Transiciones Contratos",
+            "POST",
+            "tareas/transiciones_contratos/ejecutar",
+            200
+        )
+        self.run_test(
+            "Ejecutar Detección Atrasos",
+            "POST",
+            "tareas/deteccion_atrasos/ejecutar",
+            200
+        )
+        self.run_test("Métricas", "GET", "metricas", 200)
+        return success
+
+    def test_exportacion(self):
+        """Test CSV/XLSX exports"""
+        success, _ = self.run_test("Export Pagos CSV", "GET", "export/pagos", 200)
+        self.run_test("Export Contratos CSV", "GET", "export/contratos", 200)
+        self.run_test("Export Contratos XLSX", "GET", "export/contratos?formato=xlsx", 200)
+        return success
+
+    def test_campos_e_ids(self):
+        """Test sparse fields and batch get by ids"""
+        success, pisos = self.run_test("Pisos solo nombre", "GET", "pisos?fields=nombre", 200)
+        if success and pisos and set(pisos[0].keys()) != {"_id", "nombre"}:
+            print(f"❌ Campos inesperados: {list(pisos[0].keys())}")
+        self.run_test("Campo no válido", "GET", "habitaciones?fields=inexistente", 400)
+        if self.created_ids['inquilino']:
+            success, inquilinos = self.run_test(
+                "Inquilinos por ids", "GET",
+                f"inquilinos?ids={self.created_ids['inquilino']}&fields=nombre,dni", 200
+            )
+            if success and len(inquilinos) != 1:
+                print(f"❌ Se esperaba 1 inquilino, recibidos {len(inquilinos)}")
+        self.run_test("Contratos por ids", "GET", "contratos?ids=&fields=estado", 200)
+        return success
+
+    def test_pisos_con_conteo(self):
+        """Test room counts per piso match the per-piso room listing"""
+        success, pisos = self.run_test("Pisos con conteo", "GET", "pisos/con-conteo", 200)
+        for piso in (pisos or [])[:3] if success else []:
+            ok, habitaciones = self.run_test(
+                f"Habitaciones de {piso['piso']['nombre']}", "GET", f"pisos/{piso['piso']['_id']}/habitaciones", 200
+            )
+            if not ok:
+                continue
+            ocupadas = sum(1 for h in habitaciones if h["ocupada"])
+            if (len(habitaciones), ocupadas) != (piso["total_habitaciones"], piso["habitaciones_ocupadas"]):
+                print(f"❌ Conteo distinto: {piso['total_habitaciones']}/{piso['habitaciones_ocupadas']} "
+                      f"frente a {len(habitaciones)}/{ocupadas}")
+                success = False
+            if any(h["ocupada"] and not h["contrato_activo_id"] for h in habitaciones):
+                print("❌ Habitación ocupada sin contrato activo")
+                success = False
+        self.run_test("Habitaciones de piso inexistente", "GET", "pisos/000000000000000000000000/habitaciones", 404)
+        return success
+
+    def test_bootstrap(self):
+        """Test bootstrap bundle and delta refresh"""
+        success, datos = self.run_test("Bootstrap", "GET", "bootstrap", 200)
+        if success:
+            estados = {c["estado"] for c in datos["contratos"].values()}
+            if not estados <= {"activo", "programado"}:
+                print(f"❌ El bootstrap no debería incluir contratos {estados - {'activo', 'programado'}}")
+            success, delta = self.run_test("Bootstrap delta", "GET", f"bootstrap?desde={datos['version']}", 200)
+            if success and "pisos" in delta:
+                print("❌ El delta no debería incluir pisos sin cambios")
+        self.run_test("Bootstrap token no válido", "GET", "bootstrap?desde=x", 400)
+        return success
+
+    def test_sync(self):
+        """Test incremental sync"""
+        success, datos = self.run_test("Sync completo", "GET", "sync", 200)
+        if not success:
+            return False
+        token = datos["token"]
+        ok, piso = self.run_test("Create Piso (sync)", "POST", "pisos", 201, data={"nombre": "Piso Sync", "direccion": "Calle Sync 1"})
+        if ok:
+            _, cambios = self.run_test("Sync tras crear", "GET", f"sync?since={token}", 200)
+            if piso["_id"] not in [p["_id"] for p in cambios["pisos"]["cambiados"]]:
+                print("❌ El piso creado no aparece en cambiados")
+                success = False
+            self.run_test("Delete Piso (sync)", "DELETE", f"pisos/{piso['_id']}", 200)
+            _, cambios = self.run_test("Sync tras eliminar", "GET", f"sync?since={cambios['token']}", 200)
+            if piso["_id"] not in cambios["pisos"]["eliminados"]:
+                print("❌ El piso eliminado no aparece en eliminados")
+                success = False
+        self.run_test("Sync token no válido", "GET", "sync?since=abc", 400)
+        return success and ok
+
+    def test_batch(self):
+        """Test request batching"""
+        success, resultados = self.run_test("Batch", "POST", "batch", 200, data={"peticiones": [
+            {"metodo": "GET", "ruta": "/api/pisos"},
+            {"metodo": "GET", "ruta": "/api/dashboard/stats"},
+            {"metodo": "PUT", "ruta": "/api/pisos/000000000000000000000000", "cuerpo": {"nombre": "x"}}
+        ]})
+        if success and [r["estado"] for r in resultados] != [200, 200, 404]:
+            print(f"❌ Estados inesperados: {[r['estado'] for r in resultados]}")
+        return success
+
+    def test_disponibilidad(self):
+        """Test room availability search"""
+        success, datos = self.run_test(
+            "Disponibilidad", "GET", "disponibilidad?desde=2030-01-01T00:00:00&hasta=2030-03-01T00:00:00&calendario=true", 200
+        )
+        if success and "calendario" not in datos:
+            print("❌ Falta el calendario")
+        self.run_test("Disponibilidad rango no válido", "GET", "disponibilidad?desde=2030-03-01T00:00:00&hasta=2030-01-01T00:00:00", 400)
+        return success
+
+    def test_analitica(self):
+        """Test occupancy and revenue series"""
+        success, datos = self.run_test("Analítica mensual", "GET", "analitica/ocupacion-ingresos?anios=1", 200)
+        if success and len(datos["meses"]) != len(datos["ingresos_cobrados"]):
+            print("❌ Series de distinta longitud")
+        self.run_test("Analítica diaria", "GET", "analitica/ocupacion-ingresos?granularidad=diaria", 200)
+        return success
+
+    def test_proyeccion(self):
+        """Test rent-roll projection"""
+        success, datos = self.run_test(
+            "Proyección de rentas", "GET", "reportes/proyeccion?meses=12&probabilidad_renovacion=0.5", 200
+        )
+        if success and len(datos["meses"]) != 12:
+            print(f"❌ Se esperaban 12 meses, recibidos {len(datos['meses'])}")
+        return success
+
+    def test_morosidad(self):
+        """Test arrears aging report and export"""
+        success, datos = self.run_test("Informe de morosidad", "GET", "reportes/morosidad", 200)
+        if success and set(datos["totales"]) != {"0-30", "31-60", "61-90", "90+", "total"}:
+            print(f"❌ Tramos inesperados: {list(datos['totales'])}")
+        self.run_test("Morosidad CSV", "GET", "reportes/morosidad?formato=csv", 200)
+        return success
+
+    def test_cobros(self):
+        """Test cobros worklist"""
+        success, datos = self.run_test("Lista de cobros", "GET", "cobros?mes_anio=2025-01", 200)
+        if success and "pisos" not in datos:
+            print("❌ Falta la agrupación por piso")
+        self.run_test("Lista de cobros mes no válido", "GET", "cobros?mes_anio=enero", 400)
+        self.run_test("Lista de cobros mes sin cero", "GET", "cobros?mes_anio=2025-1", 400)
+        return success
+
+    def test_archivo(self):
+        """Test archive job and transparent archive reads"""
+        success, _ = self.run_test("Ejecutar archivado", "POST", "tareas/archivado/ejecutar", 200)
+        self.run_test("Contratos con archivo", "GET", "contratos?incluir_archivo=true", 200)
+        self.run_test("Pagos con archivo", "GET", "pagos?incluir_archivo=true", 200)
+        self.run_test("Restaurar contrato no archivado", "POST", "contratos/000000000000000000000000/restaurar", 404)
+        return success
+
+    def test_archivo_en_informes(self):
+        """Test archived contracts and pagos still count in exports and arrears"""
+        if not self.created_ids['habitacion']:
+            print("❌ Cannot test archivo en informes without habitacion")
+            return False
+        import random
+        sufijo = random.randint(1000, 9999)
+        ok, inquilino = self.run_test("Create Inquilino (archivo)", "POST", "inquilinos", 201, data={
+            "nombre": "Inquilino Archivo", "email": f"archivo{sufijo}@example.com",
+            "telefono": "+34600123456", "dni": f"7654321{sufijo}A", "activo": True
+        })
+        if not ok:
+            return False
+        ok, contrato = self.run_test("Create Contrato antiguo", "POST", "contratos", 201, data={
+            "habitacion_id": self.created_ids['habitacion'], "inquilino_id": inquilino["_id"],
+            "fecha_inicio": "2020-01-01T00:00:00", "fecha_fin": "2020-02-29T00:00:00",
+            "renta_mensual": 300.0, "fianza": 600.0, "gastos_mensuales_tarifa": 0.0, "estado": "finalizado"
+        })
+        if not ok:
+            return False
+        # Enero pagado, febrero sin pagar
+        _, pago = self.run_test("Create Pago antiguo", "POST", "pagos", 201, data={
+            "contrato_id": contrato["_id"], "mes_anio": "2020-01", "tipo": "alquiler", "importe": 300.0,
+            "metodo": "transferencia", "estado": "pagado", "creado_por_usuario_id": "admin_id"
+        })
+        success, _ = self.run_test("Archivar contrato antiguo", "POST", "tareas/archivado/ejecutar", 200)
+        self.run_test("Contrato ya archivado", "GET", f"contratos/{contrato['_id']}", 404)
+
+        _, informe = self.run_test("Morosidad con archivo", "GET", "reportes/morosidad", 200)
+        deuda = next((i for i in informe.get("inquilinos", []) if i["inquilino_id"] == inquilino["_id"]), None)
+        if not deuda or (deuda["meses_pendientes"], deuda["total"]) != (1, 300.0):
+            print(f"❌ La deuda del contrato archivado no aparece en morosidad: {deuda}")
+            success = False
+
+        for nombre, ruta, buscado in (
+            ("Export Contratos con archivo", "export/contratos", contrato["_id"]),
+            ("Export Pagos con archivo", "export/pagos", pago.get("_id")),
+        ):
+            self.tests_run += 1
+            print(f"\n🔍 Testing {nombre}...")
+            response = requests.get(f"{self.base_url}/{ruta}", headers={'Authorization': f'Bearer {self.token}'})
+            if response.status_code == 200 and buscado and buscado in response.text:
+                self.tests_passed += 1
+                print("✅ Passed - incluye el dato archivado")
+            else:
+                print(f"❌ Failed - Status: {response.status_code}, falta {buscado}")
+                success = False
+        return success
+
+    def test_importacion(self):
+        """Test CSV import in dry-run mode"""
+        self.tests_run += 1
+        print("\n🔍 Testing Importar pisos (dry_run)...")
+        response = requests.post(
+            f"{self.base_url}/importar/pisos?dry_run=true",
+            files={"archivo": (
+                "pisos.csv", b'nombre;direccion;notas\nPiso CSV;Calle 1;"Notas en\nvarias lineas"\n;Sin nombre;\n', "text/csv"
+            )},
+            headers={'Authorization': f'Bearer {self.token}'}
+        )
+        informe = response.json() if response.status_code == 200 else {}
+        success = informe.get("validas") == 1 and informe.get("insertadas") == 0 and len(informe.get("errores", [])) == 1
+        # La fila con error empieza en la línea 4: la anterior ocupa dos líneas
+        success = success and informe["errores"][0]["fila"] == 4
+        if success:
+            self.tests_passed += 1
+            print(f"✅ Passed - {informe['validas']} válidas, {len(informe['errores'])} errores")
+        else:
+            print(f"❌ Failed - Status: {response.status_code}, {response.text}")
+        return success
+
+    def test_migraciones(self):
+        """Test schema migrations status and runner"""
+        success, estado = self.run_test("Estado migraciones", "GET", "migraciones", 200)
+        if success:
+            versiones = [m["version"] for m in estado]
+            if versiones != sorted(versiones) or any(m["estado"] not in ("pendiente", "en_curso", "completada") for m in estado):
+                print(f"❌ Estado de migraciones inesperado: {estado}")
+                success = False
+        ok, resultado = self.run_test("Ejecutar migraciones", "POST", "migraciones/ejecutar", 200)
+        if ok and "motivo" not in resultado:
+            _, estado = self.run_test("Estado tras ejecutar", "GET", "migraciones", 200)
+            pendientes = [m["nombre"] for m in estado if m["estado"] != "completada"]
+            if pendientes:
+                print(f"❌ Migraciones sin completar: {pendientes}")
+                success = False
+        return success
+
+    def test_logout(self):
+        """Test logout revokes the session token (uses a separate session)"""
+        token_principal = self.token
+        self.test_login()
+        success, _ = self.run_test("Logout", "POST", "auth/logout", 200)
+        self.run_test("Token revocado tras logout", "GET", "auth/me", 401)
+        self.token = token_principal
+        self.run_test("Otra sesión sigue activa", "GET", "auth/me", 200)
+        return success
+
+    def test_limite_login(self):
+        """Test repeated failed logins for one email are throttled"""
+        datos = {"email": "fuerza.bruta@test.com", "contraseña": "incorrecta"}
+        for _ in range(4):
+            self.run_test("Login fallido", "POST", "auth/login", 401, data=datos)
+        success, _ = self.run_test("Login bloqueado tras varios fallos", "POST", "auth/login", 429, data=datos)
+        # Los inicios de sesión correctos no gastan el margen del email
+        for _ in range(6):
+            ok, _ = self.run_test(
+                "Login correcto repetido", "POST", "auth/login", 200,
+                data={"email": "admin@admin.com", "contraseña": "Admin123"}
+            )
+            success = success and ok
+        return success
+
+    def test_eventos_dashboard(self):
+        """Test the SSE stream starts with the current dashboard statistics"""
+        self.tests_run += 1
+        print("\n🔍 Testing Eventos SSE (dashboard inicial)...")
+        try:
+            self.ticket_eventos = requests.post(
+                f"{self.base_url}/eventos/ticket", headers={'Authorization': f'Bearer {self.token}'}
+            ).json()["ticket"]
+            with requests.get(
+                f"{self.base_url}/eventos?temas=dashboard&ticket={self.ticket_eventos}",
+                stream=True,
+                timeout=10
+            ) as response:
+                datos = None
+                for linea in response.iter_lines(decode_unicode=True):
+                    if linea and linea.startswith("data: "):
+                        datos = json.loads(linea[len("data: "):])
+                        break
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False
+
+        success = (
+            datos is not None and datos["tipo"] == "dashboard" and datos["accion"] == "inicial"
+            and "total_habitaciones" in datos["datos"]
+        )
+        if success:
+            self.tests_passed += 1
+            print("✅ Passed - Estadísticas iniciales recibidas")
+        else:
+            print(f"❌ Failed - Primer evento inesperado: {datos}")
+        return success
+
+    def test_ticket_eventos(self):
+        """Test SSE tickets are single-use and the JWT is not accepted in the URL"""
+        self.tests_run += 1
+        print("\n🔍 Testing Ticket de eventos (un solo uso, sin JWT en la URL)...")
+        if not getattr(self, 'ticket_eventos', None):
+            print("❌ Failed - No se obtuvo ticket")
+            return False
+        rutas = [
+            f"eventos?temas=dashboard&ticket={self.ticket_eventos}",
+            f"eventos?temas=dashboard&token={self.token}",
+        ]
+        codigos = []
+        for ruta in rutas:
+            with requests.get(f"{self.base_url}/{ruta}", stream=True, timeout=10) as response:
+                codigos.append(response.status_code)
+        success = codigos == [401, 401]
+        if success:
+            self.tests_passed += 1
+            print("✅ Passed - Ticket reutilizado y JWT en la URL rechazados")
+        else:
+            print(f"❌ Failed - Códigos: {codigos}")
+        return success
+
+    def test_coalescencia(self):
+        """Test concurrent identical requests to coalesced endpoints"""
+        self.tests_run += 1
+        print("\n🔍 Testing Peticiones simultáneas (dashboard y pagos enriquecidos)...")
+        cabeceras = {'Authorization': f'Bearer {self.token}'}
+        rutas = ["dashboard/stats"] * 5 + ["pagos/enriquecidos?estado=pendiente"] * 5
+        with ThreadPoolExecutor(max_workers=10) as ejecutor:
+            codigos = list(ejecutor.map(lambda r: requests.get(f"{self.base_url}/{r}", headers=cabeceras).status_code, rutas))
+        success = all(codigo == 200 for codigo in codigos)
+        if success:
+            self.tests_passed += 1
+            print("✅ Passed - Todas las respuestas 200")
+        else:
+            print(f"❌ Failed - Status: {codigos}")
+        return success
+
+    def test_detalles(self):
+        """Test piso and habitacion detail endpoints"""
+        success = True
+        if self.created_ids['piso']:
+            success, _ = self.run_test("Detalle piso", "GET", f"pisos/{self.created_ids['piso']}/detalle", 200)
+        if self.created_ids['habitacion']:
+            ok, detalle = self.run_test("Detalle habitación", "GET", f"habitaciones/{self.created_ids['habitacion']}/detalle", 200)
+            success = success and ok and "historial_contratos" in detalle
+        self.run_test("Detalle habitación inexistente", "GET", "habitaciones/000000000000000000000000/detalle", 404)
+        return success
+
     def cleanup(self):
         """Clean up created test data"""
         print("\n🧹 Cleaning up test data...")
@@ -482,8 +925,33 @@ def main():
     tester.test_contratos_crud()
     tester.test_pagos_crud()
     tester.test_gastos_crud()
+    tester.test_liquidacion_fianza()
     tester.test_usuarios_crud()
     tester.test_ajustes()
+    tester.test_ajustes_cache()
+    tester.test_recursos()
+    tester.test_exportacion()
+    tester.test_campos_e_ids()
+    tester.test_pisos_con_conteo()
+    tester.test_bootstrap()
+    tester.test_sync()
+    tester.test_batch()
+    tester.test_disponibilidad()
+    tester.test_analitica()
+    tester.test_proyeccion()
+    tester.test_morosidad()
+    tester.test_cobros()
+    tester.test_archivo()
+    tester.test_archivo_en_informes()
+    tester.test_importacion()
+    tester.test_migraciones()
+    tester.test_logout()
+    tester.test_limite_login()
+    tester.test_coalescencia()
+    tester.test_eventos_dashboard()
+    tester.test_ticket_eventos()
+    tester.test_detalles()
+    tester.test_tareas()
     
     # Cleanup
     tester.cleanup()
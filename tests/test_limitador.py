@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_limitador")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from limitador import EMAIL_CAPACIDAD, AlmacenMemoria, LimitadorLogin, ip_cliente  # noqa: E402
+
+
+def _peticion(reenviadas: str = None, host: str = "10.0.0.1"):
+    cabeceras = {"x-forwarded-for": reenviadas} if reenviadas else {}
+    return SimpleNamespace(headers=cabeceras, client=SimpleNamespace(host=host))
+
+
+def test_ip_cliente_usa_el_salto_de_confianza():
+    # El cliente puede inventarse las primeras entradas; la última la añade el ingress
+    peticion = _peticion("1.2.3.4, 203.0.113.7")
+    assert ip_cliente(peticion, proxies=1) == "203.0.113.7"
+    assert ip_cliente(peticion, proxies=2) == "1.2.3.4"
+    assert ip_cliente(peticion, proxies=0) == "10.0.0.1"
+    assert ip_cliente(_peticion(), proxies=1) == "10.0.0.1"
+
+
+def test_los_logins_correctos_no_gastan_el_cubo_del_email():
+    async def probar():
+        limitador = LimitadorLogin(AlmacenMemoria())
+        for _ in range(int(EMAIL_CAPACIDAD) * 2):
+            await limitador.admitir(f"ip-{_}", "ana@example.com")
+            await limitador.exito("ana@example.com")
+
+    asyncio.run(probar())
+
+
+def test_los_fallos_gastan_el_cubo_del_email():
+    async def probar():
+        limitador = LimitadorLogin(AlmacenMemoria())
+        for i in range(int(EMAIL_CAPACIDAD)):
+            await limitador.admitir(f"ip-{i}", "ana@example.com")
+            await limitador.fallo("ana@example.com")
+            await limitador.almacen.reiniciar("email:ana@example.com")  # sin el bloqueo por fallos seguidos
+        with pytest.raises(HTTPException) as error:
+            await limitador.admitir("otra-ip", "ana@example.com")
+        assert error.value.status_code == 429
+
+    asyncio.run(probar())
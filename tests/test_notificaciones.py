@@ -0,0 +1,128 @@
+import asyncio
+import os
+import socket
+import sys
+
+import pytest
+
+aiosmtpd = pytest.importorskip("aiosmtpd")
+from aiosmtpd.controller import Controller
+from aiosmtpd.handlers import Message
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_notificaciones")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from notificaciones import Despachador, EmisorEmail, LimitadorTasa  # noqa: E402
+
+
+class Buzon(Message):
+    """Guarda en memoria los mensajes que recibe el servidor SMTP de pruebas"""
+
+    def __init__(self):
+        super().__init__()
+        self.mensajes = []
+
+    def handle_message(self, message):
+        self.mensajes.append(message)
+
+
+def _puerto_libre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def servidor_smtp():
+    buzon = Buzon()
+    controlador = Controller(buzon, hostname="127.0.0.1", port=_puerto_libre())
+    controlador.start()
+    try:
+        yield controlador, buzon
+    finally:
+        controlador.stop()
+
+
+def test_enviar_lote_por_smtp(servidor_smtp):
+    controlador, buzon = servidor_smtp
+    config = {
+        "servidor": controlador.hostname,
+        "puerto": controlador.port,
+        "usar_tls": False,
+        "remitente": "cobros@empresa.test"
+    }
+    avisos = [
+        {"_id": "a1", "destinatario": "ana@test.com", "asunto": "Recordatorio de pago 2025-03", "cuerpo": "Hola Ana"},
+        {"_id": "a2", "destinatario": "luis@test.com", "asunto": "Recibo de pago 2025-03", "cuerpo": "Hola Luis"},
+    ]
+
+    resultados = asyncio.run(EmisorEmail().enviar_lote(avisos, config, LimitadorTasa(600)))
+
+    assert resultados == {"a1": None, "a2": None}
+    assert [m["To"] for m in buzon.mensajes] == ["ana@test.com", "luis@test.com"]
+    assert buzon.mensajes[0]["From"] == "cobros@empresa.test"
+    assert buzon.mensajes[0]["Subject"] == "Recordatorio de pago 2025-03"
+    assert buzon.mensajes[0].get_payload().strip() == "Hola Ana"
+
+
+class ConexionQueSeCae:
+    """Conexión SMTP falsa que se corta al enviar el mensaje número fallo_en"""
+
+    def __init__(self, fallo_en: int):
+        self.fallo_en = fallo_en
+        self.enviados = []
+
+    def send_message(self, mensaje):
+        if len(self.enviados) + 1 == self.fallo_en:
+            raise ConnectionResetError("Connection reset by peer")
+        self.enviados.append(mensaje["To"])
+
+    def quit(self):
+        raise ConnectionResetError("Connection reset by peer")
+
+
+AVISOS = [
+    {"_id": f"a{i}", "destinatario": f"inquilino{i}@test.com", "asunto": "Recordatorio", "cuerpo": "Hola"}
+    for i in range(1, 4)
+]
+
+
+def test_conexion_caida_no_reenvia_los_ya_enviados(monkeypatch):
+    conexion = ConexionQueSeCae(fallo_en=2)
+    monkeypatch.setattr(EmisorEmail, "_conectar", lambda self, config: conexion)
+
+    resultados = asyncio.run(EmisorEmail().enviar_lote(AVISOS, {"remitente": "x@test.com"}, LimitadorTasa(600)))
+
+    assert conexion.enviados == ["inquilino1@test.com"]
+    # a1 enviado, a2 con el error y a3 sin resultado: solo esos dos se reintentan
+    assert resultados["a1"] is None
+    assert "reset" in resultados["a2"]
+    assert "a3" not in resultados
+
+
+def test_error_inesperado_conserva_los_resultados_anotados(monkeypatch):
+    class EmisorQueFalla:
+        canal = "email"
+
+        async def configuracion(self):
+            return {}
+
+        async def enviar_lote(self, avisos, config, limitador, resultados):
+            resultados[avisos[0]["_id"]] = None
+            raise RuntimeError("fallo a mitad del lote")
+
+    despachador = Despachador(emisores=[EmisorQueFalla()])
+    registrados = {}
+
+    async def reclamar(canal):
+        return AVISOS
+
+    async def registrar(avisos, resultados):
+        registrados.update(resultados)
+
+    monkeypatch.setattr(despachador, "_reclamar_lote", reclamar)
+    monkeypatch.setattr(despachador, "_registrar_resultados", registrar)
+
+    assert asyncio.run(despachador.procesar_lote(despachador.emisores[0])) == 3
+    assert registrados == {"a1": None, "a2": "fallo a mitad del lote", "a3": "fallo a mitad del lote"}
@@ -0,0 +1,49 @@
+import os
+import sys
+from datetime import datetime
+
+import pandas as pd
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_ocupacion")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+from analitica import calcular_deuda  # noqa: E402
+from ocupacion import fin_efectivo, fines_efectivos  # noqa: E402
+
+AHORA = datetime(2025, 6, 10)
+
+
+def _contratos(**cambios) -> pd.DataFrame:
+    contrato = {
+        "_id": "c1", "fecha_inicio": datetime(2025, 1, 1), "fecha_fin": datetime(2025, 12, 31),
+        "fecha_finalizacion": None, "estado": "activo", "dia_pago": 1, "renta_mensual": 300.0,
+        "gastos_mensuales_tarifa": 0.0, "tiene_limpieza": False, "importe_limpieza_mensual": None,
+        **cambios
+    }
+    return pd.DataFrame([contrato])
+
+
+def test_fin_efectivo_de_un_contrato_terminado_antes_de_tiempo():
+    contrato = {"estado": "finalizado", "fecha_fin": datetime(2025, 12, 31), "fecha_finalizacion": datetime(2025, 3, 15)}
+    assert fin_efectivo(contrato, AHORA) == datetime(2025, 3, 15)
+    assert fin_efectivo({**contrato, "fecha_finalizacion": None}, AHORA) is None
+    # Terminado en su fecha: cuenta hasta fecha_fin
+    assert fin_efectivo({**contrato, "fecha_fin": datetime(2025, 5, 31)}, AHORA) == datetime(2025, 5, 31)
+
+
+def test_deuda_no_sigue_tras_la_finalizacion():
+    contratos = _contratos(estado="finalizado", fecha_finalizacion=datetime(2025, 3, 15))
+    contratos["fecha_fin"] = fines_efectivos(contratos, AHORA)
+    pagado = pd.DataFrame(columns=["contrato_id", "mes_anio", "pagado"])
+
+    deuda = calcular_deuda(contratos, pagado, pd.Timestamp(AHORA))
+
+    assert deuda["mes_anio"].tolist() == ["2025-01", "2025-02", "2025-03"]
+
+
+def test_terminado_antes_sin_fecha_no_ocupa():
+    contratos = pd.concat([_contratos(), _contratos(_id="c2", estado="finalizado")], ignore_index=True)
+    fines = fines_efectivos(contratos, AHORA)
+    assert fines.iloc[0] == pd.Timestamp(2025, 12, 31)
+    assert pd.isna(fines.iloc[1])